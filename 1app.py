@@ -3,9 +3,16 @@ import json
 import base64
 import threading
 from flask import Flask, render_template, request, jsonify, send_from_directory
-import face_recognition
 from PIL import Image
 import io
+import numpy as np
+
+import face_index
+import generations
+import lazy_models
+import search_engine
+
+face_recognition = lazy_models.lazy_module('face_recognition')
 
 app = Flask(__name__)
 
@@ -28,8 +35,30 @@ except:
 # Create photo directory if not exists
 os.makedirs(config['photo_dir'], exist_ok=True)
 
+def searchable(encodings):
+    """(encodings, filenames, photo of each matrix row, index) for one search generation"""
+    filenames, matrix, starts = search_engine.stack_encodings(encodings)
+    photos = np.repeat(np.arange(len(filenames)), np.diff(np.append(starts, len(matrix))))
+    params = dict(config.get('index', {'kind': 'brute'}))
+    index = face_index.build_index(params.pop('kind', 'brute'), matrix, **params) if filenames else None
+    return encodings, filenames, photos, index
+
+# Searches read the current generation of encodings and their index; a precompute
+# builds new ones and publishes them, so what a search is reading is never mutated
+search_generation = generations.GenerationHolder(searchable(config.get('encodings_cache', {})))
+config_lock = threading.Lock()
+
+def save_config():
+    """Write the config file atomically; precompute and admin threads both save it"""
+    with config_lock:
+        tmp_path = CONFIG_FILE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(config, encodings_cache=search_generation.current.value[0]), f)
+        os.replace(tmp_path, CONFIG_FILE)
+
 def precompute_encodings():
     """Precompute face encodings in background"""
+    generation = search_generation.begin()
     encodings = {}
     photo_dir = config['photo_dir']
     valid_extensions = ('.jpg', '.jpeg', '.png')
@@ -45,9 +74,9 @@ def precompute_encodings():
             except Exception as e:
                 print(f"Error processing {filename}: {e}")
     
-    config['encodings_cache'] = encodings
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    # A run started earlier (e.g. for the previous photo_dir) that finishes late is dropped
+    if search_generation.publish(searchable(encodings), generation):
+        save_config()
 
 # Initial precomputation
 threading.Thread(target=precompute_encodings).start()
@@ -68,8 +97,7 @@ def admin():
             config['photo_dir'] = os.path.abspath(new_dir)
             threading.Thread(target=precompute_encodings).start()
         
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f)
+        save_config()
     
     return render_template('admin.html', 
                          current_title=config['title'],
@@ -88,18 +116,13 @@ def search():
         if not input_encodings:
             return jsonify({'error': 'No faces detected'}), 400
         
-        matches = []
-        input_encoding = input_encodings[0]
-        
-        for filename, encodings in config['encodings_cache'].items():
-            for enc in encodings:
-                if face_recognition.compare_faces(
-                    [input_encoding], 
-                    [enc],
-                    tolerance=0.5
-                )[0]:
-                    matches.append(filename)
-                    break
+        # Every photo with a face within tolerance, best first
+        _, filenames, photos, index = search_generation.current.value
+        if not filenames:
+            return jsonify({'matches': []})
+        ids, distances = index.search(input_encodings[0], config.get('search_candidates', 1000))
+        found, _, _ = search_engine.top_k_photos(distances, photos[ids], k=None, tolerance=0.5)
+        matches = [filenames[i] for i in found]
         
         return jsonify({'matches': matches})
     
@@ -111,4 +134,5 @@ def serve_photo(filename):
     return send_from_directory(config['photo_dir'], filename)
 
 if __name__ == '__main__':
+    lazy_models.warm_in_background(reloader=True)
     app.run(debug=True)
\ No newline at end of file
@@ -1,13 +1,19 @@
 import os
 import json
+import threading
 import numpy as np
-import face_recognition
 from flask import Flask, render_template_string, request, redirect, url_for, session, flash, jsonify, send_from_directory
 from flask import session
 from flask import send_from_directory
 from functools import wraps
 from werkzeug.utils import secure_filename
 
+import http_cache
+import lazy_models
+import thumbnails
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'  # Change this in production
@@ -130,7 +136,40 @@ def gallery():
 @app.route('/photos/<filename>')
 def photos(filename):
     photo_dir = config.get('photo_dir', 'uploads')
-    return send_from_directory(photo_dir, filename)
+    return http_cache.send_cached_file(photo_dir, filename)
+
+# Version of a photo for cache-busting URLs
+@app.template_global()
+def photo_version(filename):
+    return http_cache.file_version(os.path.join(config.get('photo_dir', 'uploads'), filename))
+
+thumbnail_lock = threading.Lock()
+thumbnail_service = None
+
+# Thumbnail cache for the current photo directory, created once: the constructor scans the cache on disk
+def get_thumbnail_service():
+    global thumbnail_service
+    thumbnail_dir = os.path.join(config.get('photo_dir', 'uploads'), '.thumbnails')
+    with thumbnail_lock:
+        if thumbnail_service is None or thumbnail_service.cache_dir != thumbnail_dir:
+            thumbnail_service = thumbnails.ThumbnailService(thumbnail_dir)
+        return thumbnail_service
+
+# Serve thumbnails, created on first request (?size=gallery|preview)
+@app.route('/photos/thumbnails/<filename>')
+def photos_thumbnail(filename):
+    photo_dir = config.get('photo_dir', 'uploads')
+    if filename.startswith('.') or os.path.basename(filename) != filename:
+        return jsonify({'error': 'Photo not found'}), 404
+    service = get_thumbnail_service()
+    size = request.args.get('size', 'gallery')
+    if size not in service.sizes:
+        return jsonify({'error': 'Unknown thumbnail size'}), 400
+    path = service.get(photo_dir, filename, size)
+    if path is None:
+        return jsonify({'error': 'Photo not found'}), 404
+    return http_cache.send_cached_file(os.path.dirname(path), os.path.basename(path),
+                                       version=photo_version(filename))
 
 # API endpoint to simulate face search (stub)
 @app.route('/api/search_face', methods=['POST'])
@@ -496,8 +535,9 @@ GALLERY_HTML = """
     <div class="gallery">
         {% if images %}
             {% for img in images %}
-            <div class="thumbnail" onclick="openModal('{{ url_for('photos', filename=img) }}')">
-                <img src="{{ url_for('photos', filename=img) }}" alt="{{ img }}">
+            {% set v = photo_version(img) %}
+            <div class="thumbnail" onclick="openModal('{{ url_for('photos_thumbnail', filename=img, size='preview', v=v) }}')">
+                <img src="{{ url_for('photos_thumbnail', filename=img, v=v) }}" alt="{{ img }}">
             </div>
             {% endfor %}
         {% else %}
@@ -534,5 +574,8 @@ GALLERY_HTML = """
 </html>
 """
 
+lazy_models.mark_app_imported()
+
 if __name__ == '__main__':
+    lazy_models.warm_in_background(reloader=True)
     app.run(host="0.0.0.0", port=int("5000"), debug=True)
@@ -0,0 +1,79 @@
+# bench_index.py
+#
+# Recall/latency benchmark of the face_index types against the exact
+# face_distance result.
+#
+#   python bench_index.py                       # synthetic clustered encodings
+#   python bench_index.py encodings 200         # real store prefix, 200 queries
+#
+# Queries are stored encodings with a little noise added, which is what a
+# second photo of the same person looks like to the encoder.
+
+import sys
+import time
+import numpy as np
+
+import encoding_store
+import face_index
+from search_engine import face_distances
+
+K = 10
+
+
+def synthetic_matrix(n=20000, people=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=0.1, size=(people, encoding_store.ENCODING_DIM))
+    rows = centers[rng.integers(0, people, n)] + rng.normal(scale=0.03, size=(n, encoding_store.ENCODING_DIM))
+    return rows.astype(np.float32)
+
+
+def exact_top_k(matrix, query, k):
+    # Same metric as face_recognition.face_distance
+    distances = face_distances(matrix, query)
+    return set(np.argsort(distances)[:k].tolist())
+
+
+def run(index, matrix, queries, truth, **knobs):
+    recalls = []
+    start = time.time()
+    for query, expected in zip(queries, truth):
+        ids, _ = index.search(query, K, **knobs)
+        recalls.append(len(expected & set(ids.tolist())) / max(1, len(expected)))
+    elapsed = (time.time() - start) / len(queries)
+    return float(np.mean(recalls)), elapsed * 1000
+
+
+def main():
+    if len(sys.argv) > 1:
+        loaded = encoding_store.load_store(sys.argv[1])
+        if loaded is None:
+            print(f"No encoding store at {sys.argv[1]}")
+            return
+        matrix = loaded.dense()[1]
+    else:
+        matrix = synthetic_matrix()
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    rng = np.random.default_rng(1)
+    picks = rng.choice(len(matrix), size=min(n_queries, len(matrix)), replace=False)
+    queries = np.asarray(matrix[picks], dtype=np.float32) + rng.normal(scale=0.01, size=(len(picks), matrix.shape[1])).astype(np.float32)
+    truth = [exact_top_k(matrix, q, K) for q in queries]
+    print(f"{len(matrix)} encodings, {len(queries)} queries, recall@{K}")
+
+    configs = [
+        ('brute', {}, [{}]),
+        ('ivf', {}, [{'nprobe': p} for p in (1, 4, 8, 16, 32)]),
+        ('hnsw', {}, [{'ef': e} for e in (16, 32, 64, 128)]),
+    ]
+    for kind, params, knob_list in configs:
+        start = time.time()
+        index = face_index.build_index(kind, matrix, **params)
+        build_time = time.time() - start
+        for knobs in knob_list:
+            recall, latency = run(index, matrix, queries, truth, **knobs)
+            label = ', '.join(f'{k}={v}' for k, v in knobs.items()) or 'exact'
+            print(f"{kind:6s} {label:12s} build {build_time:7.2f}s  recall {recall:.3f}  {latency:8.3f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
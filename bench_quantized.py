@@ -0,0 +1,71 @@
+# bench_quantized.py
+#
+# Memory/recall benchmark of quantized encoding storage against the exact
+# face_distance result.
+#
+#   python bench_quantized.py                   # synthetic clustered encodings
+#   python bench_quantized.py encodings 200     # real store prefix, 200 queries
+#
+# rerank=1 means the shortlist is only k long, i.e. the ranking comes
+# straight from the compact codes; larger values re-rank more candidates
+# against the full precision vectors.
+
+import sys
+import time
+import numpy as np
+
+import encoding_store
+import face_index
+from bench_index import synthetic_matrix, K
+
+
+def exact_top_k(matrix, query, k):
+    # face_recognition.face_distance: float64 euclidean norm
+    distances = np.linalg.norm(np.asarray(matrix, dtype=np.float64) - query, axis=1)
+    return set(np.argsort(distances)[:k].tolist())
+
+
+def run(index, queries, truth, **knobs):
+    recalls = []
+    start = time.time()
+    for query, expected in zip(queries, truth):
+        ids, _ = index.search(query, K, **knobs)
+        recalls.append(len(expected & set(ids.tolist())) / max(1, len(expected)))
+    elapsed = (time.time() - start) / len(queries)
+    return float(np.mean(recalls)), elapsed * 1000
+
+
+def main():
+    if len(sys.argv) > 1:
+        loaded = encoding_store.load_store(sys.argv[1])
+        if loaded is None:
+            print(f"No encoding store at {sys.argv[1]}")
+            return
+        matrix = loaded.dense()[1]
+    else:
+        matrix = synthetic_matrix()
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    rng = np.random.default_rng(1)
+    picks = rng.choice(len(matrix), size=min(n_queries, len(matrix)), replace=False)
+    queries = np.asarray(matrix[picks], dtype=np.float32) + rng.normal(scale=0.01, size=(len(picks), matrix.shape[1])).astype(np.float32)
+    truth = [exact_top_k(matrix, q, K) for q in queries]
+    print(f"{len(matrix)} encodings, {len(queries)} queries, recall@{K} against float64 face_distance")
+
+    float64_bytes = len(matrix) * matrix.shape[1] * 8
+    print(f"float64  {float64_bytes / 2**20:8.2f} MiB scanned (legacy np.array(e) cache)")
+    recall, latency = run(face_index.build_index('brute', matrix), queries, truth)
+    print(f"float32  {matrix.nbytes / 2**20:8.2f} MiB scanned  saved {1 - matrix.nbytes / float64_bytes:5.1%}"
+          f"  recall {recall:.3f}  {latency:8.3f} ms/query")
+
+    for dtype in ('float16', 'int8'):
+        index = face_index.build_index('sq', matrix, dtype=dtype)
+        scanned = index.memory_bytes()
+        for rerank in (1, 2, 4, 8):
+            recall, latency = run(index, queries, truth, rerank=rerank)
+            print(f"{dtype:8s} {scanned / 2**20:8.2f} MiB scanned  saved {1 - scanned / float64_bytes:5.1%}"
+                  f"  rerank={rerank}  recall {recall:.3f}  {latency:8.3f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
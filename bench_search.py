@@ -0,0 +1,57 @@
+# bench_search.py
+#
+# Result selection benchmark: full argsort versus the search_engine core
+# (argpartition top-K, tolerance filter, per-photo best face).
+#
+#   python bench_search.py                  # 100k and 1M synthetic faces
+#   python bench_search.py 5000000 20       # 5M faces, k=20
+#
+# Distances are generated directly, so only the selection step is timed.
+
+import sys
+import time
+import numpy as np
+
+import search_engine
+
+
+def timed(fn, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return result, best * 1000
+
+
+def bench(n, k, tolerance=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    # ~1.5 faces per photo, rows grouped by photo as in the store
+    faces_per_photo = rng.integers(1, 3, size=int(n / 1.5))
+    starts = np.concatenate(([0], np.cumsum(faces_per_photo)[:-1]))
+    n = int(faces_per_photo.sum())
+    photos = np.repeat(np.arange(len(starts)), faces_per_photo)
+    distances = rng.uniform(0.3, 1.2, size=n).astype(np.float32)
+
+    sorted_rows, argsort_ms = timed(lambda: np.argsort(distances)[:k])
+    top_rows, top_ms = timed(lambda: search_engine.top_k(distances, k))
+    assert np.array_equal(np.sort(distances[sorted_rows]), distances[top_rows])
+    _, select_ms = timed(lambda: search_engine.select(distances, k, tolerance))
+    _, grouped_ms = timed(lambda: search_engine.select(search_engine.grouped_min(distances, starts), k, tolerance))
+    candidates = search_engine.top_k(distances, k * 4)
+    _, candidate_ms = timed(lambda: search_engine.top_k_photos(distances[candidates], photos[candidates], k, tolerance))
+
+    print(f"{n:>9d} faces  argsort[:{k}] {argsort_ms:8.2f} ms   top_k {top_ms:6.2f} ms   "
+          f"top_k+tolerance {select_ms:6.2f} ms   per-photo (grouped) {grouped_ms:6.2f} ms   "
+          f"per-photo ({len(candidates)} candidates) {candidate_ms:6.3f} ms")
+
+
+def main():
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    sizes = [int(sys.argv[1])] if len(sys.argv) > 1 else [100000, 1000000]
+    for n in sizes:
+        bench(n, k)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,46 @@
 import os
 import io
 import base64
-import pickle
-import concurrent.futures
 from flask import Flask, render_template, request, send_from_directory, jsonify
-import face_recognition
 from PIL import Image
 
+import encoding_file
+import lazy_models
+import search_engine
+import search_jobs
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
 app = Flask(__name__)
 app.config.update({
     'current_directory': os.path.join(os.getcwd(), 'photos'),
     'encodings_cache': None,
-    'processing': {
-        'total': 0,
-        'processed': 0,
-        'matches': [],
-        'running': False
-    }
+    'search_matrix': None
 })
 
+# Searches run as background jobs, each with its own progress record
+search_job_manager = search_jobs.JobManager(max_workers=4, ttl=600)
+app.register_blueprint(search_jobs.progress_blueprint(search_job_manager))
+
+def load_directory(directory):
+    app.config['current_directory'] = directory
+    app.config['encodings_cache'] = precompute_encodings(directory)
+    app.config['search_matrix'] = search_engine.stack_encodings(app.config['encodings_cache'])
+
 def validate_directory(path):
     return os.path.exists(path) and os.path.isdir(path)
 
 def precompute_encodings(directory):
-    cache_path = os.path.join(directory, 'face_encodings.pkl')
+    cache_path = os.path.join(directory, 'face_encodings.fenc')
     encodings = {}
     
     if os.path.exists(cache_path):
         try:
-            with open(cache_path, 'rb') as f:
-                encodings = pickle.load(f)
-            return encodings
-        except:
-            pass
+            return encoding_file.read_encodings(cache_path)
+        except encoding_file.CorruptEncodingFile as e:
+            print(f"Ignoring damaged cache: {e}")
+    elif os.path.exists(os.path.join(directory, 'face_encodings.pkl')):
+        print(f"Found legacy cache in {directory}, run migrate_encodings.py on it to keep its encodings")
 
     valid_extensions = ('.jpg', '.jpeg', '.png')
     files = [f for f in os.listdir(directory) if f.lower().endswith(valid_extensions)]
@@ -47,8 +55,7 @@ def precompute_encodings(directory):
         except Exception as e:
             print(f"Error processing {filename}: {e}")
     
-    with open(cache_path, 'wb') as f:
-        pickle.dump(encodings, f)
+    encoding_file.write_encodings(cache_path, encodings)
     
     return encodings
 
@@ -62,77 +69,40 @@ def change_directory():
     if not validate_directory(new_dir):
         return jsonify({'error': 'Invalid directory'}), 400
     
-    app.config['current_directory'] = new_dir
-    app.config['encodings_cache'] = precompute_encodings(new_dir)
+    load_directory(new_dir)
     return jsonify({'message': f'Directory changed to {new_dir}', 'file_count': len(app.config['encodings_cache'])})
 
+def run_search(job, image_data):
+    """Search job: encode the captured face and scan the current directory in chunks"""
+    image = face_recognition.load_image_file(io.BytesIO(image_data))
+    input_encodings = face_recognition.face_encodings(image)
+    if not input_encodings:
+        raise ValueError('No faces detected')
+
+    filenames, matrix, starts = app.config['search_matrix']
+    job.update(total=len(filenames))
+    for processed, matches in search_engine.iter_match_files(
+            filenames, matrix, starts, input_encodings[0], tolerance=0.5):
+        job.update(processed=processed, matches=[filename for filename, _ in matches])
+
 @app.route('/search', methods=['POST'])
 def search():
     if 'image' not in request.json:
         return jsonify({'error': 'No image provided'}), 400
     
     try:
-        # Reset processing state
-        app.config['processing'] = {
-            'total': len(app.config['encodings_cache']),
-            'processed': 0,
-            'matches': [],
-            'running': True
-        }
-        
-        # Process uploaded image
         image_data = base64.b64decode(request.json['image'].split(',')[1])
-        image = face_recognition.load_image_file(io.BytesIO(image_data))
-        input_encodings = face_recognition.face_encodings(image)
-        
-        if not input_encodings:
-            return jsonify({'error': 'No faces detected'}), 400
-        
-        # Compare faces in parallel
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for filename, encodings in app.config['encodings_cache'].items():
-                futures.append(executor.submit(
-                    process_image,
-                    filename,
-                    encodings,
-                    input_encodings[0]
-                ))
-            
-            for future in concurrent.futures.as_completed(futures):
-                result = future.result()
-                app.config['processing']['processed'] += 1
-                if result:
-                    app.config['processing']['matches'].append(result)
-        
-        app.config['processing']['running'] = False
-        return jsonify({
-            'matches': app.config['processing']['matches'],
-            'directory': app.config['current_directory']
-        })
-    
-    except Exception as e:
-        app.config['processing']['running'] = False
-        return jsonify({'error': str(e)}), 500
-
-def process_image(filename, db_encodings, input_encoding):
-    try:
-        for encoding in db_encodings:
-            if face_recognition.compare_faces([input_encoding], encoding, tolerance=0.5)[0]:
-                return filename
-        return None
     except Exception as e:
-        print(f"Error processing {filename}: {e}")
-        return None
-
-@app.route('/progress')
-def get_progress():
-    return jsonify(app.config['processing'])
+        return jsonify({'error': str(e)}), 400
+    
+    job = search_job_manager.submit(run_search, image_data)
+    return jsonify({'job_id': job.id, 'directory': app.config['current_directory']}), 202
 
 @app.route('/photos/<path:filename>')
 def serve_photo(filename):
     return send_from_directory(app.config['current_directory'], filename)
 
 if __name__ == '__main__':
-    app.config['encodings_cache'] = precompute_encodings(app.config['current_directory'])
+    load_directory(app.config['current_directory'])
+    lazy_models.warm_in_background(reloader=True)
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,196 @@
+# encoding_file.py
+#
+# Binary file format for face encodings.
+#
+# One file holds the encodings of a set of photos. All integers are
+# little-endian; every section starts on a 64-byte boundary so the vector
+# block can be memory-mapped directly.
+#
+#   header (128 bytes)
+#     magic          4s   b'FENC'
+#     version        u16  format version (2)
+#     dtype          u8   0 = float32
+#     reserved       u8
+#     dim            u32  values per encoding (128)
+#     file_count     u32  number of photos
+#     row_count      u64  number of encodings (faces)
+#     strings_off    u64  string table: utf-8 filenames, back to back
+#     strings_len    u64
+#     names_off      u64  u64[file_count + 1] byte offsets into the string table
+#     rows_off       u64  u64[file_count + 1] first row of each photo; the faces
+#                         of photo i are rows rows[i] .. rows[i + 1] - 1
+#     vectors_off    u64  row_count x dim vector block
+#     meta_crc       u32  crc32 of the string table, both offset arrays and the boxes
+#     vectors_crc    u32  crc32 of the vector block
+#     model          32s  encoder name, utf-8, NUL padded
+#     boxes_off      u64  i32[row_count x 4] face boxes (top, right, bottom,
+#                         left) in original pixels, -1 when unknown; 0 when
+#                         the file has no boxes (always the case in version 1)
+#
+# The two checksums are separate so a damaged vector block still leaves the
+# list of affected photos readable, and those photos can be re-encoded.
+
+import os
+import struct
+import zlib
+import numpy as np
+
+MAGIC = b'FENC'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sHBBIIQQQQQQII32sQ')
+HEADER_SIZE = 128
+ALIGN = 64
+DTYPES = {0: np.float32}
+DTYPE_CODES = {np.dtype(v): k for k, v in DTYPES.items()}
+DEFAULT_MODEL = 'dlib_face_recognition_resnet_model_v1'
+
+
+class CorruptEncodingFile(Exception):
+    """Raised when a file fails its header or checksum validation"""
+
+    def __init__(self, path, message, files=None):
+        super().__init__(f"{path}: {message}")
+        self.path = path
+        # Photos in the file, when the metadata itself is intact
+        self.files = files
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _crc(buffer, crc=0, chunk=1 << 24):
+    view = memoryview(buffer)
+    if view.nbytes == 0:
+        return crc
+    view = view.cast('B')
+    for start in range(0, len(view), chunk):
+        crc = zlib.crc32(view[start:start + chunk], crc)
+    return crc
+
+
+def write_file(path, entries, model=DEFAULT_MODEL, dim=128):
+    """Write [(filename, [encoding, ...]), ...] to path atomically
+
+    Entries may carry a third item, the face boxes of the encodings; the
+    boxes section is written when any entry has one.
+    """
+    names = [entry[0].encode('utf-8') for entry in entries]
+    name_offsets = np.zeros(len(names) + 1, dtype='<u8')
+    name_offsets[1:] = np.cumsum([len(n) for n in names])
+    row_offsets = np.zeros(len(entries) + 1, dtype='<u8')
+    row_offsets[1:] = np.cumsum([len(entry[1]) for entry in entries])
+    rows = [e for entry in entries for e in entry[1]]
+    vectors = np.ascontiguousarray(np.asarray(rows, dtype='<f4').reshape(-1, dim))
+    strings = b''.join(names)
+    boxes = None
+    if any(len(entry) > 2 and entry[2] is not None for entry in entries):
+        boxes = np.full((len(vectors), 4), -1, dtype='<i4')
+        for entry, start in zip(entries, row_offsets[:-1]):
+            if len(entry) > 2 and entry[2] is not None and len(entry[2]):
+                boxes[start:start + len(entry[2])] = entry[2]
+
+    strings_off = HEADER_SIZE
+    names_off = _align(strings_off + len(strings))
+    rows_off = _align(names_off + name_offsets.nbytes)
+    vectors_off = _align(rows_off + row_offsets.nbytes)
+    boxes_off = _align(vectors_off + vectors.nbytes) if boxes is not None else 0
+
+    meta_crc = _crc(row_offsets.tobytes(), _crc(name_offsets.tobytes(), _crc(strings)))
+    if boxes is not None:
+        meta_crc = _crc(boxes, meta_crc)
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, DTYPE_CODES[vectors.dtype.newbyteorder('=')], 0, dim,
+        len(entries), len(vectors), strings_off, len(strings), names_off, rows_off, vectors_off,
+        meta_crc, _crc(vectors), model.encode('utf-8')[:32], boxes_off)
+
+    blocks = [(0, header), (strings_off, strings), (names_off, name_offsets.tobytes()),
+              (rows_off, row_offsets.tobytes()), (vectors_off, vectors.tobytes())]
+    if boxes is not None:
+        blocks.append((boxes_off, boxes.tobytes()))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for offset, block in blocks:
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(block)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class EncodingFile:
+    """Read-only view of an encoding file; the vector block is memory-mapped"""
+
+    def __init__(self, path, verify=True):
+        self.path = path
+        with open(path, 'rb') as f:
+            raw = f.read(HEADER_SIZE)
+        if len(raw) < HEADER.size:
+            raise CorruptEncodingFile(path, "truncated header")
+        (magic, version, dtype, _, self.dim, self.file_count, self.row_count, strings_off, strings_len,
+         names_off, rows_off, vectors_off, meta_crc, vectors_crc, model, boxes_off) = HEADER.unpack_from(raw)
+        if magic != MAGIC:
+            raise CorruptEncodingFile(path, "not an encoding file")
+        if version > FORMAT_VERSION or dtype not in DTYPES:
+            raise CorruptEncodingFile(path, f"unsupported format version {version} / dtype {dtype}")
+        self.version = version
+        self.checksum = vectors_crc
+        self.model = model.rstrip(b'\0').decode('utf-8')
+        self.dtype = np.dtype(DTYPES[dtype])
+
+        expected = vectors_off + self.row_count * self.dim * self.dtype.itemsize
+        boxes_end = boxes_off + self.row_count * 16 if boxes_off else 0
+        if os.path.getsize(path) < max(expected, boxes_end):
+            raise CorruptEncodingFile(path, "truncated file")
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        strings = data[strings_off:strings_off + strings_len]
+        name_offsets = data[names_off:names_off + 8 * (self.file_count + 1)].view('<u8')
+        self.row_offsets = np.asarray(data[rows_off:rows_off + 8 * (self.file_count + 1)].view('<u8'),
+                                      dtype=np.int64)
+        vector_bytes = data[vectors_off:expected]
+        self.boxes = data[boxes_off:boxes_end].view('<i4').reshape(self.row_count, 4) if boxes_off else None
+        crc = _crc(self.row_offsets.astype('<u8').tobytes(), _crc(name_offsets.tobytes(), _crc(strings)))
+        if self.boxes is not None:
+            crc = _crc(np.ascontiguousarray(self.boxes), crc)
+        if verify and crc != meta_crc:
+            raise CorruptEncodingFile(path, "metadata checksum mismatch")
+
+        blob = bytes(strings)
+        self.files = [blob[int(name_offsets[i]):int(name_offsets[i + 1])].decode('utf-8')
+                      for i in range(self.file_count)]
+        if verify and _crc(vector_bytes) != vectors_crc:
+            raise CorruptEncodingFile(path, "vector checksum mismatch", files=self.files)
+        self.vectors = vector_bytes.view(self.dtype.newbyteorder('<')).reshape(self.row_count, self.dim)
+
+    def row_files(self):
+        """Index into self.files for every row"""
+        return np.repeat(np.arange(self.file_count), np.diff(self.row_offsets))
+
+    def row_faces(self):
+        """Face number within its photo for every row"""
+        return np.arange(self.row_count) - np.repeat(self.row_offsets[:-1], np.diff(self.row_offsets))
+
+    def items(self):
+        """Yield (filename, vectors) pairs"""
+        for i, name in enumerate(self.files):
+            yield name, self.vectors[self.row_offsets[i]:self.row_offsets[i + 1]]
+
+    def entries(self):
+        """Yield (filename, vectors, boxes) in the form write_file takes; boxes is None without a boxes section"""
+        for i, name in enumerate(self.files):
+            rows = slice(self.row_offsets[i], self.row_offsets[i + 1])
+            yield name, self.vectors[rows], None if self.boxes is None else self.boxes[rows]
+
+
+def write_encodings(path, encodings_cache, model=DEFAULT_MODEL):
+    """Write a {filename: [encoding, ...]} cache; photos without faces are left out"""
+    write_file(path, [(name, encodings) for name, encodings in encodings_cache.items() if len(encodings)], model)
+
+
+def read_encodings(path):
+    """Read a cache written by write_encodings as {filename: (faces x dim) array}
+
+    The arrays are views of the memory-mapped vector block, nothing is
+    copied until they are used.
+    """
+    return dict(EncodingFile(path).items())
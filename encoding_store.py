@@ -0,0 +1,364 @@
+# encoding_store.py
+#
+# Sharded binary face encoding store.
+#
+# A store is a manifest plus a directory of immutable shard files, all
+# sharing one prefix:
+#   <prefix>.shards.json    {'version': int, 'next_shard': int, 'shards': [...]}
+#   <prefix>.shards/        shard-NNNNNN.fenc files (see encoding_file.py)
+# Each shard holds every face encoding and face box of up to shard_size
+# photos, with a face -> photo mapping (the file's row offsets). A precompute
+# appends new shards and never rewrites full ones; removed or changed photos
+# are only tombstoned in the manifest ('deleted'), and a shard is compacted
+# once more than half of its photos are dead. A last shard that is less than
+# half full is merged with the next append. The manifest is replaced last,
+# so readers always see a consistent set of shards. A store has a single
+# writer at a time, also across processes (lock_writer).
+
+import os
+import json
+import threading
+import weakref
+import numpy as np
+
+import encoding_file
+
+try:
+    import fcntl
+except ImportError:  # not on POSIX: single process only
+    fcntl = None
+
+ENCODING_DIM = 128
+SHARD_SIZE = 5000
+COMPACT_RATIO = 0.5
+
+_store_lock = threading.Lock()
+_store_cache = {}
+_writer_locks = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    global _store_lock
+    # Another thread may have held the lock when the process forked
+    _store_lock = threading.Lock()
+    # An inherited copy of the writer lock's file would keep the store locked
+    # after the parent is done writing; closing it here leaves the parent's lock alone
+    for lock_file in list(_writer_locks):
+        lock_file.close()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _manifest_path(prefix):
+    return prefix + '.shards.json'
+
+
+def _shard_dir(prefix):
+    return prefix + '.shards'
+
+
+def read_manifest(prefix):
+    """Return the shard manifest of a store, or None if there is no store"""
+    path = _manifest_path(prefix)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(prefix, manifest):
+    path = _manifest_path(prefix)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _write_shards(prefix, manifest, entries, shard_size):
+    """Write entries as new shard files and add them to manifest"""
+    os.makedirs(_shard_dir(prefix), exist_ok=True)
+    for start in range(0, len(entries), shard_size):
+        chunk = entries[start:start + shard_size]
+        name = f"shard-{manifest['next_shard']:06d}.fenc"
+        manifest['next_shard'] += 1
+        encoding_file.write_file(os.path.join(_shard_dir(prefix), name), chunk, dim=ENCODING_DIM)
+        manifest['shards'].append({
+            'file': name,
+            'photos': len(chunk),
+            'rows': sum(len(entry[1]) for entry in chunk),
+            'deleted': []
+        })
+
+
+def _remove_unreferenced(prefix, manifest):
+    """Delete shard files (and their per-shard indexes) the manifest no longer uses"""
+    shard_dir = _shard_dir(prefix)
+    keep = {shard['file'].split('.')[0] for shard in manifest['shards']}
+    for name in os.listdir(shard_dir):
+        if name.split('.')[0] not in keep:
+            # Readers that already mapped the shard keep their pages after unlink
+            os.remove(os.path.join(shard_dir, name))
+
+
+def write_store(prefix, entries, shard_size=SHARD_SIZE):
+    """Write a complete store from [(filename, [encoding, ...], [box, ...]), ...] and bump its version
+
+    Boxes may be left out of the entries (legacy encodings without them).
+    """
+    entries = [entry for entry in entries if len(entry[1])]
+    old = read_manifest(prefix) or {}
+    manifest = {'version': old.get('version', 0) + 1, 'next_shard': old.get('next_shard', 0), 'shards': []}
+    _write_shards(prefix, manifest, entries, shard_size)
+    _write_manifest(prefix, manifest)
+    _remove_unreferenced(prefix, manifest)
+    return manifest['version']
+
+
+def append_store(prefix, drop, entries, shard_size=SHARD_SIZE):
+    """Tombstone the photos in drop, append entries as new shards and bump the version"""
+    manifest = read_manifest(prefix)
+    if manifest is None:
+        return write_store(prefix, entries, shard_size)
+    entries = [entry for entry in entries if len(entry[1])]
+    drop = set(drop)
+    compact = []
+    kept = []
+    for shard in manifest['shards']:
+        path = os.path.join(_shard_dir(prefix), shard['file'])
+        files = encoding_file.EncodingFile(path, verify=False).files if drop else None
+        if files is not None:
+            deleted = set(shard['deleted'])
+            deleted.update(name for name in files if name in drop)
+            shard['deleted'] = sorted(deleted)
+        if len(shard['deleted']) > shard['photos'] * COMPACT_RATIO:
+            compact.append(shard)
+        else:
+            kept.append(shard)
+    # Frequent small appends (precompute checkpoints) top up the last shard
+    # instead of leaving a trail of tiny ones
+    if entries and kept and kept[-1]['photos'] < shard_size * COMPACT_RATIO:
+        compact.append(kept.pop())
+
+    # Live photos of mostly-dead shards are rewritten together with the new ones
+    for shard in compact:
+        deleted = set(shard['deleted'])
+        try:
+            shard_file = encoding_file.EncodingFile(os.path.join(_shard_dir(prefix), shard['file']))
+        except encoding_file.CorruptEncodingFile as e:
+            print(f"Dropping damaged shard during compaction: {e}")
+            continue
+        entries.extend((name, np.array(vectors), None if boxes is None else np.array(boxes))
+                       for name, vectors, boxes in shard_file.entries() if name not in deleted)
+
+    manifest['shards'] = kept
+    manifest['version'] += 1
+    _write_shards(prefix, manifest, entries, shard_size)
+    _write_manifest(prefix, manifest)
+    _remove_unreferenced(prefix, manifest)
+    return manifest['version']
+
+
+def stale_photos(prefix):
+    """Photos that have to be encoded again
+
+    These are the photos of shards that fail their checksum, and of shards
+    written before every face and its box were stored (first face only).
+    Returns None when a shard is so damaged that its photo list cannot be
+    read either, in which case the store has to be rebuilt from scratch.
+    """
+    manifest = read_manifest(prefix)
+    stale = []
+    for shard in (manifest or {}).get('shards', []):
+        try:
+            shard_file = encoding_file.EncodingFile(os.path.join(_shard_dir(prefix), shard['file']))
+        except FileNotFoundError:
+            return None
+        except encoding_file.CorruptEncodingFile as e:
+            print(f"Damaged encoding shard: {e}")
+            if e.files is None:
+                return None
+            stale.extend(e.files)
+            continue
+        if shard_file.boxes is None:
+            stale.extend(shard_file.files)
+        else:
+            unknown = np.unique(shard_file.row_files()[shard_file.boxes[:, 0] < 0])
+            stale.extend(shard_file.files[i] for i in unknown)
+    return stale
+
+
+class Shard:
+    """One shard of a loaded store: its vectors plus which rows are still alive"""
+
+    def __init__(self, path, shard_file, deleted, base, photo_base):
+        self.path = path
+        self.source = shard_file
+        self.checksum = shard_file.checksum
+        self.files = shard_file.files
+        self.vectors = shard_file.vectors
+        self.boxes = shard_file.boxes
+        self.row_files = shard_file.row_files()
+        self.row_faces = shard_file.row_faces()
+        self.alive = None
+        if deleted:
+            dead_files = np.fromiter((name in deleted for name in self.files), dtype=bool, count=len(self.files))
+            self.alive = ~dead_files[self.row_files]
+        self.dead = 0 if self.alive is None else int(len(self.alive) - self.alive.sum())
+        # Global ids of the first row and the first photo
+        self.base = base
+        self.photo_base = photo_base
+
+
+class StoreSnapshot:
+    """Immutable view of one store version; global row ids run across all shards"""
+
+    def __init__(self, version, shards, corrupt=()):
+        self.version = version
+        self.shards = shards
+        self.corrupt = list(corrupt)
+        self.bases = np.array([shard.base for shard in shards], dtype=np.int64)
+        self.photo_bases = np.array([shard.photo_base for shard in shards], dtype=np.int64)
+        self.rows = shards[-1].base + len(shards[-1].vectors) if shards else 0
+        self.live_rows = self.rows - sum(shard.dead for shard in shards)
+
+    def __len__(self):
+        return self.live_rows
+
+    def _locate(self, gid):
+        shard = self.shards[int(np.searchsorted(self.bases, gid, side='right')) - 1]
+        return shard, int(gid - shard.base)
+
+    def image(self, gid):
+        """Filename of global row gid"""
+        shard, row = self._locate(gid)
+        return shard.files[shard.row_files[row]]
+
+    def face(self, gid):
+        """Face number of global row gid within its photo"""
+        shard, row = self._locate(gid)
+        return int(shard.row_faces[row])
+
+    def box(self, gid):
+        """Face box (top, right, bottom, left) of global row gid, or None if unknown"""
+        shard, row = self._locate(gid)
+        if shard.boxes is None or shard.boxes[row][0] < 0:
+            return None
+        return [int(v) for v in shard.boxes[row]]
+
+    def photos(self, gids):
+        """Global photo number of every row in gids, for per-photo reduction"""
+        gids = np.asarray(gids, dtype=np.int64)
+        which = np.searchsorted(self.bases, gids, side='right') - 1
+        out = np.empty(len(gids), dtype=np.int64)
+        for i in np.unique(which):
+            shard = self.shards[i]
+            mask = which == i
+            out[mask] = shard.photo_base + shard.row_files[gids[mask] - shard.base]
+        return out
+
+    def photo_name(self, pid):
+        """Filename of global photo number pid"""
+        shard = self.shards[int(np.searchsorted(self.photo_bases, pid, side='right')) - 1]
+        return shard.files[int(pid - shard.photo_base)]
+
+    def dense(self):
+        """(images, matrix) of all live rows, copied into memory"""
+        images = []
+        blocks = []
+        for shard in self.shards:
+            alive = slice(None) if shard.alive is None else shard.alive
+            images.extend(np.asarray(shard.files, dtype=object)[shard.row_files[alive]].tolist())
+            blocks.append(np.asarray(shard.vectors[alive], dtype=np.float32))
+        if not blocks:
+            return [], np.empty((0, ENCODING_DIM), dtype=np.float32)
+        return images, np.concatenate(blocks)
+
+
+def load_store(prefix, previous=None):
+    """Load a store from disk, memory-mapping every shard
+
+    Shards are immutable, so the ones already open in previous are reused and
+    only have their tombstones refreshed. Damaged shards are left out of the
+    snapshot and listed in its corrupt attribute.
+    """
+    manifest = read_manifest(prefix)
+    if manifest is None:
+        return None
+    opened = {shard.path: shard.source for shard in previous.shards} if previous else {}
+    shards = []
+    corrupt = []
+    base = 0
+    photo_base = 0
+    for entry in manifest['shards']:
+        path = os.path.join(_shard_dir(prefix), entry['file'])
+        reused = opened.get(path)
+        try:
+            shard_file = reused if reused is not None else encoding_file.EncodingFile(path)
+        except FileNotFoundError:
+            # A writer removed it after we read the manifest
+            return None
+        except encoding_file.CorruptEncodingFile as e:
+            print(f"Skipping damaged encoding shard: {e}")
+            corrupt.append(entry['file'])
+            continue
+        shards.append(Shard(path, shard_file, set(entry['deleted']), base, photo_base))
+        base += len(shard_file.vectors)
+        photo_base += len(shard_file.files)
+    return StoreSnapshot(manifest['version'], shards, corrupt)
+
+
+def _stamp(prefix):
+    try:
+        st = os.stat(_manifest_path(prefix))
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def get_store(prefix):
+    """Return the current StoreSnapshot, reloading only when the manifest changes"""
+    stamp = _stamp(prefix)
+    # Snapshots are immutable, so the common case needs no lock
+    cached = _store_cache.get(prefix)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with _store_lock:
+        cached = _store_cache.get(prefix)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        loaded = load_store(prefix, cached[1] if cached else None) if stamp is not None else None
+        if loaded is None and stamp is not None and cached is not None:
+            # Caught a writer mid-swap, keep serving the previous version
+            return cached[1]
+        if loaded is None:
+            loaded = StoreSnapshot(None, [])
+        elif cached is not None and loaded.version == cached[1].version:
+            # Manifest was touched but nothing changed
+            loaded = cached[1]
+        _store_cache[prefix] = (stamp, loaded)
+        return loaded
+
+
+def lock_writer(prefix):
+    """Take the writer lock of a store, or return None if another process holds it
+
+    Keep the returned file open while writing; closing it releases the lock.
+    """
+    lock_file = open(prefix + '.lock', 'a')
+    if fcntl is not None:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+    _writer_locks.add(lock_file)
+    return lock_file
+
+
+def store_version(prefix):
+    """Version of the currently loaded store"""
+    return get_store(prefix).version
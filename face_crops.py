@@ -0,0 +1,55 @@
+# face_crops.py
+#
+# Tight face-crop thumbnails.
+#
+# The precompute workers already hold the decoded photo and the face boxes,
+# so they cut the crops right there instead of decoding the photo a second
+# time. Crops live in one directory, named after a hash of the photo's
+# filename plus the face number, e.g. 3f2a...-1.jpg for the second face.
+
+import os
+import glob
+import hashlib
+from PIL import Image
+
+DEFAULT_SIDE = 160
+DEFAULT_MARGIN = 0.3
+
+
+def _stem(filename):
+    return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:20]
+
+
+def crop_name(filename, face):
+    """File name of the crop of face number face of photo filename"""
+    return f'{_stem(filename)}-{int(face)}.jpg'
+
+
+def remove_face_crops(crop_dir, filename):
+    """Delete every crop of a photo"""
+    for path in glob.glob(os.path.join(crop_dir, _stem(filename) + '-*.jpg')):
+        os.remove(path)
+
+
+def save_face_crops(image, boxes, crop_dir, filename, side=DEFAULT_SIDE, margin=DEFAULT_MARGIN):
+    """Write a square side x side crop around every (top, right, bottom, left) box of image
+
+    Boxes are in the pixels of image; margin widens each box by that
+    fraction of its size so the crop shows the whole head.
+    """
+    os.makedirs(crop_dir, exist_ok=True)
+    remove_face_crops(crop_dir, filename)
+    height, width = image.shape[:2]
+    for face, (top, right, bottom, left) in enumerate(boxes):
+        size = max(bottom - top, right - left) * (1 + 2 * margin)
+        cy, cx = (top + bottom) / 2, (left + right) / 2
+        y0, x0 = max(0, int(cy - size / 2)), max(0, int(cx - size / 2))
+        y1, x1 = min(height, int(cy + size / 2)), min(width, int(cx + size / 2))
+        if y1 <= y0 or x1 <= x0:
+            continue
+        crop = Image.fromarray(image[y0:y1, x0:x1])
+        crop.thumbnail((side, side))
+        path = os.path.join(crop_dir, crop_name(filename, face))
+        tmp_path = path + '.tmp.jpg'
+        crop.save(tmp_path, quality=85)
+        os.replace(tmp_path, path)
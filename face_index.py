@@ -0,0 +1,538 @@
+# face_index.py
+#
+# Pluggable nearest-neighbour indexes over a face encoding matrix.
+#
+# Every index answers search(query, k) -> (ids, distances), sorted by
+# ascending euclidean distance, where ids are row numbers of the matrix it
+# was built on. Indexes never copy the matrix, so they can sit on top of the
+# memory-mapped encoding store; save()/load_index() persist only the index
+# structure and need the same matrix handed back on load.
+#
+#   brute  exact linear scan
+#   ivf    coarse k-means + inverted lists, recall knob: nprobe
+#   hnsw   hierarchical navigable small world graph, recall knob: ef
+#   sq     scalar-quantized scan (float16 or per-dimension int8) with exact
+#          re-ranking of the best candidates, recall knob: rerank
+#
+# search_batch(queries, k) answers several query faces at once; the brute
+# force index does it with a single matrix product.
+#
+# ShardedIndex keeps one index per shard of the encoding store, searches the
+# shards in parallel and merges their results into global row ids.
+
+import os
+import heapq
+import math
+import zipfile
+import tempfile
+import concurrent.futures
+import numpy as np
+
+from search_engine import face_distances, batch_face_distances, top_k
+
+
+def _pairwise_sq(a, b):
+    """Squared distances between every row of a and every row of b"""
+    sq = (a * a).sum(axis=1)[:, None] - 2.0 * (a @ b.T) + (b * b).sum(axis=1)[None, :]
+    return np.maximum(sq, 0.0)
+
+
+class _Index:
+    def search_batch(self, queries, k=10):
+        """[(ids, distances), ...], one entry per query"""
+        return [self.search(query, k) for query in queries]
+
+    def matches(self, params):
+        """False if a loaded index was built with different build-time params"""
+        return True
+
+
+class BruteForceIndex(_Index):
+    """Exact search, the reference every other index is measured against"""
+    kind = 'brute'
+
+    def __init__(self):
+        self.matrix = None
+
+    def build(self, matrix):
+        self.matrix = matrix
+        return self
+
+    def search(self, query, k=10):
+        distances = face_distances(self.matrix, query)
+        ids = top_k(distances, k)
+        return ids, distances[ids]
+
+    def search_batch(self, queries, k=10):
+        results = []
+        for distances in batch_face_distances(self.matrix, queries):
+            ids = top_k(distances, k)
+            results.append((ids, distances[ids]))
+        return results
+
+    def _state(self):
+        return {}
+
+    def _restore(self, state, matrix):
+        self.matrix = matrix
+
+
+class IVFIndex(_Index):
+    """Inverted file index: faces are bucketed by their nearest k-means centroid"""
+    kind = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, iterations=10, sample_size=100000, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.sample_size = sample_size
+        self.seed = seed
+        self.matrix = None
+        self.centroids = None
+        self.ids = None
+        self.offsets = None
+
+    def _assign(self, vectors, chunk=65536):
+        labels = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), chunk):
+            block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+            labels[start:start + chunk] = _pairwise_sq(block, self.centroids).argmin(axis=1)
+        return labels
+
+    def _train(self, matrix, nlist):
+        rng = np.random.default_rng(self.seed)
+        n = len(matrix)
+        sample = rng.choice(n, size=min(n, self.sample_size), replace=False)
+        sample = np.asarray(matrix[np.sort(sample)], dtype=np.float32)
+        self.centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = self._assign(sample)
+            counts = np.bincount(labels, minlength=nlist)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, sample)
+            filled = counts > 0
+            self.centroids[filled] = sums[filled] / counts[filled, None]
+            # Re-seed empty lists from random sample points
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                self.centroids[empty] = sample[rng.choice(len(sample), size=len(empty))]
+
+    def build(self, matrix):
+        self.matrix = matrix
+        n = len(matrix)
+        if n == 0:
+            self.centroids = np.empty((0, matrix.shape[1]), dtype=np.float32)
+            self.ids = np.empty(0, dtype=np.int64)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return self
+        nlist = min(n, self.nlist or max(1, int(math.sqrt(n))))
+        self._train(matrix, nlist)
+        labels = self._assign(matrix)
+        self.ids = np.argsort(labels, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=nlist))))
+        return self
+
+    def search(self, query, k=10, nprobe=None):
+        if len(self.ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probe = top_k(face_distances(self.centroids, query), nprobe)
+        candidates = np.concatenate([self.ids[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+        candidates.sort()  # sequential reads from the memory-mapped matrix
+        distances = face_distances(self.matrix[candidates], query)
+        best = top_k(distances, k)
+        return candidates[best], distances[best]
+
+    def _state(self):
+        return {'nprobe': self.nprobe, 'centroids': self.centroids, 'ids': self.ids, 'offsets': self.offsets}
+
+    def _restore(self, state, matrix):
+        self.matrix = matrix
+        self.nprobe = int(state['nprobe'])
+        self.centroids = state['centroids']
+        self.ids = state['ids']
+        self.offsets = state['offsets']
+        self.nlist = len(self.centroids)
+
+
+class HNSWIndex(_Index):
+    """Hierarchical navigable small world graph (Malkov & Yashunin)"""
+    kind = 'hnsw'
+
+    def __init__(self, M=16, ef_construction=100, ef=64, seed=0):
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef = ef
+        self.seed = seed
+        self.matrix = None
+        self.entry_point = -1
+        self.max_level = -1
+        # Frozen graph, one CSR block per level: nodes (sorted ids present on
+        # that level), indptr and indices into the matrix
+        self.layers = []
+        self._links = None
+
+    def _max_links(self, level):
+        return 2 * self.M if level == 0 else self.M
+
+    def _neighbours(self, node, level):
+        if self._links is not None:
+            return self._links[node][level]
+        nodes, indptr, indices = self.layers[level]
+        pos = node if level == 0 else int(np.searchsorted(nodes, node))
+        return indices[indptr[pos]:indptr[pos + 1]].tolist()
+
+    def _search_layer(self, query, entry_points, ef, level):
+        visited = set(entry_points)
+        dists = face_distances(self.matrix[entry_points], query)
+        candidates = [(float(d), e) for d, e in zip(dists, entry_points)]
+        heapq.heapify(candidates)
+        results = [(-d, e) for d, e in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if dist > -results[0][0]:
+                break
+            fresh = [n for n in self._neighbours(node, level) if n not in visited]
+            if not fresh:
+                continue
+            visited.update(fresh)
+            for d, n in zip(face_distances(self.matrix[fresh], query), fresh):
+                d = float(d)
+                if len(results) < ef or d < -results[0][0]:
+                    heapq.heappush(candidates, (d, n))
+                    heapq.heappush(results, (-d, n))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, n) for d, n in results)
+
+    def _insert(self, node, level):
+        query = self.matrix[node]
+        self._links[node] = [[] for _ in range(level + 1)]
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return
+
+        entry = [self.entry_point]
+        for lvl in range(self.max_level, level, -1):
+            entry = [self._search_layer(query, entry, 1, lvl)[0][1]]
+
+        for lvl in range(min(level, self.max_level), -1, -1):
+            found = self._search_layer(query, entry, self.ef_construction, lvl)
+            neighbours = [n for _, n in found[:self.M]]
+            self._links[node][lvl] = neighbours
+            limit = self._max_links(lvl)
+            for n in neighbours:
+                links = self._links[n][lvl]
+                links.append(node)
+                if len(links) > limit:
+                    d = face_distances(self.matrix[links], self.matrix[n])
+                    self._links[n][lvl] = [links[i] for i in np.argsort(d)[:limit]]
+            entry = [n for _, n in found]
+
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+
+    def _freeze(self):
+        self.layers = []
+        for level in range(self.max_level + 1):
+            nodes = [n for n, links in enumerate(self._links) if len(links) > level]
+            indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum([len(self._links[n][level]) for n in nodes])
+            indices = np.fromiter(
+                (m for n in nodes for m in self._links[n][level]), dtype=np.int64, count=int(indptr[-1]))
+            self.layers.append((np.asarray(nodes, dtype=np.int64), indptr, indices))
+        self._links = None
+
+    def build(self, matrix):
+        self.matrix = matrix
+        rng = np.random.default_rng(self.seed)
+        level_mult = 1.0 / math.log(self.M)
+        levels = (-np.log(1.0 - rng.random(len(matrix))) * level_mult).astype(np.int64)
+        self._links = [None] * len(matrix)
+        self.entry_point, self.max_level = -1, -1
+        for node in range(len(matrix)):
+            self._insert(node, int(levels[node]))
+        self._freeze()
+        return self
+
+    def search(self, query, k=10, ef=None):
+        if self.entry_point < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        entry = [self.entry_point]
+        for level in range(self.max_level, 0, -1):
+            entry = [self._search_layer(query, entry, 1, level)[0][1]]
+        found = self._search_layer(query, entry, max(ef or self.ef, k), 0)[:k]
+        ids = np.array([n for _, n in found], dtype=np.int64)
+        return ids, np.array([d for d, _ in found], dtype=np.float32)
+
+    def _state(self):
+        state = {'M': self.M, 'ef': self.ef, 'entry_point': self.entry_point, 'max_level': self.max_level}
+        for level, (nodes, indptr, indices) in enumerate(self.layers):
+            state[f'nodes_{level}'] = nodes
+            state[f'indptr_{level}'] = indptr
+            state[f'indices_{level}'] = indices
+        return state
+
+    def _restore(self, state, matrix):
+        self.matrix = matrix
+        self.M = int(state['M'])
+        self.ef = int(state['ef'])
+        self.entry_point = int(state['entry_point'])
+        self.max_level = int(state['max_level'])
+        self.layers = [
+            (state[f'nodes_{level}'], state[f'indptr_{level}'], state[f'indices_{level}'])
+            for level in range(self.max_level + 1)
+        ]
+
+
+class QuantizedIndex(_Index):
+    """Linear scan over compact codes, then exact distances for the best candidates
+
+    float16 halves the memory of the scanned data; int8 maps every dimension
+    onto 256 steps between its min and max and quarters it. The full
+    precision matrix is only read for the rerank * k candidates, so it can
+    stay on disk behind the memory map. numpy has no fast float16 matrix
+    product, so codes are widened to float32 chunk_rows at a time for the
+    scan: float16 saves memory, not scan time.
+    """
+    kind = 'sq'
+
+    def __init__(self, dtype='int8', rerank=4, chunk_rows=262144):
+        if dtype not in ('int8', 'float16'):
+            raise ValueError(f"Unsupported quantization: {dtype}")
+        self.dtype = dtype
+        self.rerank = rerank
+        self.chunk_rows = chunk_rows
+        self.matrix = None
+        self.codes = None
+        self.low = None
+        self.step = None
+        self.norms = None
+
+    def build(self, matrix):
+        self.matrix = matrix
+        dim = matrix.shape[1]
+        if self.dtype == 'float16':
+            self.codes = np.empty((len(matrix), dim), dtype=np.float16)
+        else:
+            self.low = np.full(dim, np.inf, dtype=np.float32)
+            high = np.full(dim, -np.inf, dtype=np.float32)
+            for start in range(0, len(matrix), self.chunk_rows):
+                block = np.asarray(matrix[start:start + self.chunk_rows], dtype=np.float32)
+                self.low = np.minimum(self.low, block.min(axis=0))
+                high = np.maximum(high, block.max(axis=0))
+            if len(matrix) == 0:
+                self.low, high = np.zeros(dim, dtype=np.float32), np.ones(dim, dtype=np.float32)
+            self.step = np.maximum(high - self.low, 1e-12) / 255.0
+            self.codes = np.empty((len(matrix), dim), dtype=np.int8)
+        for start in range(0, len(matrix), self.chunk_rows):
+            block = np.asarray(matrix[start:start + self.chunk_rows], dtype=np.float32)
+            self.codes[start:start + len(block)] = self._encode(block)
+        self._prepare()
+        return self
+
+    def _encode(self, block):
+        if self.dtype == 'float16':
+            return block.astype(np.float16)
+        return (np.clip(np.rint((block - self.low) / self.step), 0, 255) - 128).astype(np.int8)
+
+    def _prepare(self):
+        # Distances are taken in code space, weighted per dimension:
+        # |x - q|^2 = sum(w * (c - q')^2) with w = step^2 and q' the query's code
+        dim = self.codes.shape[1]
+        self.weights = np.ones(dim, dtype=np.float32) if self.step is None else self.step * self.step
+        self.norms = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), self.chunk_rows):
+            block = self.codes[start:start + self.chunk_rows].astype(np.float32)
+            self.norms[start:start + len(block)] = (block * block) @ self.weights
+
+    def _query_codes(self, queries):
+        if self.step is None:
+            return queries
+        return (queries - self.low) / self.step - 128.0
+
+    def search_batch(self, queries, k=10, rerank=None):
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.codes.shape[1])
+        candidates = min(len(self.codes), max(k, k * (rerank or self.rerank)))
+        coded = self._query_codes(queries)
+        weighted = (coded * self.weights).T
+        q_sq = (coded * coded) @ self.weights
+        # Approximate squared distances; only their order matters here
+        coarse = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), self.chunk_rows):
+            block = self.codes[start:start + self.chunk_rows].astype(np.float32)
+            out = coarse[:, start:start + len(block)]
+            out[:] = (block @ weighted).T
+            out *= -2.0
+            out += self.norms[None, start:start + len(block)] + q_sq[:, None]
+        results = []
+        for query, distances in zip(queries, coarse):
+            # Re-rank the approximate shortlist against the full precision rows
+            shortlist = np.sort(top_k(distances, candidates))
+            exact = face_distances(self.matrix[shortlist], query)
+            best = top_k(exact, k)
+            results.append((shortlist[best], exact[best]))
+        return results
+
+    def search(self, query, k=10, rerank=None):
+        return self.search_batch([query], k, rerank)[0]
+
+    def matches(self, params):
+        return params.get('dtype', 'int8') == self.dtype
+
+    def memory_bytes(self):
+        """Bytes of the data every query scans"""
+        extra = 0 if self.low is None else self.low.nbytes + self.step.nbytes
+        return self.codes.nbytes + self.norms.nbytes + extra
+
+    def _state(self):
+        state = {'dtype': self.dtype, 'rerank': self.rerank, 'codes': self.codes}
+        if self.low is not None:
+            state['low'] = self.low
+            state['step'] = self.step
+        return state
+
+    def _restore(self, state, matrix):
+        self.matrix = matrix
+        self.dtype = str(state['dtype'])
+        self.rerank = int(state['rerank'])
+        self.codes = state['codes']
+        self.low = state['low'] if 'low' in state else None
+        self.step = state['step'] if 'step' in state else None
+        self._prepare()
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (BruteForceIndex, IVFIndex, HNSWIndex, QuantizedIndex)}
+
+
+def build_index(kind, matrix, **params):
+    """Build an index of the given kind over matrix"""
+    if kind not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type: {kind}")
+    return INDEX_TYPES[kind](**params).build(matrix)
+
+
+def save_index(index, path, store_version=None):
+    """Persist the index structure (not the vectors) to an .npz file"""
+    state = index._state()
+    state['kind'] = index.kind
+    state['rows'] = len(index.matrix)
+    state['store_version'] = -1 if store_version is None else store_version
+    # A name of its own, so processes saving the same index at once don't clobber each other
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_index(path, matrix, store_version=None):
+    """Load a persisted index on top of matrix, or None if it is missing, stale or damaged"""
+    try:
+        with np.load(path) as data:
+            state = {key: data[key] for key in data.files}
+        if int(state['rows']) != len(matrix):
+            return None
+        if store_version is not None and int(state['store_version']) != store_version:
+            return None
+        index = INDEX_TYPES[str(state['kind'])]()
+        index._restore(state, matrix)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError, KeyError, IndexError, zipfile.BadZipFile) as e:
+        # Truncated or corrupt: the caller builds it again
+        print(f"Ignoring damaged index {path}: {e}")
+        return None
+    return index
+
+
+def load_or_build_index(path, matrix, store_version, kind='brute', **params):
+    """Reuse the persisted index for this store version, rebuilding it when stale"""
+    index = load_index(path, matrix, store_version)
+    if index is not None and index.kind == kind and index.matches(params):
+        # Search-time knobs (nprobe, ef, rerank) may be retuned without a rebuild
+        for knob in ('nprobe', 'ef', 'rerank'):
+            if knob in params:
+                setattr(index, knob, params[knob])
+        return index
+    index = build_index(kind, matrix, **params)
+    if kind != 'brute':
+        save_index(index, path, store_version)
+    return index
+
+
+class ShardedIndex:
+    """One index per store shard, searched in parallel
+
+    shards are encoding_store.Shard objects. Shard files never change, so a
+    shard's index is persisted next to it, tagged with the shard checksum,
+    and carried over from the previous ShardedIndex when the store grows.
+    Rows of tombstoned photos are filtered out of each shard's results.
+    """
+
+    def __init__(self, shards, kind='brute', previous=None, workers=None, **params):
+        self.kind = kind
+        self.shards = shards
+        reuse = previous.by_path if previous is not None and previous.kind == kind else {}
+        self.by_path = {}
+        self.indexes = []
+        for shard in shards:
+            index = reuse.get(shard.path)
+            if index is None:
+                index = load_or_build_index(f'{shard.path}.{kind}.npz', shard.vectors, shard.checksum, kind, **params)
+            self.by_path[shard.path] = index
+            self.indexes.append(index)
+        self.workers = workers or min(8, len(shards))
+        self._executor = None
+        self._executor_pid = None
+
+    def _search_shard(self, i, queries, k):
+        shard = self.shards[i]
+        results = []
+        # Over-fetch by the number of dead rows so tombstones cannot crowd out live hits
+        for ids, distances in self.indexes[i].search_batch(queries, k + shard.dead):
+            if shard.alive is not None:
+                live = shard.alive[ids]
+                ids, distances = ids[live], distances[live]
+            results.append((ids[:k] + shard.base, distances[:k]))
+        return results
+
+    def _pool(self):
+        # Created on first use in each process: a pool inherited through fork has no threads
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def search_batch(self, queries, k=10):
+        if not self.shards:
+            empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+            return [empty for _ in queries]
+        if len(self.shards) == 1:
+            per_shard = [self._search_shard(0, queries, k)]
+        else:
+            per_shard = list(self._pool().map(lambda i: self._search_shard(i, queries, k), range(len(self.shards))))
+        merged = []
+        for q in range(len(queries)):
+            ids = np.concatenate([results[q][0] for results in per_shard])
+            distances = np.concatenate([results[q][1] for results in per_shard])
+            best = top_k(distances, k)
+            merged.append((ids[best], distances[best]))
+        return merged
+
+    def search(self, query, k=10):
+        return self.search_batch([query], k)[0]
+
+    def close(self):
+        """Stop the search threads; the per-shard indexes may live on in a newer ShardedIndex"""
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,76 @@
+# generations.py
+#
+# Copy-on-write publication of search state.
+#
+# A GenerationHolder always points at one immutable Generation. Readers take
+# holder.current, a single attribute read with no lock, and keep using that
+# generation for the whole request even if a newer one is published
+# meanwhile. Writers build the next value off to the side and publish() it,
+# which swaps the pointer. An old generation is released (on_release is
+# called with its value) when the last reader drops its reference, so
+# readers must hold on to the Generation, not just its value.
+
+import os
+import threading
+import weakref
+
+_holders = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    # A writer may have been publishing when the process forked
+    for holder in list(_holders):
+        holder._lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class Generation:
+    """One published value and its generation number"""
+    __slots__ = ('number', 'value', '__weakref__')
+
+    def __init__(self, number, value):
+        self.number = number
+        self.value = value
+
+
+class GenerationHolder:
+    def __init__(self, value=None, on_release=None):
+        self._on_release = on_release
+        self._lock = threading.Lock()  # serializes writers only
+        self._next = 0
+        self._current = Generation(0, value)
+        _holders.add(self)
+
+    @property
+    def current(self):
+        return self._current
+
+    def begin(self):
+        """Reserve a generation number before starting a build"""
+        with self._lock:
+            self._next += 1
+            return self._next
+
+    def publish(self, value, number=None):
+        """Make value the current generation
+
+        A build that began before the current generation's build is stale
+        and is dropped; returns False in that case.
+        """
+        if number is None:
+            number = self.begin()
+        with self._lock:
+            if number <= self._current.number:
+                stale = value
+                old = None
+            else:
+                old, self._current = self._current, Generation(number, value)
+        if old is None:
+            if self._on_release is not None:
+                self._on_release(stale)
+            return False
+        if self._on_release is not None and old.value is not None:
+            weakref.finalize(old, self._on_release, old.value)
+        return True
@@ -0,0 +1,67 @@
+# http_cache.py
+#
+# Cache-friendly file responses for photos and thumbnails.
+#
+# Every response carries a content-hash ETag and Last-Modified, so browsers
+# revalidate with If-None-Match / If-Modified-Since and get a 304 instead of
+# the whole image. URLs may carry ?v=<file_version()>, a version derived
+# from the file's size and mtime (the apps add it with url_for(..., v=...));
+# when a request carries the current version the response is marked
+# immutable and cached for a year, since any change to the file produces a
+# different URL.
+
+import os
+import hashlib
+from functools import lru_cache
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+DEFAULT_MAX_AGE = 3600
+
+
+@lru_cache(maxsize=65536)
+def _content_hash(path, size, mtime_ns):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_etag(path):
+    """SHA-1 of the file, computed once per (size, mtime) of the file"""
+    st = os.stat(path)
+    return _content_hash(path, st.st_size, st.st_mtime_ns)
+
+
+def file_version(path):
+    """Cheap version string for cache-busting URLs, or None if the file is missing"""
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, TypeError):
+        return None
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+
+def send_cached_file(directory, filename, max_age=DEFAULT_MAX_AGE, version=None):
+    """send_from_directory with a content ETag, 304 handling and versioned immutable caching
+
+    version is what ?v= must equal for the response to be immutable; it
+    defaults to file_version() of the file itself. Derived files such as
+    thumbnails pass the version of their source photo.
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        # Let send_from_directory produce its usual 404
+        return send_from_directory(directory, filename)
+
+    requested = request.args.get('v')
+    immutable = requested is not None and requested == (version or file_version(path))
+    response = send_from_directory(
+        directory, filename,
+        etag=content_etag(path),
+        max_age=IMMUTABLE_MAX_AGE if immutable else max_age)
+    if immutable:
+        response.cache_control.immutable = True
+    return response
@@ -0,0 +1,50 @@
+# image_loader.py
+#
+# Reduced-resolution image decoding for the ingest path.
+#
+# The 24MP DSLR originals decode to ~72MB RGB arrays, but face detection and
+# the 150px face chips used for encoding need a fraction of that. For JPEGs
+# Pillow's draft mode lets libjpeg decode directly at 1/2, 1/4 or 1/8 scale,
+# which skips most of the IDCT work and never allocates the full-size buffer.
+
+import numpy as np
+from PIL import Image
+
+
+def load_image_scaled(path, max_side=None):
+    """Decode path as an RGB array whose longest side is at most max_side
+
+    Returns (image, scale) where scale maps original pixel coordinates onto
+    the returned image (1.0 when decoded at full resolution).
+    """
+    with Image.open(path) as img:
+        full_width, full_height = img.size
+        if max_side and max(full_width, full_height) > max_side:
+            # draft() picks the smallest JPEG scale that is still >= the requested size
+            img.draft('RGB', (max_side, max_side))
+        img = img.convert('RGB')
+        if max_side and max(img.size) > max_side:
+            ratio = max_side / max(img.size)
+            img = img.resize((max(1, round(img.size[0] * ratio)), max(1, round(img.size[1] * ratio))),
+                             Image.BILINEAR)
+        return np.asarray(img), img.size[0] / full_width
+
+
+def downscale(image, max_side):
+    """Shrink an RGB array so its longest side is at most max_side, returning (image, scale)"""
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width) if max_side else 1.0
+    if scale >= 1.0:
+        return image, 1.0
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR)), scale
+
+
+def scale_boxes(boxes, scale, shape=None):
+    """Map (top, right, bottom, left) boxes by dividing by scale, clipped to shape if given"""
+    if scale == 1.0:
+        return [tuple(int(v) for v in box) for box in boxes]
+    height, width = shape[:2] if shape is not None else (float('inf'), float('inf'))
+    return [(max(0, int(top / scale)), int(min(width, round(right / scale))),
+             int(min(height, round(bottom / scale))), max(0, int(left / scale)))
+            for top, right, bottom, left in boxes]
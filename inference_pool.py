@@ -0,0 +1,367 @@
+# inference_pool.py
+#
+# Long-lived pool of face encoding processes.
+#
+# Each worker process imports face_recognition once when it starts, so the
+# dlib detector, landmark and ResNet models stay loaded for its whole life
+# instead of being reloaded for every request. Query images are sent to the
+# workers over a multiprocessing queue. A worker writes the face boxes and
+# encodings into a shared-memory result slot reserved for the request and
+# only sends back the face count, so results are never pickled.
+#
+# Backpressure: there is one result slot per worker thread
+# (workers * concurrency) and up to queue_size requests may wait for a free
+# one. Beyond that submit() raises PoolBusy at once, so the apps can answer
+# 503 instead of piling up requests.
+#
+# Workers are started the way precompute_pipeline starts its processes (the
+# platform default, fork on Linux); spawn would re-run the app module in
+# every worker, photo watcher included. Each worker has its own task queue
+# and result pipe, so the pool knows which requests every worker holds, and
+# a worker killed in the middle of a write cannot jam the others. The pool
+# watches the workers' sentinels: a worker that dies is replaced and every
+# request it held fails with InferenceError, started or not. One that dies
+# before loading its models is not replaced, so a broken install cannot
+# respawn forever. A worker whose parent is gone exits.
+
+import io
+import os
+import time
+import itertools
+import threading
+import collections
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import shared_memory
+import numpy as np
+
+import lazy_models
+
+ENCODING_DIM = 128
+
+
+class PoolBusy(Exception):
+    """Every worker is busy and the wait queue is full"""
+
+
+class InferenceError(Exception):
+    """A worker failed to encode a query image"""
+
+
+def _slot_arrays(buf, max_faces):
+    encodings = np.ndarray((max_faces, ENCODING_DIM), dtype=np.float64, buffer=buf)
+    boxes = np.ndarray((max_faces, 4), dtype=np.int32, buffer=buf, offset=encodings.nbytes)
+    return encodings, boxes
+
+
+def encode_image(face_recognition, data, model='hog', upsample=1, max_faces=16):
+    """Boxes and encodings of the faces in encoded image bytes"""
+    image = face_recognition.load_image_file(io.BytesIO(data))
+    boxes = face_recognition.face_locations(image, number_of_times_to_upsample=upsample, model=model)[:max_faces]
+    return boxes, face_recognition.face_encodings(image, boxes) if boxes else []
+
+
+def wait_result(future, timeout=None):
+    """future.result(timeout), a timeout raising InferenceError"""
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        raise InferenceError(f"No inference result within {timeout}s") from None
+
+
+def _exit_with_parent(parent):
+    while os.getppid() == parent:
+        time.sleep(1.0)
+    os._exit(0)
+
+
+def _worker_main(tasks, results, slot_names, max_faces, model, upsample, concurrency, parent):
+    """Entry point of a worker process"""
+    threading.Thread(target=_exit_with_parent, args=(parent,), daemon=True).start()
+    import face_recognition  # loads the models, which stay warm for the life of the process
+    handles = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    slots = [_slot_arrays(handle.buf, max_faces) for handle in handles]
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            results.send(message)
+
+    send(('ready', None, None))
+
+    def serve():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            task_id, slot, data = task
+            try:
+                boxes, encodings = encode_image(face_recognition, data, model, upsample, max_faces)
+                out_encodings, out_boxes = slots[slot]
+                for i, (box, encoding) in enumerate(zip(boxes, encodings)):
+                    out_encodings[i] = encoding
+                    out_boxes[i] = box
+                send(('done', task_id, len(encodings)))
+            except Exception as e:
+                send(('error', task_id, str(e)))
+
+    threads = [threading.Thread(target=serve) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class _Worker:
+    """A worker process, its task queue and result pipe, and how many requests it holds"""
+
+    def __init__(self, process, tasks, results):
+        self.process = process
+        self.tasks = tasks
+        self.results = results
+        self.load = 0
+
+
+class InferencePool:
+    """Query image encoding on worker processes that keep the models loaded
+
+    workers=0 encodes in the calling thread instead, with the same interface.
+    """
+
+    def __init__(self, workers=2, concurrency=1, queue_size=16, max_faces=16, model='hog', upsample=1):
+        self.workers = workers
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.max_faces = max_faces
+        self.model = model
+        self.upsample = upsample
+        self._ready = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._workers = {}  # pid -> _Worker
+        self._pending = {}  # task_id -> (future, slot, worker pid)
+        self._waiting = collections.deque()
+        self._free = []
+        self._slots = []
+        self._closed = False
+
+    def start(self):
+        if not self.workers:
+            return self
+        n_slots = self.workers * self.concurrency
+        slot_size = self.max_faces * (ENCODING_DIM * 8 + 4 * 4)
+        self._slots = [shared_memory.SharedMemory(create=True, size=slot_size) for _ in range(n_slots)]
+        self._views = [_slot_arrays(slot.buf, self.max_faces) for slot in self._slots]
+        self._free = list(range(n_slots))
+        self._context = multiprocessing.get_context()
+        self._wakeup, self._wake = self._context.Pipe(duplex=False)
+        for _ in range(self.workers):
+            self._spawn()
+        self._collector = threading.Thread(target=self._collect, name='inference-results', daemon=True)
+        self._collector.start()
+        return self
+
+    def _spawn(self):
+        tasks = self._context.Queue()
+        results, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main, name='inference-worker', daemon=True,
+            args=(tasks, sender, [slot.name for slot in self._slots], self.max_faces,
+                  self.model, self.upsample, self.concurrency, os.getpid()))
+        process.start()
+        # Only the worker writes to its pipe, so reading it ends once the worker is gone
+        sender.close()
+        with self._lock:
+            self._workers[process.pid] = _Worker(process, tasks, results)
+
+    @property
+    def ready_workers(self):
+        """Workers that have their models loaded"""
+        return len(self._ready)
+
+    def submit(self, data):
+        """Queue encoded image bytes; the future resolves to (boxes, encodings)
+
+        Raises PoolBusy when every slot is taken and queue_size requests
+        are already waiting.
+        """
+        future = concurrent.futures.Future()
+        if not self.workers:
+            try:
+                future.set_result(encode_image(lazy_models.lazy_module('face_recognition'), data,
+                                               self.model, self.upsample, self.max_faces))
+            except Exception as e:
+                future.set_exception(InferenceError(str(e)))
+            return future
+        with self._lock:
+            if self._closed or not self._workers:
+                raise InferenceError("Inference pool is closed or has no workers left")
+            task_id = next(self._ids)
+            if self._free:
+                self._dispatch(task_id, self._free.pop(), data, future)
+            elif len(self._waiting) < self.queue_size:
+                self._waiting.append((task_id, data, future))
+            else:
+                raise PoolBusy(f"{len(self._pending)} queries running and {len(self._waiting)} waiting")
+        return future
+
+    def encode(self, data, timeout=None):
+        """(boxes, encodings) of the faces in encoded image bytes
+
+        Raises InferenceError if no result arrives within timeout seconds.
+        """
+        return wait_result(self.submit(data), timeout)
+
+    def _dispatch(self, task_id, slot, data, future):
+        # Called with the lock held: the least loaded worker takes it, one with its models loaded on a tie
+        pid = min(self._workers, key=lambda pid: (self._workers[pid].load, pid not in self._ready))
+        worker = self._workers[pid]
+        worker.load += 1
+        self._pending[task_id] = (future, slot, pid)
+        worker.tasks.put((task_id, slot, data))
+
+    def _release(self, slot):
+        """Hand a freed slot to the longest waiting request"""
+        with self._lock:
+            if self._waiting and self._workers:
+                task_id, data, future = self._waiting.popleft()
+                self._dispatch(task_id, slot, data, future)
+            else:
+                self._free.append(slot)
+
+    def _finish(self, task_id, kind, payload):
+        with self._lock:
+            entry = self._pending.pop(task_id, None)
+            if entry is not None and entry[2] in self._workers:
+                self._workers[entry[2]].load -= 1
+        if entry is None:
+            return
+        future, slot, _ = entry
+        if kind == 'done':
+            encodings, boxes = self._views[slot]
+            result = ([tuple(box) for box in boxes[:payload].tolist()], list(encodings[:payload].copy()))
+            self._release(slot)
+            future.set_result(result)
+        else:
+            self._release(slot)
+            future.set_exception(InferenceError(payload))
+
+    def _receive(self, pid, worker):
+        """Handle what the worker has sent; False once its pipe is closed"""
+        try:
+            kind, task_id, payload = worker.results.recv()
+        except (EOFError, OSError):
+            return False
+        if kind == 'ready':
+            self._ready.add(pid)
+        else:
+            self._finish(task_id, kind, payload)
+        return True
+
+    def _collect(self):
+        while True:
+            with self._lock:
+                workers = dict(self._workers)
+            waitables = {self._wakeup: None}
+            for pid, worker in workers.items():
+                waitables[worker.results] = pid
+                waitables[worker.process.sentinel] = pid
+            for ready in multiprocessing.connection.wait(list(waitables), timeout=1.0):
+                if ready is self._wakeup:
+                    return
+                pid = waitables[ready]
+                if ready is workers[pid].results:
+                    self._receive(pid, workers[pid])
+            # Checked on every pass, so a dead worker's requests fail even while others keep answering
+            self._replace_dead_workers()
+
+    def _replace_dead_workers(self):
+        for pid, worker in list(self._workers.items()):
+            if worker.process.is_alive() or self._closed:
+                continue
+            # Results it sent before dying still count
+            while worker.results.poll() and self._receive(pid, worker):
+                pass
+            worker.results.close()
+            # Whatever is still queued for it stays unread; don't wait on it at exit
+            worker.tasks.cancel_join_thread()
+            worker.tasks.close()
+            with self._lock:
+                del self._workers[pid]
+            if pid in self._ready:
+                self._ready.discard(pid)
+                print(f"Inference worker {pid} exited with code {worker.process.exitcode}, starting a new one")
+                self._spawn()
+            else:
+                print(f"Inference worker {pid} failed to load the models (exit code {worker.process.exitcode}), not restarting it")
+            with self._lock:
+                # Started or still queued there, its requests are lost
+                lost = [task_id for task_id, entry in self._pending.items() if entry[2] == pid]
+                # With no workers left, nothing would ever run the waiting requests either
+                waiting = self._waiting if not self._workers else ()
+                if not self._workers:
+                    self._waiting = collections.deque()
+            for task_id in lost:
+                self._finish(task_id, 'error', "Inference worker died")
+            for _, _, future in waiting:
+                future.set_exception(InferenceError("No inference workers left"))
+
+    def close(self, timeout=5.0):
+        """Stop the workers and free the shared memory"""
+        with self._lock:
+            if self._closed or not self.workers:
+                self._closed = True
+                return
+            self._closed = True
+            waiting, self._waiting = self._waiting, collections.deque()
+        for _, _, future in waiting:
+            future.set_exception(InferenceError("Inference pool is closed"))
+        for worker in self._workers.values():
+            for _ in range(self.concurrency):
+                worker.tasks.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self._workers.values():
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                worker.process.terminate()
+        self._wake.send('stop')
+        self._collector.join()
+        for worker in self._workers.values():
+            worker.results.close()
+        self._views = []
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
+
+
+# The apps keep one pool per process. A forked child (a serve.py worker) must
+# start its own: the parent's workers answer only the parent's collector.
+_process_lock = threading.Lock()
+_process_pool = {'pool': None, 'pid': None}
+
+
+def _reset_after_fork():
+    global _process_lock
+    # Another thread may have been starting the pool when the process forked
+    _process_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_pool(**settings):
+    """This process's InferencePool, started with settings on first use"""
+    with _process_lock:
+        if _process_pool['pid'] != os.getpid():
+            _process_pool['pool'] = InferencePool(**settings).start()
+            _process_pool['pid'] = os.getpid()
+        return _process_pool['pool']
+
+
+def close_pool():
+    """Stop this process's pool, if it has started one"""
+    with _process_lock:
+        if _process_pool['pid'] == os.getpid():
+            _process_pool['pool'].close()
+            _process_pool.update(pool=None, pid=None)
@@ -0,0 +1,127 @@
+# lazy_models.py
+#
+# Deferred loading of the ML stack.
+#
+# Importing face_recognition loads dlib and reads the weights of every model
+# in face_recognition_models, and cv2 pulls in OpenCV: seconds of start-up
+# and a few hundred MB before the first request. The apps import them
+# through lazy_module(), a stand-in that does the real import on first
+# attribute access, so starting the web process and serving pages that never
+# touch a face (login, gallery, admin) don't pay for it.
+# warm_in_background() loads them once the server is up, so the first search
+# usually finds them warm.
+#
+# `metrics` records how long each import took and how long the first query
+# took, in seconds; they are printed as they come in.
+
+import os
+import time
+import threading
+import importlib
+
+
+def _process_age():
+    """Seconds since this process started, from /proc; None elsewhere"""
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Process start; without /proc the first import of this module stands in for it
+_started = time.perf_counter() - (_process_age() or 0.0)
+_lock = threading.RLock()
+metrics = {'imports': {}, 'app_import': None, 'warm': None, 'first_query': None}
+
+
+class LazyModule:
+    """Stand-in that imports module name on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self._name)
+                    metrics['imports'][self._name] = round(time.perf_counter() - start, 3)
+                    print(f"Loaded {self._name} in {metrics['imports'][self._name]:.2f}s")
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+
+_modules = {}
+
+
+def _reset_after_fork():
+    global _lock
+    # The warm-up thread may have been importing when the process forked
+    _lock = threading.RLock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def lazy_module(name):
+    """The shared stand-in for module name; for face_recognition, the first
+    attribute access is what loads dlib and its models"""
+    with _lock:
+        if name not in _modules:
+            _modules[name] = LazyModule(name)
+        return _modules[name]
+
+
+def loaded():
+    return [name for name, module in _modules.items() if module._module is not None]
+
+
+def warm(names=None):
+    """Import the modules now (all stand-ins handed out so far by default)"""
+    start = time.perf_counter()
+    for name in names or list(_modules):
+        try:
+            lazy_module(name)._load()
+        except Exception as e:
+            print(f"Could not load {name}: {e}")
+    metrics['warm'] = round(time.perf_counter() - start, 3)
+
+
+def warm_in_background(names=None, delay=1.0, reloader=False):
+    """Warm the modules on a thread, delay seconds from now
+
+    Call it right before app.run(); the delay lets the server start
+    accepting connections first. With reloader=True (debug mode) only the
+    reloader's serving child warms, its file-watching parent never serves.
+    """
+    if reloader and not os.environ.get('WERKZEUG_RUN_MAIN'):
+        return None
+    thread = threading.Timer(delay, warm, (names,))
+    thread.daemon = True
+    thread.name = 'model-warm-up'
+    thread.start()
+    return thread
+
+
+def mark_app_imported():
+    """Record the time from process start to the app being importable"""
+    metrics['app_import'] = round(time.perf_counter() - _started, 3)
+    print(f"App imported in {metrics['app_import']:.2f}s")
+
+
+def record_first_query(seconds):
+    """Record the latency of the first query this process served"""
+    with _lock:
+        if metrics['first_query'] is not None:
+            return
+        metrics['first_query'] = round(seconds, 3)
+    print(f"First query took {seconds:.2f}s")
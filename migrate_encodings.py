@@ -0,0 +1,65 @@
+# migrate_encodings.py
+#
+# One-shot conversion of legacy encoding caches to the binary format of
+# encoding_file.py.
+#
+#   python migrate_encodings.py face_encodings.pkl      # -> face_encodings.fenc
+#   python migrate_encodings.py encodings.json out.fenc
+#
+# .pkl files are the {filename: [encoding, ...]} pickles of newapp.py,
+# oldapp.py and deepseekapp.py; encodings.json is the {'images': [...],
+# 'encodings': [...]} file of with_CNN_app.py. Unpickling runs arbitrary
+# code, so only migrate caches you wrote yourself. The photo manifest next
+# to a .pkl cache is copied along, so the next precompute stays incremental.
+
+import os
+import sys
+import json
+import pickle
+import shutil
+
+import encoding_file
+
+
+def read_legacy(path):
+    """Return {filename: [encoding, ...]} from a legacy .pkl or encodings.json"""
+    if path.endswith('.json'):
+        with open(path) as f:
+            data = json.load(f)
+        cache = {}
+        for name, encoding in zip(data.get('images', []), data.get('encodings', [])):
+            cache.setdefault(name, []).append(encoding)
+        return cache
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def migrate(src, dst=None):
+    """Convert src to dst and return the number of photos written"""
+    dst = dst or os.path.splitext(src)[0] + '.fenc'
+    cache = read_legacy(src)
+    encoding_file.write_encodings(dst, cache)
+
+    # Check the result before anyone relies on it
+    converted = encoding_file.read_encodings(dst)
+    for name, encodings in cache.items():
+        if len(encodings) and len(converted.get(name, ())) != len(encodings):
+            raise ValueError(f"{name}: face count changed during migration")
+
+    if os.path.exists(src + '.manifest.json') and not os.path.exists(dst + '.manifest.json'):
+        shutil.copyfile(src + '.manifest.json', dst + '.manifest.json')
+    return len(converted)
+
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python migrate_encodings.py <face_encodings.pkl|encodings.json> [output.fenc]")
+        sys.exit(1)
+    src = sys.argv[1]
+    dst = sys.argv[2] if len(sys.argv) == 3 else None
+    count = migrate(src, dst)
+    print(f"Migrated {count} photos from {src} to {dst or os.path.splitext(src)[0] + '.fenc'}")
+
+
+if __name__ == '__main__':
+    main()
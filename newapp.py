@@ -1,174 +1,219 @@
 import os
-import io
 import base64
-import concurrent.futures
-import pickle
-from functools import lru_cache
+import threading
+import time
 from flask import Flask, render_template, request, jsonify, send_from_directory
-import face_recognition
 import numpy as np
 from PIL import Image
 
+import encoding_file
+import generations
+import inference_pool
+import lazy_models
+import photo_manifest
+import photo_watcher
+import search_engine
+import search_jobs
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config.update({
     'PHOTO_FOLDER': os.path.join(os.getcwd(), 'photos'),
-    'CACHE_FILE': os.path.join(os.getcwd(), 'face_encodings.pkl'),
-    'PROCESSING_STATUS': {
-        'total': 0,
-        'processed': 0,
-        'matches': [],
-        'complete': False,
-        'error': None
-    }
+    'CACHE_FILE': os.path.join(os.getcwd(), 'face_encodings.fenc'),
+    'SEARCH_WORKERS': 4,
+    'JOB_TTL': 600,
+    # Job progress files, so any serve.py worker can answer a job's progress requests
+    'JOBS_DIR': os.path.join(os.getcwd(), '.search_jobs'),
+    'WATCH_PHOTOS': True,
+    # Query encoding processes, requests each handles at once, and how many more may wait
+    'INFERENCE_WORKERS': 2,
+    'INFERENCE_CONCURRENCY': 1,
+    'INFERENCE_QUEUE': 16,
+    # Seconds a search waits for its query encoding before failing
+    'INFERENCE_TIMEOUT': 60
 })
 
+# Searches run as background jobs, each with its own progress record
+search_job_manager = search_jobs.JobManager(
+    max_workers=app.config['SEARCH_WORKERS'], ttl=app.config['JOB_TTL'], directory=app.config['JOBS_DIR'])
+app.register_blueprint(search_jobs.progress_blueprint(search_job_manager))
+
 # Configuration
 FACE_DETECTION_MODEL = 'hog'  # 'hog' (faster) or 'cnn' (more accurate)
 PHOTO_EXTENSIONS = ('.png', '.jpg', '.jpeg')
 
 def precompute_encodings():
-    """Rebuild encodings cache from scratch"""
+    """Bring the encodings cache up to date, encoding only new or changed photos"""
     encodings_cache = {}
     cache_path = app.config['CACHE_FILE']
+    manifest_path = cache_path + '.manifest.json'
+    legacy_path = os.path.splitext(cache_path)[0] + '.pkl'
+    if not os.path.exists(cache_path) and os.path.exists(legacy_path):
+        print(f"Found legacy cache {legacy_path}, run migrate_encodings.py on it to keep its encodings")
     
     try:
-        # Try loading existing cache first
+        # Start from the existing cache
         if os.path.exists(cache_path):
-            with open(cache_path, 'rb') as f:
-                encodings_cache = pickle.load(f)
-                return encodings_cache
+            encodings_cache = encoding_file.read_encodings(cache_path)
     except Exception as e:
         print(f"Cache loading failed, rebuilding: {e}")
+        encodings_cache = {}
+
+    manifest, to_encode, to_drop, full = photo_manifest.plan(
+        app.config['PHOTO_FOLDER'], manifest_path, have_cache=bool(encodings_cache))
+    if full:
+        encodings_cache = {}
+    elif not to_encode and not to_drop:
+        return encodings_cache
 
-    # Rebuild cache
-    for filename in os.listdir(app.config['PHOTO_FOLDER']):
-        if filename.lower().endswith(PHOTO_EXTENSIONS):
-            photo_path = os.path.join(app.config['PHOTO_FOLDER'], filename)
-            try:
-                image = face_recognition.load_image_file(photo_path)
-                face_locations = face_recognition.face_locations(
-                    image, 
-                    model=FACE_DETECTION_MODEL,
-                    number_of_times_to_upsample=1
-                )
-                face_encodings = face_recognition.face_encodings(
-                    image, 
-                    known_face_locations=face_locations
-                )
-                
-                if face_encodings:
-                    encodings_cache[filename] = face_encodings
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-
-    # Save new cache
-    with open(cache_path, 'wb') as f:
-        pickle.dump(encodings_cache, f)
+    for filename in to_drop:
+        encodings_cache.pop(filename, None)
+
+    for filename in to_encode:
+        photo_path = os.path.join(app.config['PHOTO_FOLDER'], filename)
+        try:
+            image = face_recognition.load_image_file(photo_path)
+            face_locations = face_recognition.face_locations(
+                image, 
+                model=FACE_DETECTION_MODEL,
+                number_of_times_to_upsample=1
+            )
+            face_encodings = face_recognition.face_encodings(
+                image, 
+                known_face_locations=face_locations
+            )
+            
+            if face_encodings:
+                encodings_cache[filename] = face_encodings
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+            manifest.pop(filename, None)  # retry on the next run
+
+    # Save updated cache, then the manifest that describes it
+    encoding_file.write_encodings(cache_path, encodings_cache)
+    photo_manifest.save_manifest(manifest_path, app.config['PHOTO_FOLDER'], manifest)
     
     return encodings_cache
 
-@lru_cache(maxsize=1)
+# The published cache and its search matrix, as one copy-on-write generation;
+# searches read whichever generation is current without taking a lock
+search_generation = generations.GenerationHolder()
+precompute_lock = threading.Lock()
+
+def publish_encodings(encodings_cache):
+    """Build the search matrix first, then swap both in at once"""
+    search_generation.publish((encodings_cache, search_engine.stack_encodings(encodings_cache)))
+
+def refresh_encodings():
+    """Encode what changed on disk and publish the result"""
+    with precompute_lock:
+        publish_encodings(precompute_encodings())
+
+def get_search_generation():
+    """The current generation, computing the encodings on first use"""
+    current = search_generation.current
+    if current.value is None:
+        with precompute_lock:
+            if search_generation.current.value is None:
+                publish_encodings(precompute_encodings())
+        current = search_generation.current
+    return current
+
 def get_cached_encodings():
-    """Get cached encodings with app-context awareness"""
-    if 'face_encodings_cache' not in app.config or app.config['face_encodings_cache'] is None:
-        app.config['face_encodings_cache'] = precompute_encodings()
-    return app.config['face_encodings_cache']
+    """Get cached encodings, computing them on first use"""
+    return get_search_generation().value[0]
 
-def process_image(filename, input_encoding):
-    """Process single image for face matching"""
-    try:
-        encodings = get_cached_encodings().get(filename, [])
-        for db_encoding in encodings:
-            if face_recognition.compare_faces(
-                [input_encoding], 
-                db_encoding,
-                tolerance=0.6
-            )[0]:
-                return filename
-        return None
-    except Exception as e:
-        print(f"Error processing {filename}: {e}")
-        return None
+def get_search_matrix():
+    """Stacked encodings of the published cache, for vectorized matching"""
+    return get_search_generation().value[1]
+
+# Hooks for serve.py: encodings are loaded once in the master process and shared by the workers it forks
+def warm_up():
+    """Load the encodings; returns the generation number"""
+    return get_search_generation().number
+
+def index_ready():
+    return search_generation.current.value is not None
+
+# Query images are encoded by long-lived worker processes that keep the models loaded
+def get_inference_pool():
+    return inference_pool.get_pool(
+        workers=app.config['INFERENCE_WORKERS'],
+        concurrency=app.config['INFERENCE_CONCURRENCY'],
+        queue_size=app.config['INFERENCE_QUEUE'])
+
+def worker_started():
+    """serve.py hook: warm the inference pool before the first query arrives"""
+    get_inference_pool()
+
+def worker_stopped():
+    """serve.py hook: stop this worker's inference processes and free their shared memory"""
+    inference_pool.close_pool()
+
+def _reset_after_fork():
+    global precompute_lock
+    # The master's watcher may have been refreshing when it forked
+    precompute_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+# New photos are encoded in the background as they arrive; searches keep using
+# the previous matrix until the new one is published
+def ingest_changed_photos(filenames):
+    print(f"Photo watcher: {len(filenames)} changed photos")
+    refresh_encodings()
+
+if app.config['WATCH_PHOTOS'] and os.path.isdir(app.config['PHOTO_FOLDER']):
+    photo_watcher.DirectoryWatcher(app.config['PHOTO_FOLDER'], ingest_changed_photos).start()
 
 @app.route('/')
 def index():
     return render_template('upload.html')
 
+def run_search(job, encoding):
+    """Search job: wait for the uploaded face's encoding and scan the cache in chunks"""
+    started = time.perf_counter()
+    _, input_encodings = inference_pool.wait_result(encoding, app.config['INFERENCE_TIMEOUT'])
+    if not input_encodings:
+        raise ValueError("No faces detected in uploaded image")
+
+    filenames, matrix, starts = get_search_matrix()
+    lazy_models.record_first_query(time.perf_counter() - started)
+    job.update(total=len(filenames))
+    for processed, matches in search_engine.iter_match_files(
+            filenames, matrix, starts, input_encodings[0], tolerance=0.6):
+        job.update(processed=processed, matches=[
+            os.path.join(app.config['PHOTO_FOLDER'], filename) for filename, _ in matches
+        ])
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    """Handle file upload and initiate processing"""
-    # Reset processing status
-    app.config['PROCESSING_STATUS'] = {
-        'total': 0,
-        'processed': 0,
-        'matches': [],
-        'complete': False,
-        'error': None
-    }
-    
+    """Handle file upload and start a search job"""
     if 'file' not in request.files:
-        app.config['PROCESSING_STATUS']['error'] = "No file uploaded"
-        app.config['PROCESSING_STATUS']['complete'] = True
-        return jsonify(app.config['PROCESSING_STATUS'])
+        return jsonify({'error': "No file uploaded"}), 400
     
     file = request.files['file']
     if file.filename == '':
-        app.config['PROCESSING_STATUS']['error'] = "Empty filename"
-        app.config['PROCESSING_STATUS']['complete'] = True
-        return jsonify(app.config['PROCESSING_STATUS'])
+        return jsonify({'error': "Empty filename"}), 400
     
     try:
-        # Process input image
-        image_data = file.read()
-        image = face_recognition.load_image_file(io.BytesIO(image_data))
-        input_encodings = face_recognition.face_encodings(image)
-        
-        if not input_encodings:
-            app.config['PROCESSING_STATUS']['error'] = "No faces detected in uploaded image"
-            app.config['PROCESSING_STATUS']['complete'] = True
-            return jsonify(app.config['PROCESSING_STATUS'])
-        
-        input_encoding = input_encodings[0]
-        encodings_cache = get_cached_encodings()
-        app.config['PROCESSING_STATUS']['total'] = len(encodings_cache)
-        
-        # Start async processing
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            futures = {
-                executor.submit(process_image, filename, input_encoding): filename
-                for filename in encodings_cache
-            }
-            
-            for future in concurrent.futures.as_completed(futures):
-                app.config['PROCESSING_STATUS']['processed'] += 1
-                result = future.result()
-                if result:
-                    app.config['PROCESSING_STATUS']['matches'].append(
-                        os.path.join(app.config['PHOTO_FOLDER'], result)
-                    )
-        
-        app.config['PROCESSING_STATUS']['complete'] = True
-        return jsonify(app.config['PROCESSING_STATUS'])
-    
-    except Exception as e:
-        app.config['PROCESSING_STATUS']['error'] = str(e)
-        app.config['PROCESSING_STATUS']['complete'] = True
-        return jsonify(app.config['PROCESSING_STATUS'])
-
-@app.route('/progress')
-def get_progress():
-    return jsonify(app.config['PROCESSING_STATUS'])
+        encoding = get_inference_pool().submit(file.read())
+    except inference_pool.PoolBusy:
+        return jsonify({'error': "Too many searches in progress, try again shortly"}), 503, {'Retry-After': '2'}
+    job = search_job_manager.submit(run_search, encoding)
+    return jsonify({'job_id': job.id}), 202
 
 @app.route('/reset-cache')
 def reset_cache():
     """Clear and rebuild face encodings cache"""
     try:
-        if os.path.exists(app.config['CACHE_FILE']):
-            os.remove(app.config['CACHE_FILE'])
-        get_cached_encodings.cache_clear()
-        app.config['face_encodings_cache'] = None
-        precompute_encodings()
+        with precompute_lock:
+            if os.path.exists(app.config['CACHE_FILE']):
+                os.remove(app.config['CACHE_FILE'])
+            publish_encodings(precompute_encodings())
         return jsonify({"status": "Cache reset successfully"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -177,8 +222,8 @@ def reset_cache():
 def serve_photo(filename):
     return send_from_directory(app.config['PHOTO_FOLDER'], filename)
 
+lazy_models.mark_app_imported()
+
 if __name__ == '__main__':
-    # Clear existing caches on startup
-    get_cached_encodings.cache_clear()
-    app.config['face_encodings_cache'] = None
+    lazy_models.warm_in_background(reloader=True)
     app.run(debug=True)
\ No newline at end of file
@@ -1,19 +1,22 @@
 from flask import Flask, render_template, request, jsonify, send_from_directory
-from concurrent.futures import ProcessPoolExecutor  # Or ThreadPoolExecutor
 import multiprocessing
-import face_recognition
 import os
 
-import concurrent.futures
-import pickle
 from functools import lru_cache
 
 import base64
-import io
 import time
 from PIL import Image
 import numpy as np
 
+import encoding_file
+import inference_pool
+import lazy_models
+import photo_manifest
+import search_engine
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
 app = Flask(__name__)
 # PHOTO_FOLDER = "/home/unknown/Pictures/testing/"  # Replace with your actual photo folder
 # PHOTO_FOLDER = "/home/unknown/Pictures/compressed1"  # Replace with your actual photo folder
@@ -24,102 +27,93 @@ PHOTO_FOLDER = "/home/unknown/Pictures/trial_compressed"  # Replace with your ac
 
 # deepseek approach
 # Configuration
-CACHE_FILE = "face_encodings.pkl"
+CACHE_FILE = "face_encodings.fenc"
 PHOTO_EXTENSIONS = ('.png', '.jpg', '.jpeg')
 FACE_DETECTION_MODEL = 'hog'  # Use 'cnn' for better accuracy but slower
+INFERENCE_WORKERS = 2  # Query encoding processes, each keeping the models loaded
+INFERENCE_CONCURRENCY = 1  # Queries each worker process handles at once
+INFERENCE_QUEUE = 16  # Queries that may wait for a worker before new ones are turned away
+INFERENCE_TIMEOUT = 60  # Seconds a query waits for its encoding before failing
 
 def precompute_encodings():
-    """Precompute and cache face encodings for all images"""
+    """Precompute and cache face encodings, encoding only new or changed images"""
+    encodings_cache = {}
+    if not os.path.exists(CACHE_FILE) and os.path.exists("face_encodings.pkl"):
+        print("Found legacy cache face_encodings.pkl, run migrate_encodings.py on it to keep its encodings")
     if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'rb') as f:
-            return pickle.load(f)
+        encodings_cache = encoding_file.read_encodings(CACHE_FILE)
     
-    encodings_cache = {}
+    manifest_path = CACHE_FILE + '.manifest.json'
+    manifest, to_encode, to_drop, full = photo_manifest.plan(
+        PHOTO_FOLDER, manifest_path, have_cache=os.path.exists(CACHE_FILE))
+    if full:
+        encodings_cache = {}
+    elif not to_encode and not to_drop:
+        return encodings_cache
+    
+    for filename in to_drop:
+        encodings_cache.pop(filename, None)
     
-    for filename in os.listdir(PHOTO_FOLDER):
-        if filename.lower().endswith(PHOTO_EXTENSIONS):
-            photo_path = os.path.join(PHOTO_FOLDER, filename)
-            try:
-                image = face_recognition.load_image_file(photo_path)
-                face_locations = face_recognition.face_locations(
-                    image, 
-                    model=FACE_DETECTION_MODEL,
-                    number_of_times_to_upsample=1  # Reduce for faster processing
-                )
-                face_encodings = face_recognition.face_encodings(
-                    image, 
-                    known_face_locations=face_locations
-                )
-                
-                if face_encodings:
-                    encodings_cache[filename] = face_encodings
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
+    for filename in to_encode:
+        photo_path = os.path.join(PHOTO_FOLDER, filename)
+        try:
+            image = face_recognition.load_image_file(photo_path)
+            face_locations = face_recognition.face_locations(
+                image, 
+                model=FACE_DETECTION_MODEL,
+                number_of_times_to_upsample=1  # Reduce for faster processing
+            )
+            face_encodings = face_recognition.face_encodings(
+                image, 
+                known_face_locations=face_locations
+            )
+            
+            if face_encodings:
+                encodings_cache[filename] = face_encodings
+        except Exception as e:
+            print(f"Error processing {filename}: {e}")
+            manifest.pop(filename, None)  # retry on the next run
     
-    with open(CACHE_FILE, 'wb') as f:
-        pickle.dump(encodings_cache, f)
+    encoding_file.write_encodings(CACHE_FILE, encodings_cache)
+    photo_manifest.save_manifest(manifest_path, PHOTO_FOLDER, manifest)
     
     return encodings_cache
 
+def get_inference_pool():
+    return inference_pool.get_pool(
+        workers=INFERENCE_WORKERS, concurrency=INFERENCE_CONCURRENCY, queue_size=INFERENCE_QUEUE)
+
 @lru_cache(maxsize=1)
 def get_cached_encodings():
     """Get cached encodings with LRU caching"""
     return precompute_encodings()
 
-def process_image(filename, input_encoding, tolerance=0.6):
-    """Process a single image for parallel execution"""
-    encodings = get_cached_encodings().get(filename, [])
-    for db_encoding in encodings:
-        if face_recognition.compare_faces(
-            [input_encoding], 
-            db_encoding,
-            tolerance=tolerance
-        )[0]:
-            return filename
-    return None
+@lru_cache(maxsize=1)
+def get_search_matrix():
+    """Stack cached encodings into one matrix for vectorized matching"""
+    return search_engine.stack_encodings(get_cached_encodings())
 
 def find_matching_photos_optimized(input_image_data):
     """Optimized version of face matching function"""
     try:
-        # Decode input image
-        image = face_recognition.load_image_file(io.BytesIO(base64.b64decode(input_image_data)))
-        input_encodings = face_recognition.face_encodings(image)
+        # Decoded and encoded by a warm inference worker
+        _, input_encodings = get_inference_pool().encode(base64.b64decode(input_image_data), INFERENCE_TIMEOUT)
         
         if not input_encodings:
             return []
         
         input_encoding = input_encodings[0]
-        encodings_cache = get_cached_encodings()
-        total_files = len(encodings_cache)
-        
-        print(f"Starting comparison of {total_files} photos...")
+        filenames, matrix, starts = get_search_matrix()
         
-        matches = []
-        processed = 0
-        
-        # Use parallel processing for comparison
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            futures = {
-                executor.submit(
-                    process_image, 
-                    filename, 
-                    input_encoding
-                ): filename for filename in encodings_cache
-            }
-            
-            for future in concurrent.futures.as_completed(futures):
-                processed += 1
-                result = future.result()
-                if result:
-                    matches.append(os.path.join(PHOTO_FOLDER, result))
-                
-                # Update progress every 5% or at least once
-                if processed % max(1, total_files//20) == 0 or processed == total_files:
-                    print(f"Progress: {processed}/{total_files} ({processed/total_files:.0%})", 
-                          end='\r' if processed != total_files else '\n')
+        start_time = time.time()
+        results = search_engine.match_files(filenames, matrix, starts, input_encoding, tolerance=0.6)
+        matches = [os.path.join(PHOTO_FOLDER, filename) for filename, _ in results]
+        print(f"Compared {len(filenames)} photos in {(time.time() - start_time) * 1000:.1f} ms")
         
         return matches
 
+    except inference_pool.PoolBusy:
+        raise
     except Exception as e:
         print(f"Error: {e}")
         return []
@@ -309,7 +303,10 @@ def search_faces():
     if not image_data:
         return jsonify({"error": "No image data provided"}), 400
 
-    matches = find_matching_photos_optimized(image_data)
+    try:
+        matches = find_matching_photos_optimized(image_data)
+    except inference_pool.PoolBusy:
+        return jsonify({"error": "Too many searches in progress, try again shortly"}), 503, {'Retry-After': '2'}
     # matches = find_matching_photos(image_data)
     # return jsonify({"matches": matches})
     image_urls = [f'/images/{os.path.basename(match)}' for match in matches]
@@ -336,5 +333,6 @@ if __name__ == '__main__':
     # total_time = end_time - start_time
     # print(f"Total processing time : {total_time:.2f} seconds")
 
+    lazy_models.warm_in_background(reloader=True)
     app.run(debug=True)
     # app.run(debug=True, use_reloader=False)
\ No newline at end of file
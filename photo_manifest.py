@@ -0,0 +1,117 @@
+# photo_manifest.py
+#
+# Manifest of already-encoded photos, used to make precompute incremental.
+#
+# The manifest maps each filename in the photo directory to its size, mtime
+# and content hash at the time it was encoded. Diffing it against a fresh
+# directory listing tells precompute which files are new, which changed and
+# which were removed, so only those need a pass through the face detector.
+# Files whose size and mtime are unchanged are trusted without re-hashing.
+# The manifest also records the directory it describes, so pointing the app
+# at another directory starts from an empty manifest.
+
+import os
+import json
+import hashlib
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_manifest(path, photo_dir):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except Exception as e:
+        print(f"Manifest {path} unreadable, starting fresh: {e}")
+        return {}
+    if data.get('photo_dir') != os.path.abspath(photo_dir):
+        return {}
+    return data.get('files', {})
+
+
+def save_manifest(path, photo_dir, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'photo_dir': os.path.abspath(photo_dir), 'files': manifest}, f)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _entry(photo_dir, fname, old):
+    """Manifest entry for one file, reusing old's hash if it did not change; None if unreadable"""
+    path = os.path.join(photo_dir, fname)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime_ns:
+        return old
+    try:
+        digest = file_hash(path)
+    except OSError as e:
+        print(f"Error hashing {fname}: {e}")
+        return None
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'hash': digest}
+
+
+def scan(photo_dir, previous=None, extensions=PHOTO_EXTENSIONS):
+    """Build a manifest for photo_dir, reusing hashes of files that did not change"""
+    previous = previous or {}
+    manifest = {}
+    for fname in os.listdir(photo_dir):
+        if not fname.lower().endswith(extensions):
+            continue
+        entry = _entry(photo_dir, fname, previous.get(fname))
+        if entry is not None:
+            manifest[fname] = entry
+    return manifest
+
+
+def rescan(photo_dir, previous, names, extensions=PHOTO_EXTENSIONS):
+    """previous with only the named files looked at again; the others are trusted as they are"""
+    manifest = dict(previous)
+    for fname in names:
+        if not fname.lower().endswith(extensions):
+            continue
+        entry = _entry(photo_dir, fname, previous.get(fname))
+        if entry is None:
+            manifest.pop(fname, None)
+        else:
+            manifest[fname] = entry
+    return manifest
+
+
+def diff(old, new):
+    """Return (added, modified, removed) filenames between two manifests"""
+    added = sorted(f for f in new if f not in old)
+    modified = sorted(f for f in new if f in old and new[f]['hash'] != old[f]['hash'])
+    removed = sorted(f for f in old if f not in new)
+    return added, modified, removed
+
+
+def plan(photo_dir, manifest_path, have_cache=True, extensions=PHOTO_EXTENSIONS, changed=None):
+    """Work out an incremental precompute
+
+    Returns (manifest, to_encode, to_drop, full). to_encode are files that
+    need a detector pass, to_drop are files whose old encodings must be
+    removed (deleted or modified). full is True when there was nothing to
+    build on, in which case the cache should be rewritten from scratch.
+    With changed, a list of filenames known to have changed (e.g. from a
+    directory watcher), only those are looked at instead of the directory.
+    """
+    old = load_manifest(manifest_path, photo_dir) if have_cache else {}
+    if changed is not None and old:
+        new = rescan(photo_dir, old, changed, extensions)
+    else:
+        new = scan(photo_dir, old, extensions)
+    added, modified, removed = diff(old, new)
+    return new, added + modified, modified + removed, not old
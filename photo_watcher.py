@@ -0,0 +1,169 @@
+# photo_watcher.py
+#
+# Background watcher that reports new, changed and removed photos.
+#
+# On Linux the watcher uses inotify through ctypes, so it sleeps until the
+# kernel reports a finished write, a move or a delete in the directory.
+# Elsewhere, or when inotify is unavailable (e.g. out of watches, network
+# filesystems), it falls back to polling the directory every poll_interval
+# seconds and comparing sizes and mtimes.
+#
+# Events are debounced: a camera offload writing hundreds of files triggers
+# one callback once the directory has been quiet for `debounce` seconds (or
+# after max_delay seconds of continuous activity), with the set of changed
+# filenames. If the kernel's event queue overflows, the changes are unknown
+# and the callback gets None instead: the caller rescans the whole directory.
+
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import threading
+
+from photo_manifest import PHOTO_EXTENSIONS
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT = struct.Struct('iIII')
+
+
+def _inotify_fd(directory):
+    """An inotify descriptor watching directory, or None when inotify is unavailable"""
+    if not hasattr(os, 'uname') or os.uname().sysname != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+def _parse_events(buffer):
+    """(filenames, overflowed) from a buffer of inotify events"""
+    names = []
+    overflowed = False
+    offset = 0
+    while offset + _EVENT.size <= len(buffer):
+        _, mask, _, length = _EVENT.unpack_from(buffer, offset)
+        name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+        offset += _EVENT.size + length
+        if mask & IN_Q_OVERFLOW:
+            overflowed = True
+        elif name:
+            names.append(os.fsdecode(name))
+    return names, overflowed
+
+
+def _snapshot(directory, extensions):
+    snapshot = {}
+    for fname in os.listdir(directory):
+        if not fname.lower().endswith(extensions):
+            continue
+        try:
+            st = os.stat(os.path.join(directory, fname))
+        except FileNotFoundError:
+            continue
+        snapshot[fname] = (st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+class DirectoryWatcher:
+    """Calls on_change(filenames) from a background thread when photos in directory change
+
+    filenames is None when events were lost and any photo may have changed.
+    """
+
+    def __init__(self, directory, on_change, debounce=2.0, max_delay=30.0, poll_interval=5.0,
+                 extensions=PHOTO_EXTENSIONS, use_inotify=True):
+        self.directory = directory
+        self.on_change = on_change
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.extensions = extensions
+        self.use_inotify = use_inotify
+        self.mode = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='photo-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        fd = _inotify_fd(self.directory) if self.use_inotify else None
+        self.mode = 'inotify' if fd is not None else 'poll'
+        try:
+            self._loop(fd)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _wait(self, fd, timeout):
+        """(filenames that changed within timeout seconds, whether events were lost)"""
+        if fd is None:
+            if self._stop.wait(timeout):
+                return [], False
+            current = _snapshot(self.directory, self.extensions)
+            changed = {f for f in set(current) | set(self._last) if current.get(f) != self._last.get(f)}
+            self._last = current
+            return list(changed), False
+        readable, _, _ = select.select([fd], [], [], timeout)
+        if not readable:
+            return [], False
+        try:
+            return _parse_events(os.read(fd, 64 * 1024))
+        except BlockingIOError:
+            return [], False
+
+    def _loop(self, fd):
+        self._last = _snapshot(self.directory, self.extensions) if fd is None else {}
+        tick = self.poll_interval if fd is None else 1.0
+        pending = set()
+        rescan = False
+        first = last = 0.0
+        while not self._stop.is_set():
+            timeout = tick if not (pending or rescan) else min(tick, self.debounce)
+            names, overflowed = self._wait(fd, timeout)
+            for fname in names:
+                if fname.lower().endswith(self.extensions) and not fname.startswith('.'):
+                    now = time.monotonic()
+                    if not (pending or rescan):
+                        first = now
+                    pending.add(fname)
+                    last = now
+            if overflowed:
+                # The kernel dropped events; which photos changed is unknown
+                now = time.monotonic()
+                if not (pending or rescan):
+                    first = now
+                rescan = True
+                last = now
+            now = time.monotonic()
+            if (pending or rescan) and (now - last >= self.debounce or now - first >= self.max_delay):
+                changed = None if rescan else sorted(pending)
+                pending, rescan = set(), False
+                try:
+                    self.on_change(changed)
+                except Exception as e:
+                    print(f"Photo watcher callback failed: {e}")
@@ -0,0 +1,248 @@
+# precompute_pipeline.py
+#
+# Staged, multi-process precompute.
+#
+#   decode  threads load JPEG/PNG files into RGB arrays, at most
+#           encode_max_side pixels on the long side (JPEG draft mode)
+#   detect  a process pool (one worker per core) runs face detection on a
+#           copy downscaled to detect_max_side, then encodes the faces on
+#           the decoded image; boxes are reported in original pixels
+#   write   one thread hands results to the caller, who appends them to the
+#           encoding store
+#
+# With crop_dir set, the detect workers also write a face-crop thumbnail of
+# every face they found, from the image they already decoded.
+#
+# With batch_size > 1 and the CNN model, decoded images are grouped by shape
+# and sent to the detector in batches through
+# face_recognition.batch_face_locations, which amortizes the per-call
+# detector overhead. Shapes that never fill a batch fall back to per-image
+# detection.
+#
+# The stages are connected by bounded queues and at most queue_size images
+# are in flight at once, so memory stays flat however large the directory is.
+#
+# If a detect worker dies (e.g. killed for memory) the pool is broken: the
+# files it was working on and every file not yet detected are reported as
+# failed, so the run still ends and they are retried on the next one.
+
+import os
+import time
+import queue
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+import face_crops
+import image_loader
+import lazy_models
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
+_DONE = object()
+
+
+def _encode(fname, image, image_scale, boxes, detect_scale, crops=None):
+    # Boxes were found on the detection image: map them onto the decoded
+    # image for encoding, then onto the original for storage
+    boxes = image_loader.scale_boxes(boxes, detect_scale, image.shape)
+    encodings = face_recognition.face_encodings(image, boxes) if boxes else []
+    if crops is not None:
+        crop_dir, crop_side = crops
+        try:
+            face_crops.save_face_crops(image, boxes, crop_dir, fname, crop_side)
+        except Exception as e:
+            print(f"Could not write face crops of {fname}: {e}")
+    return (fname, image_loader.scale_boxes(boxes, image_scale),
+            [np.asarray(e, dtype=np.float32) for e in encodings], None)
+
+
+def detect_and_encode(fname, image, model='cnn', detect_max_side=None, image_scale=1.0, crops=None):
+    """Worker stage: return (fname, boxes, encodings, error), boxes in original-resolution pixels
+
+    crops is None or (crop_dir, side) to also write face-crop thumbnails.
+    """
+    try:
+        small, detect_scale = image_loader.downscale(image, detect_max_side)
+        boxes = face_recognition.face_locations(small, model=model)
+        return _encode(fname, image, image_scale, boxes, detect_scale, crops)
+    except Exception as e:
+        return fname, [], [], str(e)
+
+
+def detect_and_encode_batch(items, model='cnn', detect_max_side=None, crops=None):
+    """Worker stage for a batch of same-sized images, returns a list of detect_and_encode results"""
+    try:
+        scaled = [image_loader.downscale(image, detect_max_side) for _, image, _ in items]
+        batch_boxes = face_recognition.batch_face_locations(
+            [small for small, _ in scaled], number_of_times_to_upsample=1, batch_size=len(items))
+    except Exception as e:
+        print(f"Batched detection failed, retrying per image: {e}")
+        return [detect_and_encode(fname, image, model, detect_max_side, image_scale, crops)
+                for fname, image, image_scale in items]
+
+    results = []
+    for (fname, image, image_scale), (_, detect_scale), boxes in zip(items, scaled, batch_boxes):
+        try:
+            results.append(_encode(fname, image, image_scale, boxes, detect_scale, crops))
+        except Exception as e:
+            results.append((fname, [], [], str(e)))
+    return results
+
+
+class PipelineStats:
+    """Counters shared between the stages and the progress endpoint"""
+
+    def __init__(self, total):
+        self.total = total
+        self.processed = 0
+        self.failed = 0
+        self.started = time.time()
+
+    def images_per_sec(self):
+        elapsed = time.time() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+
+def run_pipeline(photo_dir, files, handle_result, on_progress=None, on_error=None, workers=None,
+                 decoders=2, queue_size=None, model='cnn', batch_size=1, detect_max_side=1024,
+                 encode_max_side=2048, crop_dir=None, crop_side=face_crops.DEFAULT_SIDE):
+    """Run decode -> detect/encode -> write over files
+
+    handle_result(fname, boxes, encodings) is called on the writer thread for
+    every successfully processed file, in completion order, on_error(fname,
+    message) for every file that failed. on_progress(stats) is called after
+    each file. With crop_dir set, face-crop thumbnails are written there.
+    """
+    workers = workers or os.cpu_count() or 1
+    crops = (crop_dir, crop_side) if crop_dir else None
+    batching = model == 'cnn' and batch_size > 1
+    queue_size = queue_size or workers * 2
+    if batching:
+        # Room for one full batch per worker plus one being filled
+        queue_size = max(queue_size, batch_size * (workers + 1))
+    stats = PipelineStats(len(files))
+    pending = iter(files)
+    pending_lock = threading.Lock()
+    decoded = queue.Queue(maxsize=queue_size)
+    results = queue.Queue()
+    in_flight = threading.BoundedSemaphore(queue_size)
+    broken = []  # why the process pool broke, once it has
+
+    def decode_stage():
+        while True:
+            with pending_lock:
+                fname = next(pending, None)
+            if fname is None:
+                break
+            # Blocks once queue_size images are between decode and write
+            in_flight.acquire()
+            if broken:
+                results.put((fname, [], [], broken[0]))
+                continue
+            try:
+                image, image_scale = image_loader.load_image_scaled(
+                    os.path.join(photo_dir, fname), encode_max_side)
+            except Exception as e:
+                results.put((fname, [], [], str(e)))
+                continue
+            decoded.put((fname, image, image_scale))
+        decoded.put(_DONE)
+
+    def write_stage():
+        while True:
+            item = results.get()
+            if item is _DONE:
+                break
+            fname, boxes, encodings, error = item
+            if error:
+                stats.failed += 1
+                print(f"Error processing {fname}: {error}")
+                if on_error:
+                    on_error(fname, error)
+            else:
+                try:
+                    handle_result(fname, boxes, encodings)
+                except Exception as e:
+                    stats.failed += 1
+                    print(f"Error storing {fname}: {e}")
+            stats.processed += 1
+            in_flight.release()
+            if on_progress:
+                on_progress(stats)
+
+    decoder_threads = [threading.Thread(target=decode_stage, daemon=True) for _ in range(decoders)]
+    writer = threading.Thread(target=write_stage, daemon=True)
+    writer.start()
+    for t in decoder_threads:
+        t.start()
+
+    def deliver_one(future, fname):
+        results.put(future.result() if not future.exception() else (fname, [], [], str(future.exception())))
+
+    def deliver_batch(future, fnames):
+        if future.exception():
+            for fname in fnames:
+                results.put((fname, [], [], str(future.exception())))
+        else:
+            for result in future.result():
+                results.put(result)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        buckets = {}
+
+        def submit(fnames, *args):
+            if not broken:
+                try:
+                    return executor.submit(*args)
+                except BrokenProcessPool as e:
+                    broken.append(f"Detect worker died: {e}")
+                    print(f"Precompute process pool broke, failing the remaining files: {e}")
+            for fname in fnames:
+                results.put((fname, [], [], broken[0]))
+            return None
+
+        def submit_one(fname, image, image_scale):
+            future = submit([fname], detect_and_encode, fname, image, model, detect_max_side, image_scale, crops)
+            if future is not None:
+                future.add_done_callback(lambda f, fname=fname: deliver_one(f, fname))
+
+        def flush(shape):
+            items = buckets.pop(shape)
+            if len(items) == 1:
+                submit_one(*items[0])
+                return
+            fnames = [item[0] for item in items]
+            future = submit(fnames, detect_and_encode_batch, items, model, detect_max_side, crops)
+            if future is not None:
+                future.add_done_callback(lambda f, fnames=fnames: deliver_batch(f, fnames))
+
+        finished_decoders = 0
+        while finished_decoders < len(decoder_threads):
+            try:
+                item = decoded.get(timeout=0.5 if buckets else None)
+            except queue.Empty:
+                # Decoders are starved or blocked on in_flight: don't hold partial batches
+                for shape in list(buckets):
+                    flush(shape)
+                continue
+            if item is _DONE:
+                finished_decoders += 1
+                continue
+            shape = item[1].shape
+            if not batching:
+                submit_one(*item)
+                continue
+            bucket = buckets.setdefault(shape, [])
+            bucket.append(item)
+            if len(bucket) >= batch_size:
+                flush(shape)
+        for shape in list(buckets):
+            flush(shape)
+
+    for t in decoder_threads:
+        t.join()
+    results.put(_DONE)
+    writer.join()
+    return stats
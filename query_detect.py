@@ -0,0 +1,35 @@
+# query_detect.py
+#
+# Tiered face detection for live query captures.
+#
+# A webcam frame usually holds one large, frontal face, which the HOG
+# detector finds on a small copy of the frame in a few milliseconds. The CNN
+# detector is only run when HOG finds nothing (profile faces, poor light).
+# Boxes are always returned in the coordinates of the frame passed in.
+
+import time
+
+import image_loader
+import lazy_models
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
+
+def detect_query_faces(rgb_img, hog_max_side=480, cnn_max_side=800, upsample=1):
+    """Return (boxes, tier, timings_ms); tier is 'hog', 'cnn' or None when no face was found"""
+    timings = {}
+
+    start = time.perf_counter()
+    small, scale = image_loader.downscale(rgb_img, hog_max_side)
+    boxes = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model='hog')
+    timings['hog_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    if boxes:
+        return image_loader.scale_boxes(boxes, scale, rgb_img.shape), 'hog', timings
+
+    start = time.perf_counter()
+    small, scale = image_loader.downscale(rgb_img, cnn_max_side)
+    boxes = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model='cnn')
+    timings['cnn_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    if boxes:
+        return image_loader.scale_boxes(boxes, scale, rgb_img.shape), 'cnn', timings
+    return [], None, timings
@@ -0,0 +1,117 @@
+# result_store.py
+#
+# Server-side store for search results.
+#
+# Search results are kept on the server under a random search ID, so the
+# session cookie only carries that ID. Entries live in an in-process LRU and,
+# when a directory is given, in one JSON file per search so every worker
+# process can resolve an ID created by another. Entries expire after ttl
+# seconds; beyond max_entries the least recently used are dropped.
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+class ResultStore:
+    def __init__(self, directory=None, ttl=3600, max_entries=1000):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._puts = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, search_id):
+        return os.path.join(self.directory, search_id + '.json')
+
+    def put(self, results):
+        """Store results and return their search ID"""
+        search_id = uuid.uuid4().hex
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._entries[search_id] = (expires, results)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._puts += 1
+            prune = self._puts % 100 == 0
+        if self.directory:
+            tmp_path = self._path(search_id) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'expires': expires, 'results': results}, f)
+            os.replace(tmp_path, self._path(search_id))
+            if prune:
+                self.prune()
+        return search_id
+
+    def get(self, search_id):
+        """Return the stored results, or None if the ID is unknown or expired"""
+        if not search_id or not all(c in '0123456789abcdef' for c in search_id):
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(search_id)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(search_id)
+                    return entry[1]
+                del self._entries[search_id]
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(search_id)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data['expires'] <= now:
+            return None
+        try:
+            os.utime(self._path(search_id))  # keeps the disk LRU order
+        except FileNotFoundError:
+            # Another worker expired or pruned it after we read it
+            return None
+        with self._lock:
+            self._entries[search_id] = (data['expires'], data['results'])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return data['results']
+
+    def delete(self, search_id):
+        with self._lock:
+            self._entries.pop(search_id, None)
+        if self.directory and search_id and all(c in '0123456789abcdef' for c in search_id):
+            try:
+                os.remove(self._path(search_id))
+            except FileNotFoundError:
+                pass
+
+    def prune(self):
+        """Remove expired result files and the least recently used beyond max_entries"""
+        now = time.time()
+        files = []
+        for fname in os.listdir(self.directory):
+            if not fname.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, fname)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_mtime + self.ttl < now:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # another worker pruned it first
+            else:
+                files.append((st.st_mtime, path))
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
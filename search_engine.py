@@ -0,0 +1,131 @@
+# search_engine.py
+#
+# Vectorized face matching over a stacked encodings matrix.
+#
+# Instead of comparing the query against every photo one future at a time,
+# all encodings are stacked into one float32 matrix ordered by photo, so a
+# search is a single batched distance computation followed by a grouped min
+# that reduces multi-face photos to their best face.
+#
+# Result selection never sorts the whole store: top_k partitions with
+# argpartition and only sorts the k survivors, after the tolerance filter.
+
+import numpy as np
+
+ENCODING_DIM = 128
+
+
+def stack_encodings(encodings_cache):
+    """Flatten {filename: [encoding, ...]} into (filenames, matrix, starts)
+
+    Faces of the same photo are stored in consecutive rows; starts[i] is the
+    first row of filenames[i].
+    """
+    filenames = []
+    starts = []
+    rows = []
+    for filename, encodings in encodings_cache.items():
+        if len(encodings) == 0:
+            continue
+        filenames.append(filename)
+        starts.append(len(rows))
+        rows.extend(encodings)
+    matrix = np.asarray(rows, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    return filenames, matrix, np.asarray(starts, dtype=np.int64)
+
+
+def face_distances(matrix, query):
+    """Euclidean distance from query to every row, same metric as face_recognition.face_distance"""
+    diff = matrix - np.asarray(query, dtype=np.float32)
+    return np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+
+def batch_face_distances(matrix, queries, chunk_rows=262144):
+    """Q x N distances from every query to every row, as one matrix product per chunk
+
+    Uses |a - b|^2 = |a|^2 - 2ab + |b|^2, so several query faces cost about
+    the same as one: the stored matrix is streamed through memory once.
+    """
+    queries = np.asarray(queries, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    out = np.empty((len(queries), len(matrix)), dtype=np.float32)
+    q_sq = (queries * queries).sum(axis=1)[:, None]
+    for start in range(0, len(matrix), chunk_rows):
+        block = np.asarray(matrix[start:start + chunk_rows], dtype=np.float32)
+        sq = q_sq - 2.0 * (queries @ block.T) + (block * block).sum(axis=1)[None, :]
+        np.sqrt(np.maximum(sq, 0.0), out=out[:, start:start + len(block)])
+    return out
+
+
+def top_k(distances, k):
+    """Indices of the k smallest distances, sorted ascending"""
+    k = min(k, len(distances))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    part = np.argpartition(distances, k - 1)[:k]
+    return part[np.argsort(distances[part], kind='stable')]
+
+
+def select(distances, k=None, tolerance=None):
+    """Indices of the best k distances that are within tolerance, sorted ascending
+
+    k=None keeps every hit, tolerance=None applies no threshold.
+    """
+    hits = np.arange(len(distances)) if tolerance is None else np.flatnonzero(distances <= tolerance)
+    if k is None:
+        return hits[np.argsort(distances[hits], kind='stable')]
+    return hits[top_k(distances[hits], k)]
+
+
+def best_per_photo(distances, photos):
+    """(photos, distances, rows) with the closest face of every photo, for rows in any order
+
+    rows[i] is the position in the input of photo i's closest face.
+    """
+    order = np.argsort(distances, kind='stable')
+    unique, first = np.unique(photos[order], return_index=True)
+    rows = order[first]
+    return unique, distances[rows], rows
+
+
+def top_k_photos(distances, photos, k=10, tolerance=None):
+    """Top k photos by their best face within tolerance
+
+    distances[i] belongs to a face of photo photos[i]; rows may come in any
+    order, e.g. the candidates returned by a face_index. Returns
+    (photos, distances, rows), best first, where rows index the best face
+    of each photo in the input.
+    """
+    unique, best, rows = best_per_photo(np.asarray(distances), np.asarray(photos))
+    keep = select(best, k, tolerance)
+    return unique[keep], best[keep], rows[keep]
+
+
+def grouped_min(distances, starts):
+    """Best (smallest) distance of each photo"""
+    if len(starts) == 0:
+        return np.empty(0, dtype=distances.dtype)
+    return np.minimum.reduceat(distances, starts)
+
+
+def match_files(filenames, matrix, starts, query, tolerance=0.6, k=None):
+    """Return [(filename, distance), ...] for the best k photos with a face within tolerance"""
+    if len(filenames) == 0:
+        return []
+    best = grouped_min(face_distances(matrix, query), starts)
+    hits = select(best, k, tolerance)
+    return [(filenames[i], float(best[i])) for i in hits]
+
+
+def iter_match_files(filenames, matrix, starts, query, tolerance=0.6, chunk_photos=5000):
+    """Like match_files, but scans chunk_photos photos at a time
+
+    Yields (photos_processed, [(filename, distance), ...]) after each chunk,
+    so callers can report progress and partial matches on large stores.
+    """
+    for first in range(0, len(filenames), chunk_photos):
+        last = min(first + chunk_photos, len(filenames))
+        row_start = starts[first]
+        row_end = starts[last] if last < len(filenames) else len(matrix)
+        best = grouped_min(face_distances(matrix[row_start:row_end], query), starts[first:last] - row_start)
+        hits = select(best, None, tolerance)
+        yield last, [(filenames[first + i], float(best[i])) for i in hits]
@@ -0,0 +1,246 @@
+# search_jobs.py
+#
+# Asynchronous search jobs with per-job progress.
+#
+# A search request submits a job and gets its ID back immediately; the work
+# runs on a shared thread pool. Each job has its own progress record, so
+# concurrent users no longer overwrite one global status dict, and clients
+# can follow a job over Server-Sent Events, receiving partial matches as
+# they are found. Finished jobs are garbage-collected after ttl seconds.
+# progress_blueprint() gives an app the /progress routes for its jobs.
+#
+# A job runs in the process that accepted it. When a directory is given,
+# every job also keeps its progress in a JSON file there, so the other
+# worker processes of a preforking server (serve.py) can answer progress
+# polls and event streams for it, like result_store does for results.
+
+import os
+import json
+import time
+import uuid
+import threading
+import concurrent.futures
+
+from flask import Blueprint, Response, jsonify
+
+
+class SearchJob:
+    """Progress of one search, updated by the worker and read by the HTTP side"""
+
+    def __init__(self, job_id, path=None):
+        self.id = job_id
+        self.path = path
+        self.total = 0
+        self.processed = 0
+        self.matches = []
+        self.complete = False
+        self.error = None
+        self.finished_at = None
+        self.version = 0
+        self._changed = threading.Condition()
+        self._save()
+
+    def _save(self):
+        # Called with _changed held, or before the job is shared
+        if self.path is None:
+            return
+        state = dict(self._snapshot(), finished_at=self.finished_at, version=self.version, pid=os.getpid())
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save progress of search job {self.id}: {e}")
+
+    def update(self, processed=None, total=None, matches=()):
+        with self._changed:
+            if total is not None:
+                self.total = total
+            if processed is not None:
+                self.processed = processed
+            self.matches.extend(matches)
+            self.version += 1
+            self._save()
+            self._changed.notify_all()
+
+    def finish(self, error=None):
+        with self._changed:
+            self.error = error
+            self.complete = True
+            self.finished_at = time.time()
+            self.version += 1
+            self._save()
+            self._changed.notify_all()
+
+    def _snapshot(self, since_match=0):
+        return {
+            'job_id': self.id,
+            'total': self.total,
+            'processed': self.processed,
+            'matches': self.matches[since_match:],
+            'match_count': len(self.matches),
+            'complete': self.complete,
+            'error': self.error
+        }
+
+    def snapshot(self, since_match=0):
+        with self._changed:
+            return self._snapshot(since_match)
+
+    def wait_for_change(self, seen_version, timeout):
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != seen_version, timeout)
+            return self.version
+
+
+class StoredJob:
+    """A job running in another process, read from its progress file"""
+
+    def __init__(self, job_id, path, poll_interval=0.2):
+        self.id = job_id
+        self.path = path
+        self.poll_interval = poll_interval
+        self._state = None
+        self._read()
+
+    def _read(self):
+        """The job's saved state, or the last one seen if the file is unreadable"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return self._state
+        if not state['complete']:
+            try:
+                os.kill(state['pid'], 0)
+            except ProcessLookupError:
+                # The process running it exited; it will never finish
+                state.update(complete=True, error="The search was interrupted", version=state['version'] + 1)
+            except PermissionError:
+                pass
+        self._state = state
+        return state
+
+    def snapshot(self, since_match=0):
+        state = self._read()
+        snapshot = {key: state[key] for key in ('job_id', 'total', 'processed', 'complete', 'error')}
+        snapshot.update(matches=state['matches'][since_match:], match_count=len(state['matches']))
+        return snapshot
+
+    def wait_for_change(self, seen_version, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            version = self._read()['version']
+            if version != seen_version or time.monotonic() >= deadline:
+                return version
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+
+class JobManager:
+    def __init__(self, max_workers=4, ttl=600, directory=None):
+        self.ttl = ttl
+        self.directory = directory
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, job_id + '.json') if self.directory else None
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(job, *args, **kwargs) in the background and return the job"""
+        self.collect_garbage()
+        job_id = uuid.uuid4().hex
+        job = SearchJob(job_id, self._path(job_id))
+        with self._lock:
+            self._jobs[job.id] = job
+
+        def run():
+            try:
+                fn(job, *args, **kwargs)
+                job.finish()
+            except Exception as e:
+                print(f"Search job {job.id} failed: {e}")
+                job.finish(str(e))
+
+        self._executor.submit(run)
+        return job
+
+    def get(self, job_id):
+        """The job, a StoredJob if another process runs it, or None if it is unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None or not self.directory:
+            return job
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        job = StoredJob(job_id, self._path(job_id))
+        return job if job._state is not None else None
+
+    def collect_garbage(self):
+        """Forget jobs that finished more than ttl seconds ago"""
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for job_id in [j.id for j in self._jobs.values() if j.complete and j.finished_at < cutoff]:
+                del self._jobs[job_id]
+        if not self.directory:
+            return
+        # Progress files of any process's jobs, untouched for ttl seconds
+        for fname in os.listdir(self.directory):
+            path = os.path.join(self.directory, fname)
+            try:
+                if fname.endswith('.json') and os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass  # another worker collected it first
+
+    def stream(self, job, heartbeat=15):
+        """Yield Server-Sent Events for job until it completes
+
+        Each 'progress' event carries the counters plus the matches found
+        since the previous event; the last event is 'done'.
+        """
+        sent_matches = 0
+        version = -1
+        while True:
+            new_version = job.wait_for_change(version, heartbeat)
+            if new_version == version:
+                yield ': keep-alive\n\n'
+                continue
+            version = new_version
+            snapshot = job.snapshot(sent_matches)
+            sent_matches = snapshot['match_count']
+            event = 'done' if snapshot['complete'] else 'progress'
+            yield f'event: {event}\ndata: {json.dumps(snapshot)}\n\n'
+            if snapshot['complete']:
+                return
+
+
+def progress_blueprint(manager):
+    """Blueprint with the progress routes for manager's jobs
+
+    GET /progress/<job_id> returns the job's snapshot and
+    /progress/<job_id>/events streams it as Server-Sent Events.
+    """
+    blueprint = Blueprint('search_progress', __name__)
+
+    @blueprint.route('/progress/<job_id>')
+    def get_progress(job_id):
+        job = manager.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return jsonify(job.snapshot())
+
+    @blueprint.route('/progress/<job_id>/events')
+    def stream_progress(job_id):
+        """Server-Sent Events with progress and partial matches"""
+        job = manager.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown job'}), 404
+        return Response(manager.stream(job), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    return blueprint
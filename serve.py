@@ -0,0 +1,273 @@
+# serve.py
+#
+# Preforking production server.
+#
+#   python serve.py with_CNN_app:app --workers 4 --bind 0.0.0.0:5000
+#   kill -HUP <master pid>          # graceful reload
+#   kill -USR1 <master pid>         # run the app's master_task() hook
+#
+# The master process imports the app and calls its warm_up() hook, if it has
+# one, before forking the workers. The encoding store is memory-mapped and
+# the index and models loaded by warm_up() sit in the master's memory, so the
+# workers share those pages instead of each loading a copy. Background work
+# started at import (photo watcher, precompute resume) stays in the master;
+# the workers only serve requests.
+#
+# Reloads are graceful: on SIGHUP, or when warm_up() reports a new index
+# version (checked every --reload-interval seconds), the master loads the new
+# index, forks a fresh set of workers on the same listening socket and asks
+# the old ones to finish their in-flight requests and exit.
+#
+# The ML models are not needed to serve pages, so workers start without them
+# (see lazy_models.py). The master then loads them in the background and
+# reloads the workers once more, so they share the warm models too; pass
+# --no-preload-models with a CUDA build of dlib, whose GPU state does not
+# survive fork (each worker then loads the models on first use).
+#
+# An app can define worker_started(), which each worker calls right after it
+# is forked, and worker_stopped(), called once it has drained, e.g. to start
+# and stop per-process helpers such as an inference pool.
+#
+# Workers are replaced on every reload, so work that must outlive a request
+# belongs in the master: an app can define master_task(), which the master
+# runs on a thread when it receives SIGUSR1. A worker asks for it with
+# os.kill(os.getppid(), signal.SIGUSR1). A signal arriving while the task is
+# still running is ignored. Likewise an app can define master_reload(), which
+# the master runs on SIGHUP before it forks the new workers, e.g. to re-read a
+# configuration file a worker has changed; the workers fork from its result.
+#
+# GET /ready answers 200 once the worker has its index (the app's
+# index_ready() hook) and 503 before that or while the worker is draining;
+# the body carries the worker's start-up metrics.
+
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import importlib
+import threading
+
+from werkzeug.serving import make_server
+
+import lazy_models
+
+
+def load_target(target):
+    """Import 'module:attribute' (attribute defaults to app)"""
+    module_name, _, attribute = target.partition(':')
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    module = importlib.import_module(module_name)
+    return module, getattr(module, attribute or 'app')
+
+
+def warm_up(module):
+    """Run the app's warm_up() hook; returns the index version, or None"""
+    hook = getattr(module, 'warm_up', None)
+    if hook is None:
+        return None
+    try:
+        return hook()
+    except Exception as e:
+        print(f"Warm-up failed: {e}")
+        return None
+
+
+class ServingApp:
+    """WSGI wrapper answering /ready in front of the app"""
+
+    def __init__(self, app, module):
+        self.app = app
+        self.index_ready = getattr(module, 'index_ready', lambda: True)
+        self.draining = False
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != '/ready':
+            return self.app(environ, start_response)
+        ready = not self.draining and self.index_ready()
+        body = json.dumps({'ready': ready, 'pid': os.getpid(), 'metrics': lazy_models.metrics}).encode()
+        start_response('200 OK' if ready else '503 Service Unavailable',
+                       [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+        return [body]
+
+
+def run_master_reload(module):
+    hook = getattr(module, 'master_reload', None)
+    if hook is None:
+        return
+    try:
+        hook()
+    except Exception as e:
+        print(f"master_reload() failed: {e}")
+
+
+def run_worker(sock, app, module, args):
+    """Serve on the inherited socket until SIGTERM, then drain and return"""
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the whole group; the master handles it
+    serving = ServingApp(app, module)
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, serving, threaded=args.threads, fd=sock.fileno())
+    # Closing the server then waits for the requests it is handling
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def drain(signum, frame):
+        serving.draining = True
+        threading.Thread(target=server.shutdown, daemon=True).start()
+        # Idle keep-alive connections would hold the worker forever
+        timer = threading.Timer(args.graceful_timeout, os._exit, (0,))
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, drain)
+    if hasattr(module, 'worker_started'):
+        module.worker_started()
+    if not serving.index_ready():
+        # Warm-up failed in the master; keep trying here so /ready can go green
+        threading.Thread(target=warm_up, args=(module,), daemon=True).start()
+    server.serve_forever()
+    if hasattr(module, 'worker_stopped'):
+        module.worker_stopped()
+
+
+def run_master_task(module):
+    try:
+        module.master_task()
+    except Exception as e:
+        print(f"master_task() failed: {e}")
+
+
+def spawn_worker(sock, app, module, args):
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        run_worker(sock, app, module, args)
+    except BaseException as e:
+        print(f"Worker {os.getpid()} failed: {e}")
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Skip the master's exit handlers and thread joins
+        os._exit(status)
+
+
+def stop_workers(pids, timeout):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + timeout
+    while pids and time.monotonic() < deadline:
+        reap(pids)
+        time.sleep(0.1)
+    for pid in pids:
+        os.kill(pid, signal.SIGKILL)
+    while pids:
+        reap(pids)
+        time.sleep(0.1)
+
+
+def reap(pids):
+    """Forget the exited ones among pids; returns them"""
+    exited = []
+    for pid in list(pids):
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            pids.discard(pid)
+            exited.append((pid, status))
+    return exited
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preforking server for the face search apps")
+    parser.add_argument('target', nargs='?', default=os.environ.get('APP_TARGET', 'app:app'),
+                        help="module:attribute of the Flask app")
+    parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--threads', action=argparse.BooleanOptionalAction, default=True,
+                        help="handle each worker's requests in threads")
+    parser.add_argument('--reload-interval', type=float, default=10.0,
+                        help="seconds between index version checks, 0 to reload on SIGHUP only")
+    parser.add_argument('--preload-models', action=argparse.BooleanOptionalAction, default=True,
+                        help="load the ML models in the master and share them with the workers")
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help="seconds a draining worker gets to finish its requests")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    module, app = load_target(args.target)
+    version = warm_up(module)
+    print(f"Loaded {args.target} (index version {version}) in {time.perf_counter() - start:.2f}s")
+
+    host, _, port = args.bind.rpartition(':')
+    sock = socket.create_server((host or '0.0.0.0', int(port)), backlog=1024)
+    workers = {spawn_worker(sock, app, module, args) for _ in range(max(1, args.workers))}
+    draining = set()
+    print(f"Serving on {args.bind} with {len(workers)} workers (master {os.getpid()})")
+
+    warming = lazy_models.warm_in_background(delay=0) if args.preload_models else None
+
+    events = {'reload': False, 'hup': False, 'stop': False, 'task': False}
+    task = None
+    signal.signal(signal.SIGHUP, lambda signum, frame: events.update(reload=True, hup=True))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: events.update(task=True))
+    signal.signal(signal.SIGTERM, lambda signum, frame: events.update(stop=True))
+    signal.signal(signal.SIGINT, lambda signum, frame: events.update(stop=True))
+
+    checked = time.monotonic()
+    while not events['stop']:
+        for pid, status in reap(workers):
+            print(f"Worker {pid} exited with status {status}, starting a new one")
+            workers.add(spawn_worker(sock, app, module, args))
+        reap(draining)
+
+        if events['task']:
+            events['task'] = False
+            if not hasattr(module, 'master_task'):
+                print(f"{args.target} has no master_task(), ignoring SIGUSR1")
+            elif task is not None and task.is_alive():
+                print("master_task() is still running, ignoring SIGUSR1")
+            else:
+                task = threading.Thread(target=run_master_task, args=(module,), name='master-task', daemon=True)
+                task.start()
+        if warming is not None and not warming.is_alive():
+            warming = None
+            if lazy_models.loaded():
+                print(f"Models loaded in {lazy_models.metrics['warm']:.2f}s, reloading workers to share them")
+                events['reload'] = True
+        if args.reload_interval and time.monotonic() - checked >= args.reload_interval:
+            checked = time.monotonic()
+            current = warm_up(module)
+            if current != version:
+                print(f"Index version {version} -> {current}")
+                version = current
+                events['reload'] = True
+        if events['reload']:
+            events['reload'] = False
+            if events['hup']:
+                events['hup'] = False
+                run_master_reload(module)
+            version = warm_up(module)
+            old, workers = workers, {spawn_worker(sock, app, module, args) for _ in range(max(1, args.workers))}
+            for pid in old:
+                os.kill(pid, signal.SIGTERM)
+            draining |= old
+            print(f"Reloaded: {len(workers)} new workers, {len(old)} draining")
+        time.sleep(0.5)
+
+    print("Shutting down")
+    stop_workers(workers | draining, args.graceful_timeout)
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# tests/conftest.py
+#
+# The suite runs without dlib: a stand-in face_recognition module is put in
+# sys.modules before any app module imports it. Worker processes started by
+# fork inherit it. The stand-in finds one face covering each image, and a
+# face's encoding is the image's first pixel value / 255 in every dimension,
+# so tests choose encodings by the colour of the photos they write.
+#
+# Images whose first pixel is CRASH_VALUE make the process encoding them
+# exit, like a worker killed for memory; SLOW_VALUE makes detection take
+# SLOW_SECONDS.
+
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CRASH_VALUE = 255
+SLOW_VALUE = 254
+SLOW_SECONDS = 0.5
+
+
+def _face_locations(image, number_of_times_to_upsample=1, model='hog'):
+    value = int(image[0, 0, 0])
+    if value == CRASH_VALUE:
+        os._exit(3)
+    if value == SLOW_VALUE:
+        time.sleep(SLOW_SECONDS)
+    height, width = image.shape[:2]
+    return [(0, width - 1, height - 1, 0)]
+
+
+def _face_encodings(image, known_face_locations=None, num_jitters=1, model='small'):
+    boxes = _face_locations(image) if known_face_locations is None else known_face_locations
+    return [np.full(128, image[0, 0, 0] / 255.0) for _ in boxes]
+
+
+face_recognition = types.ModuleType('face_recognition')
+face_recognition.load_image_file = lambda file, mode='RGB': np.asarray(Image.open(file).convert(mode))
+face_recognition.face_locations = _face_locations
+face_recognition.face_encodings = _face_encodings
+face_recognition.batch_face_locations = (
+    lambda images, number_of_times_to_upsample=1, batch_size=128: [_face_locations(image) for image in images])
+sys.modules['face_recognition'] = face_recognition
+
+
+def write_photo(path, value, size=(40, 30)):
+    """A solid-colour PNG whose single face encodes to value / 255"""
+    Image.fromarray(np.full((size[1], size[0], 3), value, dtype=np.uint8)).save(path, 'PNG')
+
+
+def encoding_of(value):
+    return np.full(128, value / 255.0, dtype=np.float32)
+
+
+@pytest.fixture
+def photo_dir(tmp_path):
+    path = tmp_path / 'photos'
+    path.mkdir()
+    return path
@@ -0,0 +1,54 @@
+import os
+import io
+import json
+import time
+import base64
+import importlib
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import write_photo
+
+
+@pytest.fixture(scope='module')
+def search_app(tmp_path_factory):
+    # 1app.py reads config.json from the working directory when imported and
+    # its first precompute saves it there
+    home = tmp_path_factory.mktemp('search_app')
+    photos = home / 'photos'
+    photos.mkdir()
+    for name, value in (('near.png', 100), ('close.png', 105), ('far.png', 200)):
+        write_photo(photos / name, value)
+    config_path = home / 'config.json'
+    config_path.write_text(json.dumps({'title': 'Test', 'photo_dir': str(photos)}))
+    cwd = os.getcwd()
+    os.chdir(home)
+    try:
+        module = importlib.import_module('1app')
+        deadline = time.monotonic() + 10
+        while len(json.loads(config_path.read_text()).get('encodings_cache', {})) < 3:
+            assert time.monotonic() < deadline, "precompute did not finish"
+            time.sleep(0.02)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+def _data_url(value):
+    buffer = io.BytesIO()
+    Image.fromarray(np.full((30, 40, 3), value, dtype=np.uint8)).save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(buffer.getvalue()).decode()
+
+
+def test_search_returns_photos_within_tolerance_best_first(search_app):
+    client = search_app.app.test_client()
+    response = client.post('/search', json={'image': _data_url(101)})
+    assert response.get_json() == {'matches': ['near.png', 'close.png']}
+
+
+def test_search_uses_the_published_index(search_app):
+    _, filenames, photos, index = search_app.search_generation.current.value
+    assert sorted(filenames) == ['close.png', 'far.png', 'near.png']
+    assert len(photos) == 3 and index.kind == 'brute'
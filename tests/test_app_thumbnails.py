@@ -0,0 +1,42 @@
+import os
+import json
+import importlib
+
+import pytest
+
+from conftest import write_photo
+
+
+@pytest.fixture(scope='module')
+def photo_app(tmp_path_factory):
+    # app.py reads config.json from the working directory when imported
+    home = tmp_path_factory.mktemp('photo_app')
+    (home / 'uploads').mkdir()
+    (home / 'config.json').write_text(json.dumps({'title': 'Test', 'photo_dir': str(home / 'uploads')}))
+    cwd = os.getcwd()
+    os.chdir(home)
+    try:
+        module = importlib.import_module('app')
+    finally:
+        os.chdir(cwd)
+    write_photo(home / 'uploads' / 'a.png', 10, size=(400, 300))
+    return module
+
+
+def test_thumbnail_service_is_built_once(photo_app):
+    client = photo_app.app.test_client()
+    first = client.get('/photos/thumbnails/a.png')
+    assert first.status_code == 200
+    service = photo_app.get_thumbnail_service()
+    second = client.get('/photos/thumbnails/a.png', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 304
+    assert photo_app.get_thumbnail_service() is service
+    stats = service.get_stats()
+    assert (stats['misses'], stats['hits']) == (1, 1)
+
+
+def test_bad_thumbnail_requests(photo_app):
+    client = photo_app.app.test_client()
+    assert client.get('/photos/thumbnails/a.png?size=poster').status_code == 400
+    assert client.get('/photos/thumbnails/missing.png').status_code == 404
+    assert client.get('/photos/thumbnails/.hidden.png').status_code == 404
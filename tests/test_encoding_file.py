@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+import encoding_file
+import encoding_store
+
+
+def _entries():
+    rng = np.random.default_rng(0)
+    return [
+        ('a.jpg', rng.random((2, 128)).astype(np.float32), [(1, 2, 3, 4), (5, 6, 7, 8)]),
+        ('b.jpg', rng.random((1, 128)).astype(np.float32), [(9, 10, 11, 12)]),
+        ('ü.png', rng.random((3, 128)).astype(np.float32), None),
+    ]
+
+
+def _flip_byte(path, offset):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+
+def _header(path):
+    with open(path, 'rb') as f:
+        return encoding_file.HEADER.unpack_from(f.read(encoding_file.HEADER_SIZE))
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'faces.fenc')
+    entries = _entries()
+    encoding_file.write_file(path, entries)
+
+    loaded = encoding_file.EncodingFile(path)
+    assert loaded.version == encoding_file.FORMAT_VERSION == 2
+    assert loaded.files == ['a.jpg', 'b.jpg', 'ü.png']
+    assert loaded.row_count == 6
+    # The header keeps the first 32 bytes of the encoder name
+    assert loaded.model == encoding_file.DEFAULT_MODEL[:32]
+    assert loaded.row_files().tolist() == [0, 0, 1, 2, 2, 2]
+    assert loaded.row_faces().tolist() == [0, 1, 0, 0, 1, 2]
+    for (name, vectors, boxes), (_, expected, expected_boxes) in zip(loaded.entries(), entries):
+        np.testing.assert_array_equal(vectors, expected)
+        if expected_boxes is None:
+            assert (boxes == -1).all()
+        else:
+            assert boxes.tolist() == [list(box) for box in expected_boxes]
+
+
+def test_sections_are_aligned_for_memory_mapping(tmp_path):
+    path = str(tmp_path / 'faces.fenc')
+    encoding_file.write_file(path, _entries())
+    header = _header(path)
+    names_off, rows_off, vectors_off, boxes_off = header[9], header[10], header[11], header[15]
+    assert all(offset % encoding_file.ALIGN == 0 for offset in (names_off, rows_off, vectors_off, boxes_off))
+
+
+def test_empty_file(tmp_path):
+    path = str(tmp_path / 'faces.fenc')
+    encoding_file.write_file(path, [])
+    loaded = encoding_file.EncodingFile(path)
+    assert loaded.files == [] and loaded.vectors.shape == (0, 128)
+
+
+def test_file_without_boxes(tmp_path):
+    path = str(tmp_path / 'faces.fenc')
+    encoding_file.write_encodings(path, {'a.jpg': [np.zeros(128), np.ones(128)], 'none.jpg': []})
+    loaded = encoding_file.EncodingFile(path)
+    assert loaded.boxes is None
+    cache = encoding_file.read_encodings(path)
+    assert list(cache) == ['a.jpg']
+    assert cache['a.jpg'].shape == (2, 128)
+
+
+def test_damaged_vector_block_keeps_the_photo_list(tmp_path):
+    path = str(tmp_path / 'faces.fenc')
+    encoding_file.write_file(path, _entries())
+    _flip_byte(path, _header(path)[11] + 5)
+
+    with pytest.raises(encoding_file.CorruptEncodingFile, match='vector checksum') as error:
+        encoding_file.EncodingFile(path)
+    assert error.value.files == ['a.jpg', 'b.jpg', 'ü.png']
+    # verify=False skips the checks
+    assert encoding_file.EncodingFile(path, verify=False).row_count == 6
+
+
+@pytest.mark.parametrize('section', ['strings', 'boxes'])
+def test_damaged_metadata(tmp_path, section):
+    path = str(tmp_path / 'faces.fenc')
+    encoding_file.write_file(path, _entries())
+    header = _header(path)
+    _flip_byte(path, header[7] if section == 'strings' else header[15] + 3)
+
+    with pytest.raises(encoding_file.CorruptEncodingFile, match='metadata checksum') as error:
+        encoding_file.EncodingFile(path)
+    assert error.value.files is None
+
+
+def test_truncated_and_foreign_files(tmp_path):
+    path = tmp_path / 'faces.fenc'
+    encoding_file.write_file(str(path), _entries())
+    data = path.read_bytes()
+
+    path.write_bytes(data[:-100])
+    with pytest.raises(encoding_file.CorruptEncodingFile, match='truncated file'):
+        encoding_file.EncodingFile(str(path))
+    path.write_bytes(data[:50])
+    with pytest.raises(encoding_file.CorruptEncodingFile, match='truncated header'):
+        encoding_file.EncodingFile(str(path))
+    path.write_bytes(b'PK' + data[2:])
+    with pytest.raises(encoding_file.CorruptEncodingFile, match='not an encoding file'):
+        encoding_file.EncodingFile(str(path))
+
+
+def test_damaged_shard_photos_are_stale(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    entries = [(f'p{i}.jpg', [np.full(128, i, dtype=np.float32)], [(0, 1, 1, 0)]) for i in range(4)]
+    encoding_store.write_store(prefix, entries, shard_size=2)
+    assert encoding_store.stale_photos(prefix) == []
+
+    shard = tmp_path / 'enc.shards' / encoding_store.read_manifest(prefix)['shards'][1]['file']
+    _flip_byte(str(shard), _header(str(shard))[11])
+    assert sorted(encoding_store.stale_photos(prefix)) == ['p2.jpg', 'p3.jpg']
+    store = encoding_store.load_store(prefix)
+    assert store.corrupt == [shard.name]
+    assert len(store) == 2
+
+
+def test_photos_without_boxes_are_stale(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, [
+        ('old.jpg', [np.zeros(128, dtype=np.float32)]),
+        ('new.jpg', [np.ones(128, dtype=np.float32)], [(0, 1, 1, 0)]),
+    ])
+    assert encoding_store.stale_photos(prefix) == ['old.jpg']
+    store = encoding_store.load_store(prefix)
+    assert store.box(0) is None and store.box(1) == [0, 1, 1, 0]
@@ -0,0 +1,152 @@
+import os
+import time
+
+import numpy as np
+
+import encoding_store
+
+
+def _entries(names, faces=1):
+    return [(name, [np.full(128, i + j / 10, dtype=np.float32) for j in range(faces)], [(0, 9, 9, 0)] * faces)
+            for i, name in enumerate(names)]
+
+
+def _shard_files(prefix):
+    return sorted(name for name in os.listdir(prefix + '.shards') if name.endswith('.fenc'))
+
+
+def _live_photos(prefix):
+    return sorted(set(encoding_store.load_store(prefix).dense()[0]))
+
+
+def test_write_and_load(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    names = [f'p{i}.jpg' for i in range(5)]
+    version = encoding_store.write_store(prefix, _entries(names, faces=2), shard_size=2)
+
+    store = encoding_store.load_store(prefix)
+    assert store.version == version == 1
+    assert len(store.shards) == 3
+    assert len(store) == store.rows == 10
+    assert store.image(7) == 'p3.jpg'
+    assert store.face(7) == 1
+    assert store.box(7) == [0, 9, 9, 0]
+    assert [store.photo_name(p) for p in store.photos([0, 3, 9])] == ['p0.jpg', 'p1.jpg', 'p4.jpg']
+
+
+def test_photos_without_faces_are_left_out(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, _entries(['a.jpg']) + [('empty.jpg', [], [])])
+    assert _live_photos(prefix) == ['a.jpg']
+
+
+def test_drop_tombstones_without_rewriting(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    names = [f'p{i}.jpg' for i in range(4)]
+    encoding_store.write_store(prefix, _entries(names), shard_size=4)
+    files = _shard_files(prefix)
+
+    version = encoding_store.append_store(prefix, ['p1.jpg'], [], shard_size=4)
+    manifest = encoding_store.read_manifest(prefix)
+    assert version == manifest['version'] == 2
+    assert manifest['shards'][0]['deleted'] == ['p1.jpg']
+    assert _shard_files(prefix) == files
+    store = encoding_store.load_store(prefix)
+    assert len(store) == 3 and store.rows == 4
+    assert _live_photos(prefix) == ['p0.jpg', 'p2.jpg', 'p3.jpg']
+
+
+def test_mostly_dead_shard_is_compacted(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    names = [f'p{i}.jpg' for i in range(4)]
+    encoding_store.write_store(prefix, _entries(names), shard_size=4)
+    encoding_store.append_store(prefix, ['p1.jpg'], [], shard_size=4)
+    old_files = _shard_files(prefix)
+
+    # Three of four dead is past COMPACT_RATIO: the live photo is rewritten
+    encoding_store.append_store(prefix, ['p0.jpg', 'p2.jpg'], [], shard_size=4)
+    manifest = encoding_store.read_manifest(prefix)
+    assert [(shard['photos'], shard['deleted']) for shard in manifest['shards']] == [(1, [])]
+    assert not set(_shard_files(prefix)) & set(old_files)
+    store = encoding_store.load_store(prefix)
+    assert len(store) == store.rows == 1
+    assert store.image(0) == 'p3.jpg'
+    assert store.box(0) == [0, 9, 9, 0]
+    np.testing.assert_array_equal(store.shards[0].vectors[0], np.full(128, 3, dtype=np.float32))
+
+
+def test_new_photos_go_to_new_shards(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, _entries(['a.jpg', 'b.jpg']), shard_size=2)
+    files = _shard_files(prefix)
+    encoding_store.append_store(prefix, [], _entries(['c.jpg']), shard_size=2)
+    assert _shard_files(prefix)[:1] == files and len(_shard_files(prefix)) == 2
+    assert _live_photos(prefix) == ['a.jpg', 'b.jpg', 'c.jpg']
+
+
+def test_small_last_shard_is_topped_up(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, _entries(['a.jpg']), shard_size=8)
+    encoding_store.append_store(prefix, [], _entries(['b.jpg']), shard_size=8)
+    encoding_store.append_store(prefix, [], _entries(['c.jpg']), shard_size=8)
+    manifest = encoding_store.read_manifest(prefix)
+    assert [shard['photos'] for shard in manifest['shards']] == [3]
+    assert len(_shard_files(prefix)) == 1
+    assert _live_photos(prefix) == ['a.jpg', 'b.jpg', 'c.jpg']
+
+
+def test_replaced_photo_is_stored_once(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, _entries(['a.jpg', 'b.jpg', 'c.jpg']), shard_size=3)
+    encoding_store.append_store(prefix, ['b.jpg'], [('b.jpg', [np.full(128, 7, dtype=np.float32)], [(1, 1, 1, 1)])],
+                                shard_size=3)
+    images, matrix = encoding_store.load_store(prefix).dense()
+    assert sorted(images) == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert matrix[images.index('b.jpg')][0] == 7
+
+
+def test_get_store_reloads_only_on_change(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, _entries(['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg']), shard_size=2)
+    first = encoding_store.get_store(prefix)
+    assert encoding_store.get_store(prefix) is first
+
+    encoding_store.append_store(prefix, ['a.jpg'], [], shard_size=2)
+    second = encoding_store.get_store(prefix)
+    assert second.version == first.version + 1
+    assert len(second) == 3
+    # Unchanged shards stay mapped from the previous snapshot
+    assert second.shards[1].source is first.shards[1].source
+
+
+def test_writer_lock_is_exclusive(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    writer = encoding_store.lock_writer(prefix)
+    assert writer is not None
+    assert encoding_store.lock_writer(prefix) is None
+    writer.close()
+    again = encoding_store.lock_writer(prefix)
+    assert again is not None
+    again.close()
+
+
+def test_forked_child_does_not_keep_the_writer_lock(tmp_path):
+    prefix = str(tmp_path / 'enc')
+    writer = encoding_store.lock_writer(prefix)
+    started, child_started = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Outlives the parent's write, like a worker forked mid-precompute
+        os.write(child_started, b'.')
+        time.sleep(1)
+        os._exit(0)
+    try:
+        os.read(started, 1)
+        writer.close()
+        again = encoding_store.lock_writer(prefix)
+        assert again is not None
+        again.close()
+    finally:
+        os.waitpid(pid, 0)
+        os.close(started)
+        os.close(child_started)
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+import face_crops
+import precompute_pipeline
+from conftest import write_photo
+
+
+def _two_faces():
+    # Left half dark, right half bright, one face box in each
+    image = np.zeros((200, 400, 3), dtype=np.uint8)
+    image[:, 200:] = 250
+    return image, [(50, 150, 150, 50), (60, 330, 120, 270)]
+
+
+def test_every_face_gets_a_crop(tmp_path):
+    image, boxes = _two_faces()
+    crop_dir = str(tmp_path / 'crops')
+    face_crops.save_face_crops(image, boxes, crop_dir, 'group.jpg', side=64)
+
+    assert sorted(os.listdir(crop_dir)) == sorted(face_crops.crop_name('group.jpg', face) for face in (0, 1))
+    with Image.open(os.path.join(crop_dir, face_crops.crop_name('group.jpg', 0))) as crop:
+        assert max(crop.size) == 64
+        assert crop.convert('L').getpixel((32, 32)) < 10
+    with Image.open(os.path.join(crop_dir, face_crops.crop_name('group.jpg', 1))) as crop:
+        # A 60px face with its margin, clipped to nothing beyond the image
+        assert crop.convert('L').getpixel((crop.size[0] // 2, crop.size[1] // 2)) > 240
+
+
+def test_re_encoded_photo_replaces_its_crops(tmp_path):
+    image, boxes = _two_faces()
+    crop_dir = str(tmp_path / 'crops')
+    face_crops.save_face_crops(image, boxes, crop_dir, 'group.jpg')
+    face_crops.save_face_crops(image, boxes[:1], crop_dir, 'other.jpg')
+
+    face_crops.save_face_crops(image, boxes[1:], crop_dir, 'group.jpg')
+    assert sorted(os.listdir(crop_dir)) == sorted([face_crops.crop_name('group.jpg', 0),
+                                                  face_crops.crop_name('other.jpg', 0)])
+    face_crops.remove_face_crops(crop_dir, 'group.jpg')
+    assert os.listdir(crop_dir) == [face_crops.crop_name('other.jpg', 0)]
+
+
+def test_pipeline_writes_crops_from_the_decoded_image(tmp_path, photo_dir):
+    write_photo(photo_dir / 'a.png', 120, size=(400, 300))
+    crop_dir = str(tmp_path / 'crops')
+    stored = {}
+
+    def store_result(fname, boxes, encodings):
+        stored[fname] = boxes
+
+    precompute_pipeline.run_pipeline(str(photo_dir), ['a.png'], store_result, workers=1,
+                                     crop_dir=crop_dir, crop_side=50)
+
+    assert stored == {'a.png': [(0, 399, 299, 0)]}
+    with Image.open(os.path.join(crop_dir, face_crops.crop_name('a.png', 0))) as crop:
+        assert max(crop.size) == 50
@@ -0,0 +1,179 @@
+import os
+
+import numpy as np
+import pytest
+
+import encoding_store
+import face_index
+from search_engine import face_distances
+
+K = 10
+
+
+def _clustered(n=2000, people=200, seed=0):
+    # Several photos per person, like a real collection
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(scale=0.1, size=(people, 128))
+    return (centers[rng.integers(0, people, n)] + rng.normal(scale=0.03, size=(n, 128))).astype(np.float32)
+
+
+@pytest.fixture(scope='module')
+def data():
+    matrix = _clustered()
+    rng = np.random.default_rng(1)
+    queries = matrix[rng.choice(len(matrix), 50, replace=False)] + rng.normal(scale=0.01, size=(50, 128))
+    queries = queries.astype(np.float32)
+    truth = [set(np.argsort(face_distances(matrix, query))[:K].tolist()) for query in queries]
+    return matrix, queries, truth
+
+
+PARAMS = {'ivf': {'nprobe': 8}, 'hnsw': {'ef': 64}, 'sq': {'rerank': 4}}
+
+
+@pytest.fixture(scope='module')
+def indexes(data):
+    # Built once: the HNSW graph takes a few seconds
+    return {kind: face_index.build_index(kind, data[0], **params) for kind, params in PARAMS.items()}
+
+
+def _recall(results, truth):
+    return np.mean([len(set(ids.tolist()) & expected) / K for (ids, _), expected in zip(results, truth)])
+
+
+def test_brute_force_is_exact(data):
+    matrix, queries, truth = data
+    index = face_index.build_index('brute', matrix)
+    results = index.search_batch(queries, K)
+    assert _recall(results, truth) == 1.0
+    ids, distances = results[0]
+    np.testing.assert_allclose(distances, face_distances(matrix[ids], queries[0]), atol=1e-5)
+    assert (np.diff(distances) >= 0).all()
+
+
+@pytest.mark.parametrize('kind, expected', [('ivf', 0.9), ('hnsw', 0.9), ('sq', 0.95)])
+def test_recall_against_brute_force(data, indexes, kind, expected):
+    matrix, queries, truth = data
+    results = indexes[kind].search_batch(queries, K)
+    assert _recall(results, truth) >= expected
+    # Distances are exact, whatever found the candidates
+    ids, distances = results[0]
+    np.testing.assert_allclose(distances, face_distances(matrix[ids], queries[0]), atol=1e-5)
+
+
+@pytest.mark.parametrize('kind', ['brute', 'ivf', 'hnsw', 'sq'])
+def test_search_batch_agrees_with_search(data, indexes, kind):
+    matrix, queries, _ = data
+    index = indexes.get(kind) or face_index.build_index(kind, matrix)
+    for query, (ids, distances) in zip(queries[:5], index.search_batch(queries[:5], K)):
+        expected_ids, expected_distances = index.search(query, K)
+        assert ids.tolist() == expected_ids.tolist()
+        np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+
+
+def test_unknown_kind_is_refused(data):
+    with pytest.raises(ValueError):
+        face_index.build_index('lsh', data[0])
+
+
+@pytest.mark.parametrize('dtype, fraction', [('int8', 1 / 3), ('float16', 0.6)])
+def test_quantized_index_memory(tmp_path, data, dtype, fraction):
+    matrix, queries, truth = data
+    index = face_index.build_index('sq', matrix, dtype=dtype, chunk_rows=500)
+    assert index.codes.dtype == np.dtype(dtype)
+    assert index.memory_bytes() < matrix.nbytes * fraction
+    assert _recall(index.search_batch(queries, K), truth) >= 0.95
+    path = str(tmp_path / 'index.sq.npz')
+    face_index.save_index(index, path, 1)
+    loaded = face_index.load_or_build_index(path, matrix, 1, 'sq', dtype=dtype)
+    assert loaded.codes.dtype == np.dtype(dtype)
+    with pytest.raises(ValueError):
+        face_index.build_index('sq', matrix, dtype='int4')
+
+
+@pytest.mark.parametrize('kind', ['ivf', 'hnsw', 'sq'])
+def test_saved_index_is_reused(tmp_path, data, indexes, kind):
+    matrix, queries, _ = data
+    path = str(tmp_path / f'index.{kind}.npz')
+    face_index.save_index(indexes[kind], path, 3)
+    loaded = face_index.load_index(path, matrix, 3)
+    assert loaded is not None and loaded.kind == kind
+    for (ids, _), (expected, _) in zip(loaded.search_batch(queries, K), indexes[kind].search_batch(queries, K)):
+        assert ids.tolist() == expected.tolist()
+    assert face_index.load_or_build_index(path, matrix, 3, kind, **PARAMS[kind]).matches(PARAMS[kind])
+    # Another store version, or another number of rows, makes it stale
+    assert face_index.load_index(path, matrix, 4) is None
+    assert face_index.load_index(path, matrix[:-1], 3) is None
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'garbage'])
+def test_damaged_saved_index_is_rebuilt(tmp_path, data, damage):
+    matrix, queries, truth = data
+    path = tmp_path / 'index.ivf.npz'
+    face_index.load_or_build_index(str(path), matrix, 1, 'ivf')
+    content = path.read_bytes()
+    path.write_bytes(content[:len(content) // 2] if damage == 'truncate' else b'PK\x03\x04' + bytes(100))
+
+    assert face_index.load_index(str(path), matrix, 1) is None
+    index = face_index.load_or_build_index(str(path), matrix, 1, 'ivf')
+    assert _recall(index.search_batch(queries, K), truth) >= 0.9
+    assert face_index.load_index(str(path), matrix, 1) is not None
+    assert [p.name for p in tmp_path.iterdir()] == ['index.ivf.npz']
+
+
+def test_search_knobs_are_retuned_without_a_rebuild(tmp_path, data, indexes):
+    matrix = data[0]
+    path = str(tmp_path / 'index.ivf.npz')
+    face_index.save_index(indexes['ivf'], path, 1)
+    index = face_index.load_or_build_index(path, matrix, 1, 'ivf', nprobe=2)
+    assert index.nprobe == 2
+    np.testing.assert_array_equal(index.centroids, indexes['ivf'].centroids)
+
+
+def test_sharded_index_merges_shards_and_skips_tombstones(tmp_path, data):
+    matrix, queries, _ = data
+    prefix = str(tmp_path / 'enc')
+    entries = [(f'p{i}.jpg', [row]) for i, row in enumerate(matrix[:600])]
+    encoding_store.write_store(prefix, entries, shard_size=200)
+    encoding_store.append_store(prefix, ['p5.jpg'], [], shard_size=200)
+    store = encoding_store.load_store(prefix)
+
+    index = face_index.ShardedIndex(store.shards, 'brute')
+    try:
+        ids, distances = index.search(matrix[5], K)
+        assert 5 not in ids.tolist()
+        live = np.delete(np.arange(600), 5)
+        expected = live[np.argsort(face_distances(matrix[live], matrix[5]))[:K]]
+        assert ids.tolist() == expected.tolist()
+        ids, _ = index.search(matrix[450], 1)
+        assert store.image(ids[0]) == 'p450.jpg'
+    finally:
+        index.close()
+
+
+def test_sharded_index_reuses_the_indexes_of_unchanged_shards(tmp_path, data):
+    matrix = data[0]
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, [(f'p{i}.jpg', [row]) for i, row in enumerate(matrix[:400])],
+                               shard_size=200)
+    first = face_index.ShardedIndex(encoding_store.load_store(prefix).shards, 'ivf')
+    encoding_store.append_store(prefix, [], [('new.jpg', [matrix[500]])], shard_size=200)
+    second = face_index.ShardedIndex(encoding_store.load_store(prefix).shards, 'ivf', previous=first)
+    assert second.indexes[:2] == first.indexes
+    assert len(second.indexes) == 3
+    first.close()
+    second.close()
+
+
+def test_sharded_index_searches_in_a_forked_worker(tmp_path, data):
+    matrix = data[0]
+    prefix = str(tmp_path / 'enc')
+    encoding_store.write_store(prefix, [(f'p{i}.jpg', [row]) for i, row in enumerate(matrix[:400])], shard_size=100)
+    index = face_index.ShardedIndex(encoding_store.load_store(prefix).shards, 'brute')
+    expected = index.search(matrix[7], K)[0].tolist()
+
+    # The master's search threads do not exist in the child; it starts its own
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if index.search(matrix[7], K)[0].tolist() == expected else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    index.close()
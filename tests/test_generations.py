@@ -0,0 +1,51 @@
+import gc
+
+import generations
+
+
+class Value:
+    def __init__(self, name):
+        self.name = name
+
+
+def _holder(released):
+    return generations.GenerationHolder(on_release=lambda value: released.append(value.name))
+
+
+def test_reader_keeps_its_generation_until_it_lets_go():
+    released = []
+    holder = _holder(released)
+    holder.publish(Value('first'))
+    reading = holder.current
+
+    holder.publish(Value('second'))
+    assert holder.current.value.name == 'second'
+    assert reading.value.name == 'first'
+    gc.collect()
+    assert released == []
+
+    del reading
+    gc.collect()
+    assert released == ['first']
+
+
+def test_unread_generation_is_released_on_publish():
+    released = []
+    holder = _holder(released)
+    holder.publish(Value('first'))
+    holder.publish(Value('second'))
+    gc.collect()
+    assert released == ['first']
+    # The empty initial generation has nothing to release
+    assert holder.current.number == 2
+
+
+def test_stale_build_is_dropped():
+    released = []
+    holder = _holder(released)
+    slow = holder.begin()
+    fast = holder.begin()
+    assert holder.publish(Value('fast'), fast)
+    assert not holder.publish(Value('slow'), slow)
+    assert holder.current.value.name == 'fast'
+    assert released == ['slow']
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+from flask import Flask
+
+import http_cache
+
+
+@pytest.fixture
+def client(tmp_path):
+    (tmp_path / 'a.jpg').write_bytes(b'first version')
+    app = Flask(__name__)
+
+    @app.route('/photos/<filename>')
+    def photos(filename):
+        return http_cache.send_cached_file(str(tmp_path), filename)
+
+    @app.route('/derived/<filename>')
+    def derived(filename):
+        # Served under the version of another file, like a thumbnail under its photo's
+        return http_cache.send_cached_file(str(tmp_path), filename, version='photo-version')
+
+    return app.test_client()
+
+
+def test_etag_and_not_modified(client):
+    response = client.get('/photos/a.jpg')
+    assert response.status_code == 200
+    assert response.data == b'first version'
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+    assert response.cache_control.max_age == http_cache.DEFAULT_MAX_AGE
+    assert not response.cache_control.immutable
+
+    revalidated = client.get('/photos/a.jpg', headers={'If-None-Match': etag})
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+    by_date = client.get('/photos/a.jpg', headers={'If-Modified-Since': response.headers['Last-Modified']})
+    assert by_date.status_code == 304
+
+
+def test_changed_file_gets_a_new_etag(client, tmp_path):
+    etag = client.get('/photos/a.jpg').headers['ETag']
+    path = tmp_path / 'a.jpg'
+    stat = os.stat(path)
+    path.write_bytes(b'second version')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    response = client.get('/photos/a.jpg', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.data == b'second version'
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_is_the_content_hash(client, tmp_path):
+    (tmp_path / 'b.jpg').write_bytes(b'first version')
+    assert client.get('/photos/a.jpg').headers['ETag'] == client.get('/photos/b.jpg').headers['ETag']
+
+
+def test_current_version_is_immutable(client, tmp_path):
+    version = http_cache.file_version(str(tmp_path / 'a.jpg'))
+    response = client.get(f'/photos/a.jpg?v={version}')
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == http_cache.IMMUTABLE_MAX_AGE
+
+    stale = client.get('/photos/a.jpg?v=0-0')
+    assert not stale.cache_control.immutable
+    assert stale.cache_control.max_age == http_cache.DEFAULT_MAX_AGE
+
+
+def test_derived_file_uses_the_given_version(client, tmp_path):
+    assert client.get('/derived/a.jpg?v=photo-version').cache_control.immutable
+    own_version = http_cache.file_version(str(tmp_path / 'a.jpg'))
+    assert not client.get(f'/derived/a.jpg?v={own_version}').cache_control.immutable
+
+
+def test_missing_and_escaping_paths_are_404(client):
+    assert client.get('/photos/missing.jpg').status_code == 404
+    assert client.get('/photos/..%2Fsecret').status_code == 404
+    assert http_cache.file_version('/nonexistent/file.jpg') is None
@@ -0,0 +1,33 @@
+import numpy as np
+from PIL import Image
+
+import image_loader
+
+
+def test_jpeg_is_decoded_at_reduced_scale(tmp_path):
+    path = tmp_path / 'big.jpg'
+    Image.new('RGB', (1600, 1200), (200, 100, 50)).save(path, 'JPEG')
+
+    image, scale = image_loader.load_image_scaled(str(path), 500)
+    assert image.shape == (375, 500, 3)
+    assert scale == 500 / 1600
+    assert abs(int(image[0, 0, 0]) - 200) <= 2
+
+
+def test_small_or_unbounded_images_are_full_size(tmp_path):
+    path = tmp_path / 'small.png'
+    Image.new('RGB', (40, 30)).save(path, 'PNG')
+    assert image_loader.load_image_scaled(str(path), 500)[0].shape == (30, 40, 3)
+    assert image_loader.load_image_scaled(str(path))[1] == 1.0
+
+
+def test_downscale():
+    assert image_loader.downscale(np.zeros((30, 40, 3), dtype=np.uint8), 100)[1] == 1.0
+    small, scale = image_loader.downscale(np.zeros((300, 400, 3), dtype=np.uint8), 100)
+    assert small.shape == (75, 100, 3) and scale == 0.25
+
+
+def test_scale_boxes_clips_to_the_image():
+    assert image_loader.scale_boxes([(10, 99, 74, 0)], 0.25, (300, 400)) == [(40, 396, 296, 0)]
+    assert image_loader.scale_boxes([(10, 99, 74, 0)], 0.2, (300, 400)) == [(50, 400, 300, 0)]
+    assert image_loader.scale_boxes([(1.0, 2.0, 3.0, 4.0)], 1.0) == [(1, 2, 3, 4)]
@@ -0,0 +1,125 @@
+import io
+import os
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import inference_pool
+from conftest import CRASH_VALUE, SLOW_VALUE, SLOW_SECONDS
+
+
+def _image(value):
+    buffer = io.BytesIO()
+    Image.fromarray(np.full((20, 30, 3), value, dtype=np.uint8)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def _wait_ready(pool, workers, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while pool.ready_workers < workers:
+        assert time.monotonic() < deadline, "workers did not start"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def make_pool():
+    pools = []
+
+    def make(**params):
+        pool = inference_pool.InferencePool(**params).start()
+        pools.append(pool)
+        _wait_ready(pool, params.get('workers', 2))
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.close()
+
+
+def test_encode(make_pool):
+    pool = make_pool(workers=2)
+    boxes, encodings = pool.encode(_image(51), timeout=10)
+    assert boxes == [(0, 29, 19, 0)]
+    np.testing.assert_allclose(encodings[0], np.full(128, 0.2))
+
+
+def test_in_process_fallback():
+    pool = inference_pool.InferencePool(workers=0).start()
+    boxes, encodings = pool.encode(_image(51))
+    assert len(boxes) == len(encodings) == 1
+    with pytest.raises(inference_pool.InferenceError):
+        pool.encode(b'not an image')
+    pool.close()
+
+
+def test_bad_image_fails_that_request_only(make_pool):
+    pool = make_pool(workers=1)
+    with pytest.raises(inference_pool.InferenceError):
+        pool.encode(b'not an image', timeout=10)
+    assert len(pool.encode(_image(3), timeout=10)[1]) == 1
+
+
+def test_full_queue_raises_pool_busy(make_pool):
+    pool = make_pool(workers=1, concurrency=1, queue_size=1)
+    running = pool.submit(_image(SLOW_VALUE))
+    waiting = pool.submit(_image(1))
+    with pytest.raises(inference_pool.PoolBusy):
+        pool.submit(_image(2))
+    assert len(running.result(10)[1]) == 1
+    assert len(waiting.result(10)[1]) == 1
+    # Slots are back once the requests finish
+    assert len(pool.encode(_image(2), timeout=10)[1]) == 1
+
+
+def test_timeout_is_an_inference_error(make_pool):
+    pool = make_pool(workers=1)
+    future = pool.submit(_image(SLOW_VALUE))
+    with pytest.raises(inference_pool.InferenceError, match='No inference result'):
+        inference_pool.wait_result(future, timeout=0.05)
+    assert len(future.result(SLOW_SECONDS * 10)[1]) == 1
+
+
+def test_dead_worker_fails_its_requests_and_is_replaced(make_pool):
+    pool = make_pool(workers=1, concurrency=2, queue_size=4)
+    crashing = pool.submit(_image(CRASH_VALUE))
+    # Handed to the same worker; it dies before answering, started or not
+    queued = pool.submit(_image(SLOW_VALUE))
+    waiting = pool.submit(_image(7))
+
+    with pytest.raises(inference_pool.InferenceError, match='died'):
+        crashing.result(10)
+    with pytest.raises(inference_pool.InferenceError, match='died'):
+        queued.result(10)
+    # Not yet handed to any worker: the replacement runs it
+    assert len(waiting.result(10)[1]) == 1
+    _wait_ready(pool, 1)
+    assert len(pool.encode(_image(9), timeout=10)[1]) == 1
+    assert sorted(pool._free) == [0, 1]
+
+
+def test_dead_worker_is_noticed_while_others_answer(make_pool):
+    pool = make_pool(workers=2, concurrency=1, queue_size=8)
+    crashing = pool.submit(_image(CRASH_VALUE))
+    started = time.monotonic()
+    busy = [pool.submit(_image(i)) for i in range(6)]
+    with pytest.raises(inference_pool.InferenceError):
+        crashing.result(10)
+    assert time.monotonic() - started < 1.0
+    assert all(len(future.result(10)[1]) == 1 for future in busy)
+
+
+def test_one_pool_per_process():
+    pool = inference_pool.get_pool(workers=0)
+    try:
+        assert inference_pool.get_pool(workers=0) is pool
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if inference_pool.get_pool(workers=0) is not pool else 1)
+        _, status = os.waitpid(pid, 0)
+        assert os.waitstatus_to_exitcode(status) == 0
+    finally:
+        inference_pool.close_pool()
+    assert inference_pool.get_pool(workers=0) is not pool
+    inference_pool.close_pool()
@@ -0,0 +1,47 @@
+import sys
+
+import pytest
+
+import lazy_models
+
+
+@pytest.fixture
+def heavy_module(tmp_path, monkeypatch):
+    (tmp_path / 'heavy_stack.py').write_text('VALUE = 42\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, 'heavy_stack', raising=False)
+    monkeypatch.delitem(lazy_models._modules, 'heavy_stack', raising=False)
+    yield 'heavy_stack'
+    lazy_models._modules.pop('heavy_stack', None)
+    sys.modules.pop('heavy_stack', None)
+
+
+def test_import_waits_for_first_use(heavy_module):
+    module = lazy_models.lazy_module(heavy_module)
+    assert lazy_models.lazy_module(heavy_module) is module
+    assert heavy_module not in sys.modules
+    assert heavy_module not in lazy_models.loaded()
+
+    assert module.VALUE == 42
+    assert heavy_module in lazy_models.loaded()
+    assert heavy_module in lazy_models.metrics['imports']
+
+
+def test_warm_loads_in_the_background(heavy_module):
+    lazy_models.lazy_module(heavy_module)
+    lazy_models.warm_in_background([heavy_module], delay=0).join(5)
+    assert heavy_module in sys.modules
+
+
+def test_reloader_parent_does_not_warm(heavy_module, monkeypatch):
+    monkeypatch.delenv('WERKZEUG_RUN_MAIN', raising=False)
+    assert lazy_models.warm_in_background([heavy_module], delay=0, reloader=True) is None
+    monkeypatch.setenv('WERKZEUG_RUN_MAIN', 'true')
+    lazy_models.warm_in_background([heavy_module], delay=0, reloader=True).join(5)
+    assert heavy_module in sys.modules
+
+
+def test_missing_module_does_not_stop_warm_up(heavy_module):
+    lazy_models.warm(['no_such_module_here', heavy_module])
+    assert heavy_module in sys.modules
+    lazy_models._modules.pop('no_such_module_here', None)
@@ -0,0 +1,30 @@
+import json
+import pickle
+
+import numpy as np
+
+import encoding_file
+import migrate_encodings
+
+
+def test_pickle_cache_and_its_manifest_are_migrated(tmp_path):
+    src = tmp_path / 'face_encodings.pkl'
+    cache = {'a.jpg': [np.full(128, 0.5)], 'group.jpg': [np.zeros(128), np.ones(128)], 'none.jpg': []}
+    src.write_bytes(pickle.dumps(cache))
+    (tmp_path / 'face_encodings.pkl.manifest.json').write_text('{"files": {}}')
+
+    assert migrate_encodings.migrate(str(src)) == 2
+    converted = encoding_file.read_encodings(str(tmp_path / 'face_encodings.fenc'))
+    np.testing.assert_array_equal(converted['group.jpg'], np.array(cache['group.jpg'], dtype=np.float32))
+    assert (tmp_path / 'face_encodings.fenc.manifest.json').read_text() == '{"files": {}}'
+
+
+def test_json_store_groups_faces_by_photo(tmp_path):
+    src = tmp_path / 'encodings.json'
+    src.write_text(json.dumps({'images': ['a.jpg', 'a.jpg', 'b.jpg'], 'encodings': [[0.0] * 128, [1.0] * 128, [2.0] * 128]}))
+    dst = tmp_path / 'out.fenc'
+
+    assert migrate_encodings.migrate(str(src), str(dst)) == 2
+    converted = encoding_file.read_encodings(str(dst))
+    assert converted['a.jpg'].shape == (2, 128)
+    assert converted['b.jpg'][0][0] == 2.0
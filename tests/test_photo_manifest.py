@@ -0,0 +1,105 @@
+import os
+
+import photo_manifest
+
+
+def _write(path, content):
+    path.write_bytes(content)
+    return path
+
+
+def _first_run(photo_dir, manifest_path):
+    manifest, to_encode, to_drop, full = photo_manifest.plan(str(photo_dir), manifest_path)
+    photo_manifest.save_manifest(manifest_path, str(photo_dir), manifest)
+    return to_encode, to_drop, full
+
+
+def test_first_run_is_full(tmp_path):
+    photo_dir = tmp_path / 'photos'
+    photo_dir.mkdir()
+    _write(photo_dir / 'a.jpg', b'a')
+    _write(photo_dir / 'b.PNG', b'b')
+    _write(photo_dir / 'notes.txt', b'not a photo')
+
+    to_encode, to_drop, full = _first_run(photo_dir, str(tmp_path / 'manifest.json'))
+    assert full
+    assert sorted(to_encode) == ['a.jpg', 'b.PNG']
+    assert to_drop == []
+
+
+def test_only_changes_are_planned(tmp_path):
+    photo_dir = tmp_path / 'photos'
+    photo_dir.mkdir()
+    manifest_path = str(tmp_path / 'manifest.json')
+    for name in ('same.jpg', 'edited.jpg', 'gone.jpg'):
+        _write(photo_dir / name, name.encode())
+    _first_run(photo_dir, manifest_path)
+
+    (photo_dir / 'gone.jpg').unlink()
+    edited = _write(photo_dir / 'edited.jpg', b'new content')
+    os.utime(edited, ns=(1, 1))
+    _write(photo_dir / 'new.jpg', b'new')
+
+    manifest, to_encode, to_drop, full = photo_manifest.plan(str(photo_dir), manifest_path)
+    assert not full
+    assert to_encode == ['new.jpg', 'edited.jpg']
+    assert to_drop == ['edited.jpg', 'gone.jpg']
+    assert sorted(manifest) == ['edited.jpg', 'new.jpg', 'same.jpg']
+
+
+def test_touched_but_unchanged_file_is_not_re_encoded(tmp_path):
+    photo_dir = tmp_path / 'photos'
+    photo_dir.mkdir()
+    manifest_path = str(tmp_path / 'manifest.json')
+    photo = _write(photo_dir / 'a.jpg', b'a')
+    _first_run(photo_dir, manifest_path)
+
+    os.utime(photo, ns=(1, 1))
+    _, to_encode, to_drop, _ = photo_manifest.plan(str(photo_dir), manifest_path)
+    assert to_encode == to_drop == []
+
+
+def test_another_directory_or_missing_cache_starts_fresh(tmp_path):
+    photo_dir = tmp_path / 'photos'
+    photo_dir.mkdir()
+    manifest_path = str(tmp_path / 'manifest.json')
+    _write(photo_dir / 'a.jpg', b'a')
+    _first_run(photo_dir, manifest_path)
+
+    assert photo_manifest.plan(str(photo_dir), manifest_path, have_cache=False)[3]
+    other = tmp_path / 'other'
+    other.mkdir()
+    assert photo_manifest.load_manifest(manifest_path, str(other)) == {}
+    (tmp_path / 'broken.json').write_text('{')
+    assert photo_manifest.load_manifest(str(tmp_path / 'broken.json'), str(photo_dir)) == {}
+
+
+def test_plan_for_known_changes_looks_at_those_files_only(tmp_path, monkeypatch):
+    photo_dir = tmp_path / 'photos'
+    photo_dir.mkdir()
+    manifest_path = str(tmp_path / 'manifest.json')
+    for name in ('same.jpg', 'edited.jpg', 'gone.jpg', 'unreported.jpg'):
+        _write(photo_dir / name, name.encode())
+    _first_run(photo_dir, manifest_path)
+
+    (photo_dir / 'gone.jpg').unlink()
+    edited = _write(photo_dir / 'edited.jpg', b'new content')
+    os.utime(edited, ns=(1, 1))
+    _write(photo_dir / 'new.jpg', b'new')
+    _write(photo_dir / 'unreported.jpg', b'changed too, but not reported')
+    hashed = []
+    file_hash = photo_manifest.file_hash
+    monkeypatch.setattr(photo_manifest, 'file_hash', lambda path: hashed.append(os.path.basename(path)) or file_hash(path))
+
+    manifest, to_encode, to_drop, full = photo_manifest.plan(
+        str(photo_dir), manifest_path, changed=['new.jpg', 'edited.jpg', 'gone.jpg', 'notes.txt'])
+    assert not full
+    assert to_encode == ['new.jpg', 'edited.jpg']
+    assert to_drop == ['edited.jpg', 'gone.jpg']
+    assert sorted(manifest) == ['edited.jpg', 'new.jpg', 'same.jpg', 'unreported.jpg']
+    assert sorted(hashed) == ['edited.jpg', 'new.jpg']
+
+    # Without a manifest to build on, the whole directory is planned
+    os.remove(manifest_path)
+    _, to_encode, _, full = photo_manifest.plan(str(photo_dir), manifest_path, changed=['new.jpg'])
+    assert full and len(to_encode) == 4
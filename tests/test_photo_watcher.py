@@ -0,0 +1,104 @@
+import queue
+import time
+
+import pytest
+
+import photo_watcher
+from conftest import write_photo
+
+
+@pytest.fixture(params=['poll', 'inotify'])
+def watch(request, photo_dir):
+    watchers = []
+
+    def start(**kwargs):
+        changes = queue.Queue()
+        watcher = photo_watcher.DirectoryWatcher(
+            str(photo_dir), changes.put, poll_interval=0.05, use_inotify=request.param == 'inotify', **kwargs)
+        watchers.append(watcher.start())
+        deadline = time.monotonic() + 5
+        while watcher.mode is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        if request.param == 'inotify' and watcher.mode != 'inotify':
+            pytest.skip("inotify is not available")
+        # Let the watcher take its first snapshot
+        time.sleep(0.1)
+        return changes
+
+    yield start
+    for watcher in watchers:
+        watcher.stop()
+
+
+def test_burst_is_reported_once(watch, photo_dir):
+    changes = watch(debounce=0.5)
+    for i in range(5):
+        write_photo(photo_dir / f'p{i}.png', i)
+        time.sleep(0.05)
+    (photo_dir / 'notes.txt').write_text('not a photo')
+    (photo_dir / '.hidden.png').write_bytes(b'')
+
+    assert changes.get(timeout=5) == [f'p{i}.png' for i in range(5)]
+    time.sleep(0.8)
+    assert changes.empty()
+
+
+def test_removed_photo_is_reported(watch, photo_dir):
+    write_photo(photo_dir / 'old.png', 1)
+    changes = watch(debounce=0.2)
+    (photo_dir / 'old.png').unlink()
+    assert changes.get(timeout=5) == ['old.png']
+
+
+def test_continuous_activity_is_flushed_after_max_delay(watch, photo_dir):
+    changes = watch(debounce=0.5, max_delay=1.0)
+    started = time.monotonic()
+    i = 0
+    while changes.empty() and time.monotonic() - started < 5:
+        write_photo(photo_dir / f'p{i}.png', i % 250)
+        i += 1
+        time.sleep(0.1)
+    # Files keep arriving faster than the debounce, the batch goes out anyway
+    assert time.monotonic() - started < 2.5
+    assert len(changes.get(timeout=1)) >= 5
+
+
+def _event(mask, name=b''):
+    padded = name + b'\0' * (-len(name) % 16) if name else b''
+    return photo_watcher._EVENT.pack(1, mask, 0, len(padded)) + padded
+
+
+def test_parse_events_notices_a_queue_overflow():
+    buffer = _event(photo_watcher.IN_CLOSE_WRITE, b'a.png') + _event(photo_watcher.IN_Q_OVERFLOW)
+    assert photo_watcher._parse_events(buffer) == (['a.png'], True)
+    assert photo_watcher._parse_events(_event(photo_watcher.IN_DELETE, b'b.jpg')) == (['b.jpg'], False)
+
+
+class _ScriptedWatcher(photo_watcher.DirectoryWatcher):
+    """Replays (filenames, overflowed) results instead of reading the directory"""
+
+    def __init__(self, script, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.script = list(script)
+
+    def _run(self):
+        self.mode = 'scripted'
+        self._loop(-1)
+
+    def _wait(self, fd, timeout):
+        names, overflowed = self.script.pop(0) if self.script else ([], False)
+        if not (names or overflowed):
+            self._stop.wait(timeout)
+        return names, overflowed
+
+
+def test_lost_events_ask_for_a_full_rescan(photo_dir):
+    changes = queue.Queue()
+    script = [(['a.png'], False), ([], True), (['b.png'], False), ([], False), (['c.png'], False)]
+    watcher = _ScriptedWatcher(script, str(photo_dir), changes.put, debounce=0.2).start()
+    try:
+        # The overflow swallows the names reported with it
+        assert changes.get(timeout=5) is None
+        assert changes.get(timeout=5) == ['c.png']
+    finally:
+        watcher.stop()
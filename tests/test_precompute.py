@@ -0,0 +1,310 @@
+import os
+import json
+import multiprocessing
+import signal
+
+import pytest
+
+import encoding_store
+import photo_manifest
+import precompute_pipeline
+from conftest import CRASH_VALUE, write_photo
+
+
+@pytest.fixture(scope='module')
+def cnn_app(tmp_path_factory):
+    # with_CNN_app reads config.json from the working directory when imported
+    home = tmp_path_factory.mktemp('app')
+    (home / 'photos').mkdir()
+    (home / 'config.json').write_text(json.dumps({
+        'photo_dir': str(home / 'photos'), 'encodings_store': str(home / 'enc'),
+        'watch_photos': False, 'resume_precompute': False}))
+    cwd = os.getcwd()
+    os.chdir(home)
+    try:
+        import with_CNN_app
+    finally:
+        os.chdir(cwd)
+    return with_CNN_app
+
+
+@pytest.fixture
+def app(cnn_app, tmp_path, photo_dir, monkeypatch):
+    settings = {'photo_dir': str(photo_dir), 'encodings_store': str(tmp_path / 'enc'), 'precompute_workers': 1,
+                'detect_batch_size': 1, 'checkpoint_every': 2, 'checkpoint_seconds': 600}
+    for key, value in settings.items():
+        monkeypatch.setitem(cnn_app.config, key, value)
+    monkeypatch.setitem(cnn_app.photo_watcher_state, 'missed', set())
+    return cnn_app
+
+
+def _stored(prefix):
+    """{photo: first pixel value} of the live faces in the store; every photo has one face"""
+    images, matrix = encoding_store.load_store(prefix).dense()
+    assert len(images) == len(set(images)), "a photo is stored twice"
+    return {name: round(float(row[0]) * 255) for name, row in zip(images, matrix)}
+
+
+def _touch(path, seconds=1):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+def test_first_run_encodes_everything(app, photo_dir):
+    for i in range(5):
+        write_photo(photo_dir / f'p{i}.png', 10 * i + 10)
+    (photo_dir / 'notes.txt').write_text('not a photo')
+
+    assert app.precompute_encodings_with_progress()
+    prefix = app.encodings_store_prefix()
+    assert _stored(prefix) == {f'p{i}.png': 10 * i + 10 for i in range(5)}
+    assert app.precompute_progress['running'] is False
+    assert app.precompute_progress['current'] == app.precompute_progress['total'] == 5
+    assert not os.path.exists(prefix + '.checkpoint.json')
+    # The writer lock was released
+    writer = encoding_store.lock_writer(prefix)
+    assert writer is not None
+    writer.close()
+
+
+def test_incremental_precompute_from_the_manifest(app, photo_dir, monkeypatch):
+    for i in range(4):
+        write_photo(photo_dir / f'p{i}.png', 10 * i + 10)
+    assert app.precompute_encodings_with_progress()
+    prefix = app.encodings_store_prefix()
+
+    write_photo(photo_dir / 'p4.png', 90)
+    write_photo(photo_dir / 'p1.png', 77)
+    _touch(photo_dir / 'p1.png')
+    os.remove(photo_dir / 'p2.png')
+    _touch(photo_dir / 'p3.png')  # touched only: same content, not encoded again
+
+    manifest, files, dropped, full = photo_manifest.plan(str(photo_dir), prefix + '.manifest.json')
+    assert sorted(files) == ['p1.png', 'p4.png']
+    assert sorted(dropped) == ['p1.png', 'p2.png']
+    assert not full
+
+    encoded = []
+    run_pipeline = precompute_pipeline.run_pipeline
+
+    def recording(photo_dir, files, *args, **kwargs):
+        encoded.extend(files)
+        return run_pipeline(photo_dir, files, *args, **kwargs)
+
+    monkeypatch.setattr(precompute_pipeline, 'run_pipeline', recording)
+    assert app.precompute_encodings_with_progress()
+    assert sorted(encoded) == ['p1.png', 'p4.png']
+    assert _stored(prefix) == {'p0.png': 10, 'p1.png': 77, 'p3.png': 40, 'p4.png': 90}
+
+    encoded.clear()
+    assert app.precompute_encodings_with_progress()
+    assert encoded == []
+
+
+def _interrupted_run(app):
+    # Dies right after the second checkpoint reached the store, before the
+    # photo manifest recorded it, like a process killed mid-run
+    save_manifest = photo_manifest.save_manifest
+    saves = []
+
+    def save(path, photo_dir, manifest):
+        saves.append(path)
+        if len(saves) == 2:
+            for child in multiprocessing.active_children():
+                child.kill()
+            os._exit(1)
+        save_manifest(path, photo_dir, manifest)
+
+    photo_manifest.save_manifest = save
+    app.precompute_encodings_with_progress()
+    os._exit(0)
+
+
+def test_interrupted_precompute_resumes(app, photo_dir):
+    for i in range(6):
+        write_photo(photo_dir / f'p{i}.png', 10 * i + 10)
+    prefix = app.encodings_store_prefix()
+
+    process = multiprocessing.get_context('fork').Process(target=_interrupted_run, args=(app,))
+    process.start()
+    process.join(60)
+    assert process.exitcode == 1
+    assert os.path.exists(prefix + '.checkpoint.json')
+    assert len(_stored(prefix)) == 4
+
+    assert app.precompute_encodings_with_progress()
+    assert app.precompute_progress['resumed'] == 2
+    assert app.precompute_progress['total'] == 6
+    # The photos of the unrecorded checkpoint were encoded again, not stored twice
+    assert _stored(prefix) == {f'p{i}.png': 10 * i + 10 for i in range(6)}
+    assert not os.path.exists(prefix + '.checkpoint.json')
+
+
+
+def test_only_one_run_at_a_time(app, photo_dir, monkeypatch):
+    write_photo(photo_dir / 'p0.png', 10)
+    monkeypatch.setitem(app.precompute_progress, 'running', True)
+    assert app.precompute_encodings_with_progress() is False
+    assert encoding_store.read_manifest(app.encodings_store_prefix()) is None
+
+
+def test_another_writer_keeps_the_run_off_the_store(app, photo_dir):
+    write_photo(photo_dir / 'p0.png', 10)
+    writer = encoding_store.lock_writer(app.encodings_store_prefix())
+    try:
+        assert not app.precompute_encodings_with_progress()
+    finally:
+        writer.close()
+    assert app.precompute_progress['running'] is False
+    assert encoding_store.read_manifest(app.encodings_store_prefix()) is None
+
+
+def test_failed_run_releases_the_store(app, photo_dir, monkeypatch):
+    write_photo(photo_dir / 'p0.png', 10)
+
+    def broken(*args, **kwargs):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(precompute_pipeline, 'run_pipeline', broken)
+        with pytest.raises(OSError):
+            app.precompute_encodings_with_progress()
+    assert app.precompute_progress['running'] is False
+    assert 'failed' in app.precompute_progress['message']
+
+    assert app.precompute_encodings_with_progress()
+    assert _stored(app.encodings_store_prefix()) == {'p0.png': 10}
+
+
+def test_dead_detect_worker_fails_the_rest(app, photo_dir):
+    for i in range(4):
+        write_photo(photo_dir / f'p{i}.png', 10 * i + 10)
+    write_photo(photo_dir / 'crash.png', CRASH_VALUE)
+
+    assert app.precompute_encodings_with_progress()
+    assert app.precompute_progress['running'] is False
+    assert 'failed' in app.precompute_progress['message']
+    stored = _stored(app.encodings_store_prefix())
+    assert 'crash.png' not in stored
+
+    # Failed photos are retried on the next run
+    os.remove(photo_dir / 'crash.png')
+    assert app.precompute_encodings_with_progress()
+    assert _stored(app.encodings_store_prefix()) == {f'p{i}.png': 10 * i + 10 for i in range(4)}
+
+
+def test_watcher_gives_up_on_a_busy_store(app, photo_dir, monkeypatch):
+    write_photo(photo_dir / 'p0.png', 10)
+    sleeps = []
+    monkeypatch.setattr(app.time, 'sleep', sleeps.append)
+    monkeypatch.setitem(app.config, 'ingest_retries', 9)
+    writer = encoding_store.lock_writer(app.encodings_store_prefix())
+    try:
+        app.ingest_changed_photos(['p0.png'])
+    finally:
+        writer.close()
+    # Growing pauses, capped at a minute
+    assert sleeps == [1, 2, 4, 8, 16, 32, 60, 60, 60]
+
+    sleeps.clear()
+    app.ingest_changed_photos(['p0.png'])
+    assert sleeps == []
+    assert _stored(app.encodings_store_prefix()) == {'p0.png': 10}
+
+
+def test_lost_watcher_events_rescan_the_directory(app, photo_dir):
+    for i in range(3):
+        write_photo(photo_dir / f'p{i}.png', 10 * i + 10)
+    app.ingest_changed_photos(None)
+    assert _stored(app.encodings_store_prefix()) == {f'p{i}.png': 10 * i + 10 for i in range(3)}
+
+
+def test_reloader_parent_starts_no_background_work(app, monkeypatch):
+    monkeypatch.delenv('WERKZEUG_RUN_MAIN', raising=False)
+    assert not app.reloader_parent()  # imported by a server
+    monkeypatch.setattr(app, '__name__', '__main__')
+    assert app.reloader_parent()
+    monkeypatch.setenv('WERKZEUG_RUN_MAIN', 'true')
+    assert not app.reloader_parent()
+
+
+def test_watcher_runs_plan_only_the_changed_photos(app, photo_dir, monkeypatch):
+    for i in range(2):
+        write_photo(photo_dir / f'p{i}.png', 10 * i + 10)
+    assert app.precompute_encodings_with_progress()
+    write_photo(photo_dir / 'new.png', 100)
+    write_photo(photo_dir / 'unreported.png', 110)
+
+    def verify_everything(prefix):
+        raise AssertionError("a watcher run verified the whole store")
+
+    monkeypatch.setattr(encoding_store, 'stale_photos', verify_everything)
+    app.ingest_changed_photos(['new.png'])
+    assert _stored(app.encodings_store_prefix()) == {'p0.png': 10, 'p1.png': 20, 'new.png': 100}
+
+
+def test_changes_missed_while_busy_are_ingested_next_time(app, photo_dir, monkeypatch):
+    assert app.precompute_encodings_with_progress()
+    write_photo(photo_dir / 'a.png', 10)
+    write_photo(photo_dir / 'b.png', 20)
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+    writer = encoding_store.lock_writer(app.encodings_store_prefix())
+    try:
+        app.ingest_changed_photos(['a.png'])
+    finally:
+        writer.close()
+    app.ingest_changed_photos(['b.png'])
+    assert _stored(app.encodings_store_prefix()) == {'a.png': 10, 'b.png': 20}
+
+
+def test_queries_never_build_an_index(app, photo_dir, monkeypatch):
+    write_photo(photo_dir / 'p0.png', 10)
+    assert app.precompute_encodings_with_progress()
+    # Every checkpoint published its photos
+    published = app.get_index()
+    store, _ = published.value
+    assert store is encoding_store.get_store(app.encodings_store_prefix())
+    assert store.photo_name(0) == 'p0.png'
+
+    # A precompute somewhere else changes the store; queries keep the published generation
+    refresh_index = app.refresh_index
+    monkeypatch.setattr(app, 'refresh_index', lambda: None)
+    write_photo(photo_dir / 'p1.png', 20)
+    assert app.precompute_encodings_with_progress()
+
+    def build(*args, **kwargs):
+        raise AssertionError("a query built an index")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(app.face_index, 'ShardedIndex', build)
+        assert app.get_index() is published
+    assert len(refresh_index().value[0]) == 2
+    assert app.get_index().value[0] is encoding_store.get_store(app.encodings_store_prefix())
+
+
+def test_admin_change_under_serve_is_applied_by_the_master(app, tmp_path, monkeypatch):
+    new_dir = tmp_path / 'new_photos'
+    new_dir.mkdir()
+    monkeypatch.setattr(app, 'CONFIG_FILE', str(tmp_path / 'config.json'))
+    monkeypatch.setitem(app.config, 'title', 'Old title')
+    monkeypatch.setitem(app.serve_master, 'pid', os.getpid())
+    started = []
+    monkeypatch.setattr(app, 'start_photo_watcher', lambda: started.append(app.config['photo_dir']))
+    hangups = []
+    previous = signal.signal(signal.SIGHUP, lambda signum, frame: hangups.append(signum))
+    try:
+        client = app.app.test_client()
+        with client.session_transaction() as session:
+            session['logged_in'] = True
+        response = client.post('/admin', data={'title': 'New title', 'photo_dir': str(new_dir)})
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+    assert response.status_code == 302
+    # The worker only saved the file and signalled the master
+    assert hangups == [signal.SIGHUP] and started == []
+    assert json.loads((tmp_path / 'config.json').read_text())['photo_dir'] == str(new_dir)
+
+    monkeypatch.setitem(app.config, 'photo_dir', 'stale')
+    app.master_reload()
+    assert app.config['title'] == 'New title'
+    assert started == [str(new_dir)]
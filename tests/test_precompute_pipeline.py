@@ -0,0 +1,87 @@
+import numpy as np
+
+import precompute_pipeline
+from conftest import CRASH_VALUE, encoding_of, write_photo
+
+
+def _run(photo_dir, files, **kwargs):
+    stored = {}
+    errors = {}
+    progress = []
+    stats = precompute_pipeline.run_pipeline(
+        str(photo_dir), files,
+        lambda fname, boxes, encodings: stored.__setitem__(fname, (boxes, encodings)),
+        on_progress=lambda stats: progress.append(stats.processed),
+        on_error=errors.__setitem__, workers=2, **kwargs)
+    return stats, stored, errors, progress
+
+
+def test_every_file_is_encoded(photo_dir):
+    files = [f'p{i}.png' for i in range(6)]
+    for i, name in enumerate(files):
+        write_photo(photo_dir / name, 10 * i)
+
+    stats, stored, errors, progress = _run(photo_dir, files)
+    assert sorted(stored) == files and errors == {}
+    assert stats.processed == 6 and stats.failed == 0
+    assert progress == [1, 2, 3, 4, 5, 6]
+    boxes, encodings = stored['p3.png']
+    assert boxes == [(0, 39, 29, 0)]
+    np.testing.assert_allclose(encodings[0], encoding_of(30))
+
+
+def test_unreadable_file_fails_only_itself(photo_dir):
+    write_photo(photo_dir / 'good.png', 20)
+    (photo_dir / 'broken.jpg').write_bytes(b'not an image')
+
+    stats, stored, errors, _ = _run(photo_dir, ['broken.jpg', 'good.png', 'missing.jpg'])
+    assert sorted(stored) == ['good.png']
+    assert sorted(errors) == ['broken.jpg', 'missing.jpg']
+    assert stats.processed == 3 and stats.failed == 2
+
+
+
+def test_dead_worker_fails_the_remaining_files(photo_dir):
+    files = ['crash.png'] + [f'p{i}.png' for i in range(4)]
+    write_photo(photo_dir / 'crash.png', CRASH_VALUE)
+    for i, name in enumerate(files[1:]):
+        write_photo(photo_dir / name, 10 * i)
+
+    stats, stored, errors, progress = _run(photo_dir, files)
+    assert 'crash.png' in errors
+    # Every file is accounted for, none twice
+    assert sorted(set(stored) | set(errors)) == sorted(files)
+    assert not set(stored) & set(errors)
+    assert stats.processed == len(files) == progress[-1]
+    assert stats.failed == len(errors)
+
+
+def test_batched_detection_maps_boxes_back():
+    items = [(f'p{i}.png', np.full((300, 400, 3), 10 * i, dtype=np.uint8), 1.0) for i in range(3)]
+    results = precompute_pipeline.detect_and_encode_batch(items, detect_max_side=100)
+    for i, (fname, boxes, encodings, error) in enumerate(results):
+        assert fname == f'p{i}.png' and error is None
+        # Found on a 100 x 75 copy, reported on the 400 x 300 original
+        assert boxes == [(0, 396, 296, 0)]
+        np.testing.assert_allclose(encodings[0], encoding_of(10 * i))
+
+
+def test_batched_pipeline_encodes_every_file(photo_dir):
+    files = [f'p{i}.png' for i in range(5)]
+    for i, name in enumerate(files):
+        write_photo(photo_dir / name, 10 * i)
+
+    stats, stored, errors, _ = _run(photo_dir, files, batch_size=2)
+    assert sorted(stored) == files and errors == {}
+    for i, name in enumerate(files):
+        np.testing.assert_allclose(stored[name][1][0], encoding_of(10 * i))
+
+
+
+def test_boxes_are_reported_on_the_original(photo_dir):
+    write_photo(photo_dir / 'big.png', 40, size=(800, 600))
+
+    _, stored, errors, _ = _run(photo_dir, ['big.png'], detect_max_side=100, encode_max_side=400)
+    assert errors == {}
+    # Detected at 100 x 75, encoded at 400 x 300, stored for 800 x 600
+    assert stored['big.png'][0] == [(0, 792, 592, 0)]
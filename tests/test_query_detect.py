@@ -0,0 +1,45 @@
+import numpy as np
+
+import query_detect
+
+
+def _detector(found_by, box=(10, 90, 70, 30)):
+    calls = []
+
+    def face_locations(image, number_of_times_to_upsample=1, model='hog'):
+        calls.append((model, image.shape[:2]))
+        return [box] if model in found_by else []
+    return face_locations, calls
+
+
+def _frame():
+    return np.zeros((600, 800, 3), dtype=np.uint8)
+
+
+def test_hog_face_skips_cnn(monkeypatch):
+    face_locations, calls = _detector({'hog'})
+    monkeypatch.setattr(query_detect.face_recognition, 'face_locations', face_locations)
+
+    boxes, tier, timings = query_detect.detect_query_faces(_frame(), hog_max_side=400)
+    assert tier == 'hog'
+    assert calls == [('hog', (300, 400))]
+    # Found on the half-size copy, returned in frame coordinates
+    assert boxes == [(20, 180, 140, 60)]
+    assert set(timings) == {'hog_ms'}
+
+
+def test_cnn_runs_only_when_hog_finds_nothing(monkeypatch):
+    face_locations, calls = _detector({'cnn'})
+    monkeypatch.setattr(query_detect.face_recognition, 'face_locations', face_locations)
+
+    boxes, tier, timings = query_detect.detect_query_faces(_frame(), hog_max_side=400, cnn_max_side=800)
+    assert tier == 'cnn'
+    assert calls == [('hog', (300, 400)), ('cnn', (600, 800))]
+    assert boxes == [(10, 90, 70, 30)]
+    assert set(timings) == {'hog_ms', 'cnn_ms'}
+
+
+def test_no_face(monkeypatch):
+    face_locations, _ = _detector(set())
+    monkeypatch.setattr(query_detect.face_recognition, 'face_locations', face_locations)
+    assert query_detect.detect_query_faces(_frame())[:2] == ([], None)
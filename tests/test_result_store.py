@@ -0,0 +1,114 @@
+import os
+import time
+
+import result_store
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+def test_results_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_store.time, 'time', clock)
+    store = result_store.ResultStore(ttl=60)
+    search_id = store.put([['a.jpg', 0.3]])
+    assert store.get(search_id) == [['a.jpg', 0.3]]
+
+    clock.now += 61
+    assert store.get(search_id) is None
+
+
+def test_least_recently_used_is_dropped():
+    store = result_store.ResultStore(max_entries=2)
+    first = store.put(['first'])
+    second = store.put(['second'])
+    store.get(first)
+    store.put(['third'])
+    assert store.get(first) == ['first']
+    assert store.get(second) is None
+
+
+def test_unknown_and_malformed_ids():
+    store = result_store.ResultStore()
+    assert store.get(None) is None
+    assert store.get('0' * 32) is None
+    assert store.get('../config') is None
+
+
+def test_another_process_resolves_the_id(tmp_path):
+    directory = str(tmp_path / 'results')
+    search_id = result_store.ResultStore(directory).put([['a.jpg', 0.3]])
+    other = result_store.ResultStore(directory)
+    assert other.get(search_id) == [['a.jpg', 0.3]]
+
+    other.delete(search_id)
+    assert result_store.ResultStore(directory).get(search_id) is None
+
+
+def test_expired_file_is_a_miss(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_store.time, 'time', clock)
+    directory = str(tmp_path / 'results')
+    search_id = result_store.ResultStore(directory, ttl=60).put(['old'])
+    clock.now += 61
+    assert result_store.ResultStore(directory, ttl=60).get(search_id) is None
+
+
+def test_prune_removes_expired_and_least_recently_used(tmp_path):
+    directory = str(tmp_path / 'results')
+    store = result_store.ResultStore(directory, ttl=60, max_entries=2)
+    ids = [store.put([name]) for name in ('expired', 'old', 'kept', 'newest')]
+    now = time.time()
+    os.utime(os.path.join(directory, ids[0] + '.json'), (now - 120, now - 120))
+    for age, search_id in zip((30, 20, 10), ids[1:]):
+        os.utime(os.path.join(directory, search_id + '.json'), (now - age, now - age))
+
+    store.prune()
+    assert sorted(os.listdir(directory)) == sorted(search_id + '.json' for search_id in ids[2:])
+
+
+class OtherWorkerRemoves:
+    """Stands in for result_store's os module. Another worker removes the file
+    just before this process calls one of `before`, or just after `after`"""
+
+    def __init__(self, before=(), after=()):
+        self.before = before
+        self.after = after
+
+    def __getattr__(self, name):
+        func = getattr(os, name)
+        if name not in self.before + self.after:
+            return func
+
+        def racing(path, *args, **kwargs):
+            if name in self.before:
+                os.remove(path)
+            result = func(path, *args, **kwargs)
+            if name in self.after:
+                os.remove(path)
+            return result
+        return racing
+
+
+def test_file_removed_by_another_worker_is_a_miss(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'results')
+    search_id = result_store.ResultStore(directory).put(['a.jpg'])
+    monkeypatch.setattr(result_store, 'os', OtherWorkerRemoves(before=('utime',)))
+    assert result_store.ResultStore(directory).get(search_id) is None
+
+
+def test_prune_races_with_another_worker(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'results')
+    store = result_store.ResultStore(directory, ttl=60, max_entries=1)
+    ids = [store.put([name]) for name in ('expired', 'old', 'newest')]
+    now = time.time()
+    for age, search_id in zip((120, 20, 10), ids):
+        os.utime(os.path.join(directory, search_id + '.json'), (now - age, now - age))
+    monkeypatch.setattr(result_store, 'os', OtherWorkerRemoves(after=('stat',)))
+    store.prune()
+    assert os.listdir(directory) == []
@@ -0,0 +1,86 @@
+import numpy as np
+
+import search_engine
+
+
+def _encoding(value):
+    return np.full(128, value, dtype=np.float32)
+
+
+def test_stack_encodings_skips_photos_without_faces():
+    filenames, matrix, starts = search_engine.stack_encodings({
+        'a.jpg': [_encoding(0), _encoding(1)],
+        'empty.jpg': [],
+        'b.jpg': [_encoding(2)],
+    })
+    assert filenames == ['a.jpg', 'b.jpg']
+    assert matrix.shape == (3, 128) and matrix.dtype == np.float32
+    assert starts.tolist() == [0, 2]
+
+
+def test_face_distances_match_the_reference_metric():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(50, 128)).astype(np.float32)
+    query = rng.normal(size=128).astype(np.float32)
+    expected = np.linalg.norm(matrix - query, axis=1)
+    np.testing.assert_allclose(search_engine.face_distances(matrix, query), expected, rtol=1e-5)
+
+
+def test_batch_face_distances_in_chunks():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(50, 128)).astype(np.float32)
+    queries = rng.normal(size=(3, 128)).astype(np.float32)
+    distances = search_engine.batch_face_distances(matrix, queries, chunk_rows=16)
+    assert distances.shape == (3, 50)
+    for query, row in zip(queries, distances):
+        np.testing.assert_allclose(row, search_engine.face_distances(matrix, query), atol=1e-4)
+
+
+def test_match_files_uses_each_photos_best_face():
+    filenames, matrix, starts = search_engine.stack_encodings({
+        'far.jpg': [_encoding(1)],
+        'group.jpg': [_encoding(1), _encoding(0.01)],
+        'close.jpg': [_encoding(0.02)],
+    })
+    matches = search_engine.match_files(filenames, matrix, starts, _encoding(0), tolerance=0.6)
+    assert [name for name, _ in matches] == ['group.jpg', 'close.jpg']
+    assert abs(matches[0][1] - np.sqrt(128) * 0.01) < 1e-5
+
+
+def test_match_files_on_an_empty_cache():
+    filenames, matrix, starts = search_engine.stack_encodings({})
+    assert search_engine.match_files(filenames, matrix, starts, _encoding(0)) == []
+
+
+def test_top_k_matches_a_full_sort():
+    distances = np.random.default_rng(0).random(1000).astype(np.float32)
+    assert search_engine.top_k(distances, 10).tolist() == np.argsort(distances)[:10].tolist()
+    assert search_engine.top_k(distances[:3], 10).tolist() == np.argsort(distances[:3]).tolist()
+    assert search_engine.top_k(distances, 0).tolist() == []
+
+
+def test_select_applies_tolerance_then_k():
+    distances = np.array([0.5, 0.1, 0.7, 0.3, 0.2], dtype=np.float32)
+    assert search_engine.select(distances, 2, 0.6).tolist() == [1, 4]
+    assert search_engine.select(distances, None, 0.4).tolist() == [1, 4, 3]
+    assert search_engine.select(distances, 10, 0.05).tolist() == []
+
+
+def test_top_k_photos_reduces_each_photo_to_its_best_face():
+    # Candidate rows in index order, several faces per photo
+    photos = np.array([7, 3, 7, 5, 3, 9])
+    distances = np.array([0.4, 0.5, 0.1, 0.3, 0.2, 0.8], dtype=np.float32)
+
+    best_photos, best, rows = search_engine.top_k_photos(distances, photos, k=2)
+    assert best_photos.tolist() == [7, 3]
+    np.testing.assert_allclose(best, [0.1, 0.2])
+    # The row of each photo's best face, for its face number and box
+    assert rows.tolist() == [2, 4]
+
+    best_photos, best, _ = search_engine.top_k_photos(distances, photos, k=10, tolerance=0.6)
+    assert best_photos.tolist() == [7, 3, 5]
+
+
+def test_top_k_photos_with_no_candidates():
+    best_photos, best, rows = search_engine.top_k_photos(np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64))
+    assert len(best_photos) == len(best) == len(rows) == 0
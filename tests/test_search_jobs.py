@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import threading
+
+import numpy as np
+from flask import Flask
+
+import search_engine
+import search_jobs
+
+
+def _events(stream):
+    for chunk in stream:
+        if chunk.startswith(':'):
+            continue
+        event, data = chunk.strip().split('\n')
+        yield event[len('event: '):], json.loads(data[len('data: '):])
+
+
+def test_job_reports_progress_and_matches():
+    manager = search_jobs.JobManager(max_workers=1)
+
+    def search(job, names):
+        job.update(processed=0, total=len(names))
+        for i, name in enumerate(names, 1):
+            job.update(processed=i, matches=[[name, 0.1 * i]])
+
+    job = manager.submit(search, ['a.jpg', 'b.jpg'])
+    events = list(_events(manager.stream(job)))
+    assert events[-1][0] == 'done'
+    final = manager.get(job.id).snapshot()
+    assert (final['total'], final['processed'], final['complete'], final['error']) == (2, 2, True, None)
+    # Each match is sent once, in the event after it was found
+    assert [match[0] for _, data in events for match in data['matches']] == ['a.jpg', 'b.jpg']
+
+
+def test_stream_sends_partial_matches_while_running():
+    manager = search_jobs.JobManager(max_workers=1)
+    step = threading.Event()
+
+    def search(job):
+        job.update(processed=1, total=2, matches=[['a.jpg', 0.2]])
+        step.wait(5)
+        job.update(processed=2, matches=[['b.jpg', 0.3]])
+
+    job = manager.submit(search)
+    events = []
+    for event in _events(manager.stream(job, heartbeat=0.05)):
+        events.append(event)
+        if event[1]['matches'] == [['a.jpg', 0.2]]:
+            # The first match arrived before the search could finish
+            assert event[0] == 'progress'
+            step.set()
+    assert events[-1][0] == 'done'
+    assert [m for _, data in events for m in data['matches']] == [['a.jpg', 0.2], ['b.jpg', 0.3]]
+
+
+def test_failed_job_reports_its_error():
+    manager = search_jobs.JobManager(max_workers=1)
+
+    def search(job):
+        raise RuntimeError('no faces in the query image')
+
+    job = manager.submit(search)
+    events = list(_events(manager.stream(job)))
+    assert events[-1][0] == 'done'
+    assert events[-1][1]['error'] == 'no faces in the query image'
+
+
+def test_finished_jobs_are_collected_after_ttl():
+    manager = search_jobs.JobManager(max_workers=1, ttl=0)
+    job = manager.submit(lambda job: None)
+    list(_events(manager.stream(job)))
+    manager.collect_garbage()
+    assert manager.get(job.id) is None
+
+
+def test_progress_routes():
+    manager = search_jobs.JobManager(max_workers=1)
+    app = Flask(__name__)
+    app.register_blueprint(search_jobs.progress_blueprint(manager))
+    client = app.test_client()
+    job = manager.submit(lambda job: job.update(processed=1, total=1, matches=[['a.jpg', 0.2]]))
+
+    response = client.get(f'/progress/{job.id}/events')
+    assert response.mimetype == 'text/event-stream'
+    events = list(_events(chunk.decode() for chunk in response.iter_encoded()))
+    assert events[-1][0] == 'done'
+    assert client.get(f'/progress/{job.id}').get_json()['matches'] == [['a.jpg', 0.2]]
+    assert client.get('/progress/unknown').status_code == 404
+    assert client.get('/progress/unknown/events').status_code == 404
+
+
+def test_iter_match_files_chunks_agree_with_match_files():
+    rng = np.random.default_rng(0)
+    cache = {f'p{i}.jpg': list(rng.normal(scale=0.05, size=(1 + i % 3, 128))) for i in range(50)}
+    filenames, matrix, starts = search_engine.stack_encodings(cache)
+    query = np.zeros(128, dtype=np.float32)
+
+    chunks = list(search_engine.iter_match_files(filenames, matrix, starts, query, tolerance=0.6, chunk_photos=7))
+    assert [processed for processed, _ in chunks] == [7, 14, 21, 28, 35, 42, 49, 50]
+    found = sorted(match for _, matches in chunks for match in matches)
+    assert found == sorted(search_engine.match_files(filenames, matrix, starts, query, tolerance=0.6))
+
+
+def test_other_workers_follow_a_job_through_its_file(tmp_path):
+    directory = str(tmp_path / 'jobs')
+    owner = search_jobs.JobManager(max_workers=1, directory=directory)
+    # Another serve.py worker: same directory, none of the owner's jobs in memory
+    other = search_jobs.JobManager(max_workers=1, directory=directory)
+    step = threading.Event()
+
+    def search(job):
+        job.update(processed=1, total=2, matches=[['a.jpg', 0.2]])
+        step.wait(5)
+        job.update(processed=2, matches=[['b.jpg', 0.3]])
+
+    job = owner.submit(search)
+    stored = other.get(job.id)
+    assert isinstance(stored, search_jobs.StoredJob)
+    stored.poll_interval = 0.01
+    events = []
+    for event in _events(other.stream(stored, heartbeat=0.05)):
+        events.append(event)
+        if event[1]['matches'] == [['a.jpg', 0.2]]:
+            step.set()
+    assert events[-1][0] == 'done'
+    assert [m for _, data in events for m in data['matches']] == [['a.jpg', 0.2], ['b.jpg', 0.3]]
+    assert other.get(job.id).snapshot() == owner.get(job.id).snapshot()
+    assert other.get('0' * 32) is None and other.get('../etc') is None
+
+
+def test_job_of_a_dead_worker_ends_with_an_error(tmp_path):
+    directory = str(tmp_path / 'jobs')
+    os.makedirs(directory)
+    pid = os.fork()
+    if pid == 0:
+        # Accepted a search, then died before finishing it
+        search_jobs.SearchJob('ab' * 16, os.path.join(directory, 'ab' * 16 + '.json'))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    job = search_jobs.JobManager(max_workers=1, directory=directory).get('ab' * 16)
+    snapshot = job.snapshot()
+    assert snapshot['complete'] and snapshot['error']
+
+
+def test_old_job_files_are_collected(tmp_path):
+    directory = str(tmp_path / 'jobs')
+    manager = search_jobs.JobManager(max_workers=1, ttl=60, directory=directory)
+    job = manager.submit(lambda job: None)
+    list(_events(manager.stream(job)))
+    path = os.path.join(directory, job.id + '.json')
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    manager.collect_garbage()
+    assert os.listdir(directory) == []
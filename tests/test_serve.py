@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import signal
+import socket
+import subprocess
+import sys
+import urllib.error
+import urllib.request
+
+import pytest
+
+SERVE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'serve.py')
+
+APP = '''
+import os
+from flask import Flask
+
+app = Flask(__name__)
+loaded = {'version': None}
+
+
+def warm_up():
+    loaded['version'] = 1
+    return 1
+
+
+def index_ready():
+    return loaded['version'] is not None
+
+
+def master_task():
+    with open('master_task.pid', 'w') as f:
+        f.write(str(os.getpid()))
+
+
+def master_reload():
+    with open('master_reload.pid', 'w') as f:
+        f.write(str(os.getpid()))
+
+
+@app.route('/pid')
+def pid():
+    return str(os.getpid())
+'''
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _get(port, path):
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=5) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def _worker_pids(port, requests=20):
+    return {int(_get(port, '/pid')[1]) for _ in range(requests)}
+
+
+@pytest.fixture
+def server(tmp_path):
+    (tmp_path / 'tiny_app.py').write_text(APP)
+    port = _free_port()
+    process = subprocess.Popen([sys.executable, SERVE, 'tiny_app:app', '--workers', '2', '--bind', f'127.0.0.1:{port}',
+                                '--reload-interval', '0'], cwd=tmp_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            if _get(port, '/ready')[0] == 200:
+                break
+        except OSError:
+            pass
+        assert time.monotonic() < deadline, "server did not become ready"
+        time.sleep(0.1)
+    yield process, port
+    if process.poll() is None:
+        process.kill()
+        process.wait()
+
+
+def test_workers_serve_and_report_ready(server):
+    process, port = server
+    status, body = _get(port, '/ready')
+    assert status == 200 and json.loads(body)['ready']
+    pids = _worker_pids(port)
+    assert process.pid not in pids
+    assert 1 <= len(pids) <= 2
+
+
+def test_sighup_replaces_the_workers(server, tmp_path):
+    process, port = server
+    before = _worker_pids(port)
+    process.send_signal(signal.SIGHUP)
+    deadline = time.monotonic() + 20
+    while _worker_pids(port, 5) & before:
+        assert time.monotonic() < deadline, "old workers kept serving"
+        time.sleep(0.2)
+    assert process.poll() is None
+    # The master ran master_reload() before forking them
+    assert int((tmp_path / 'master_reload.pid').read_text()) == process.pid
+
+
+def test_sigterm_stops_master_and_workers(server):
+    process, port = server
+    pids = _worker_pids(port)
+    process.send_signal(signal.SIGTERM)
+    assert process.wait(30) == 0
+    for pid in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+
+def test_sigusr1_runs_the_master_task_in_the_master(server, tmp_path):
+    process, port = server
+    workers = _worker_pids(port)
+    for pid in workers:
+        # Workers ignore it; only the master runs the task
+        os.kill(pid, signal.SIGUSR1)
+    process.send_signal(signal.SIGUSR1)
+    marker = tmp_path / 'master_task.pid'
+    deadline = time.monotonic() + 10
+    while not marker.exists() or not marker.read_text():
+        assert time.monotonic() < deadline, "master_task() did not run"
+        time.sleep(0.1)
+    assert int(marker.read_text()) == process.pid
+    assert _worker_pids(port) & workers
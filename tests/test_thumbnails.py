@@ -0,0 +1,72 @@
+import os
+
+import pytest
+from PIL import Image
+
+import thumbnails
+from conftest import write_photo
+
+
+def _service(tmp_path, **kwargs):
+    return thumbnails.ThumbnailService(str(tmp_path / 'cache'), **kwargs)
+
+
+def test_thumbnail_is_made_once(tmp_path, photo_dir):
+    write_photo(photo_dir / 'a.png', 10, size=(400, 300))
+    service = _service(tmp_path)
+
+    path = service.get(str(photo_dir), 'a.png')
+    with Image.open(path) as img:
+        assert img.size == (80, 60)
+    assert service.get(str(photo_dir), 'a.png') == path
+    stats = service.get_stats()
+    assert (stats['misses'], stats['hits'], stats['files']) == (1, 1, 1)
+    with Image.open(service.get(str(photo_dir), 'a.png', 'preview')) as img:
+        assert img.size == (400, 300)
+
+
+def test_changed_original_is_redone(tmp_path, photo_dir):
+    write_photo(photo_dir / 'a.png', 10)
+    service = _service(tmp_path)
+    path = service.get(str(photo_dir), 'a.png')
+    os.utime(path, (1, 1))
+
+    service.get(str(photo_dir), 'a.png')
+    assert service.get_stats()['misses'] == 2
+
+
+def test_missing_original_and_unknown_size(tmp_path, photo_dir):
+    service = _service(tmp_path)
+    assert service.get(str(photo_dir), 'missing.png') is None
+    with pytest.raises(ValueError):
+        service.get(str(photo_dir), 'missing.png', 'poster')
+
+
+def test_least_recently_served_is_evicted(tmp_path, photo_dir):
+    names = ['a.png', 'b.png', 'c.png']
+    for name in names:
+        write_photo(photo_dir / name, 10, size=(400, 300))
+    one = os.path.getsize(_service(tmp_path / 'probe').get(str(photo_dir), 'a.png'))
+    service = _service(tmp_path, max_bytes=2 * one)
+
+    a = service.get(str(photo_dir), 'a.png')
+    b = service.get(str(photo_dir), 'b.png')
+    service.get(str(photo_dir), 'a.png')
+    service.get(str(photo_dir), 'c.png')
+    assert os.path.exists(a) and not os.path.exists(b)
+    stats = service.get_stats()
+    assert stats['evictions'] == 1 and stats['bytes'] <= stats['max_bytes']
+
+
+def test_lru_order_survives_a_restart(tmp_path, photo_dir):
+    for name in ['a.png', 'b.png', 'c.png']:
+        write_photo(photo_dir / name, 10, size=(400, 300))
+    service = _service(tmp_path)
+    a = service.get(str(photo_dir), 'a.png')
+    b = service.get(str(photo_dir), 'b.png')
+    os.utime(b, (1, 1))
+
+    restarted = _service(tmp_path, max_bytes=2 * os.path.getsize(a))
+    assert restarted.get_stats()['files'] == 2
+    restarted.get(str(photo_dir), 'c.png')
+    assert os.path.exists(a) and not os.path.exists(b)
@@ -0,0 +1,142 @@
+# thumbnails.py
+#
+# On-demand thumbnail cache with an LRU disk budget.
+#
+# Thumbnails are created the first time they are requested and kept under
+# <cache_dir>/<size name>/<filename>. Concurrent requests for the same
+# missing thumbnail wait on a per-key lock so the original is only decoded
+# once, and JPEG draft mode lets libjpeg decode straight at a reduced scale.
+# When the cache grows past max_bytes the least recently served thumbnails
+# are deleted; serving a thumbnail bumps its mtime so the LRU order survives
+# restarts.
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+DEFAULT_SIZES = {'gallery': 80, 'preview': 1024}
+
+
+def make_thumbnail(image_path, thumbnail_path, side):
+    """Write a thumbnail of image_path that fits in side x side pixels"""
+    with Image.open(image_path) as img:
+        img.draft('RGB', (side, side))
+        img.thumbnail((side, side))
+        if img.mode not in ('RGB', 'L') and thumbnail_path.lower().endswith(('.jpg', '.jpeg')):
+            img = img.convert('RGB')
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        tmp_path = thumbnail_path + '.tmp' + os.path.splitext(thumbnail_path)[1]
+        img.save(tmp_path)
+    os.replace(tmp_path, thumbnail_path)
+
+
+class ThumbnailService:
+    """Lazily creates thumbnails and keeps their total size under max_bytes"""
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024, sizes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.sizes = dict(sizes or DEFAULT_SIZES)
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0, 'evictions': 0, 'bytes': 0, 'files': 0}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._lru = OrderedDict()
+        self._scan()
+
+    def _scan(self):
+        """Rebuild the LRU order from what is already on disk"""
+        entries = []
+        for size_name in self.sizes:
+            size_dir = os.path.join(self.cache_dir, size_name)
+            if not os.path.isdir(size_dir):
+                continue
+            for fname in os.listdir(size_dir):
+                path = os.path.join(size_dir, fname)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, path, st.st_size))
+        for _, path, size in sorted(entries):
+            self._lru[path] = size
+        self.stats['bytes'] = sum(self._lru.values())
+        self.stats['files'] = len(self._lru)
+
+    def path_for(self, filename, size_name='gallery'):
+        return os.path.join(self.cache_dir, size_name, filename)
+
+    def _touch(self, path):
+        with self._lock:
+            if path in self._lru:
+                self._lru.move_to_end(path)
+            self.stats['hits'] += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _add(self, path):
+        size = os.path.getsize(path)
+        evicted = []
+        with self._lock:
+            self.stats['bytes'] += size - self._lru.pop(path, 0)
+            self._lru[path] = size
+            while self.stats['bytes'] > self.max_bytes and len(self._lru) > 1:
+                old_path, old_size = self._lru.popitem(last=False)
+                self.stats['bytes'] -= old_size
+                self.stats['evictions'] += 1
+                evicted.append(old_path)
+            self.stats['files'] = len(self._lru)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+    def _is_fresh(self, path, source_path):
+        try:
+            return os.path.getmtime(path) >= os.path.getmtime(source_path)
+        except FileNotFoundError:
+            return False
+
+    def get(self, photo_dir, filename, size_name='gallery'):
+        """Return the path of the thumbnail, creating it if needed, or None if it can't be made"""
+        if size_name not in self.sizes:
+            raise ValueError(f"Unknown thumbnail size: {size_name}")
+        source_path = os.path.join(photo_dir, filename)
+        path = self.path_for(filename, size_name)
+        if self._is_fresh(path, source_path):
+            self._touch(path)
+            return path
+        if not os.path.exists(source_path):
+            return None
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(path, threading.Lock())
+        with key_lock:
+            try:
+                # Another request may have created it while we waited
+                if self._is_fresh(path, source_path):
+                    self._touch(path)
+                    return path
+                with self._lock:
+                    self.stats['misses'] += 1
+                start = time.time()
+                make_thumbnail(source_path, path, self.sizes[size_name])
+                self._add(path)
+                print(f"Created {size_name} thumbnail for {filename} in {(time.time() - start) * 1000:.0f} ms")
+                return path
+            except Exception as e:
+                with self._lock:
+                    self.stats['errors'] += 1
+                print(f"Error generating thumbnail for {source_path}: {e}")
+                return None
+            finally:
+                with self._lock:
+                    self._key_locks.pop(path, None)
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, max_bytes=self.max_bytes)
@@ -3,13 +3,30 @@
 import os
 import json
 import numpy as np
-import face_recognition
-from flask import Flask, render_template_string, request, redirect, url_for, session, flash, jsonify, send_from_directory
+from flask import Flask, render_template_string, request, redirect, url_for, session, flash, jsonify
 from werkzeug.utils import secure_filename
 from functools import wraps
 
+import signal
 import threading
-from PIL import Image  # Pillow library for image manipulations
+import time
+
+import encoding_store
+import face_crops
+import face_index
+import generations
+import lazy_models
+import photo_manifest
+import photo_watcher
+import precompute_pipeline
+import thumbnails
+import http_cache
+import result_store
+import query_detect
+import search_engine
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+cv2 = lazy_models.lazy_module('cv2')
 
 
 app = Flask(__name__)
@@ -22,12 +39,15 @@ precompute_progress = {
     'running': False,
     'total': 0,
     'current': 0,
+    'images_per_sec': 0.0,
+    'resumed': 0,
     'message': ''
 }
 
 def load_config():
     if not os.path.exists(CONFIG_FILE):
-        default = {'title': 'Face Search CNN App', 'photo_dir': 'photos', 'encodings_file': 'encodings.json'}
+        default = {'title': 'Face Search CNN App', 'photo_dir': 'photos', 'encodings_file': 'encodings.json',
+                   'encodings_store': 'encodings', 'index': {'kind': 'brute'}}
         with open(CONFIG_FILE, 'w') as f:
             json.dump(default, f)
         return default
@@ -35,13 +55,22 @@ def load_config():
         return json.load(f)
 
 def save_config(cfg):
-    with open(CONFIG_FILE, 'w') as f:
+    # Atomic, the serve.py master may be reading it
+    tmp_path = f'{CONFIG_FILE}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
         json.dump(cfg, f)
+    os.replace(tmp_path, CONFIG_FILE)
 
 config = load_config()
 
 os.makedirs(config['photo_dir'], exist_ok=True)
 
+# Search results live on the server; the session only carries the search ID
+search_results = result_store.ResultStore(
+    config.get('results_dir', '.search_results'),
+    ttl=config.get('results_ttl', 3600),
+    max_entries=config.get('results_max_entries', 1000))
+
 # Authentication decorator simplified
 def login_required(f):
     @wraps(f)
@@ -79,41 +108,86 @@ def index():
 def gallery():
     title = config.get('title', 'Face Search CNN App')
     photo_dir = config.get('photo_dir', 'photos')
-    matched = session.get('search_results')
-    if matched:
-        images = matched
-        if not images:
-            flash("No matches found.", "info")
-    else:
-        images = []
-    return render_template_string(GALLERY_HTML, title=title, images=images, photo_dir=photo_dir)
+    search_id = request.args.get('search') or session.get('search_id')
+    page_size = config.get('gallery_page_size', 50)
+    page = max(1, request.args.get('page', 1, type=int))
+    matched = search_results.get(search_id) if search_id else None
+    if matched is None:
+        if search_id:
+            flash("Search results expired, please search again.", "info")
+        search_id = None
+        matched = []
+    elif not matched:
+        flash("No matches found.", "info")
+    pages = max(1, (len(matched) + page_size - 1) // page_size)
+    images = matched[(page - 1) * page_size:page * page_size]
+    return render_template_string(GALLERY_HTML, title=title, images=images, photo_dir=photo_dir,
+                                  search_id=search_id, page=page, pages=pages)
 
 @app.route('/photos/<filename>')
 def photos(filename):
     photo_dir = config.get('photo_dir', 'photos')
-    return send_from_directory(photo_dir, filename)
+    return http_cache.send_cached_file(photo_dir, filename)
 
-def generate_thumbnail(image_path, thumbnail_path, size=(80,80)):
-    try:
-        with Image.open(image_path) as img:
-            img.thumbnail(size)
-            os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
-            img.save(thumbnail_path)
-            return True
-    except Exception as e:
-        print(f"Error generating thumbnail for {image_path}: {e}")
-        return False
-
-# Update gallery page to load thumbnails if exist
+# Version of a photo for cache-busting URLs, e.g. url_for('photos', filename=f, v=photo_version(f))
+@app.template_global()
+def photo_version(filename):
+    return http_cache.file_version(os.path.join(config.get('photo_dir', 'photos'), filename))
+
+thumbnail_lock = threading.Lock()
+thumbnail_service = None
+
+# Thumbnail cache for the current photo directory, created lazily
+def get_thumbnail_service():
+    global thumbnail_service
+    thumbnail_dir = os.path.join(config.get('photo_dir', 'photos'), ".thumbnails")
+    with thumbnail_lock:
+        if thumbnail_service is None or thumbnail_service.cache_dir != thumbnail_dir:
+            thumbnail_service = thumbnails.ThumbnailService(
+                thumbnail_dir, max_bytes=config.get('thumbnail_cache_mb', 512) * 1024 * 1024)
+        return thumbnail_service
+
+# Thumbnails are created on first request (?size=gallery|preview)
 @app.route('/photos/thumbnails/<filename>')
 def photos_thumbnail(filename):
     photo_dir = config.get('photo_dir', 'photos')
-    thumbnail_dir = os.path.join(photo_dir, ".thumbnails")
-    return send_from_directory(thumbnail_dir, filename)
+    if filename.startswith('.') or os.path.basename(filename) != filename:
+        return jsonify({'error': 'Photo not found'}), 404
+    size = request.args.get('size', 'gallery')
+    service = get_thumbnail_service()
+    if size not in service.sizes:
+        return jsonify({'error': f'Unknown thumbnail size: {size}'}), 400
+    path = service.get(photo_dir, filename, size)
+    if path is None:
+        return jsonify({'error': 'Photo not found'}), 404
+    # Thumbnail URLs are versioned by the original photo
+    return http_cache.send_cached_file(os.path.dirname(path), os.path.basename(path),
+                                       version=photo_version(filename))
+
+# Face crops are written by the precompute workers, next to the thumbnail cache
+def face_crop_dir():
+    return os.path.join(config.get('photo_dir', 'photos'), ".thumbnails", "faces")
+
+@app.route('/photos/faces/<filename>/<int:face>')
+def photos_face(filename, face):
+    if filename.startswith('.') or os.path.basename(filename) != filename:
+        return jsonify({'error': 'Photo not found'}), 404
+    return http_cache.send_cached_file(face_crop_dir(), face_crops.crop_name(filename, face),
+                                       version=photo_version(filename))
+
+@app.route('/admin/thumbnail_stats')
+@login_required
+def thumbnail_stats():
+    return jsonify(get_thumbnail_service().get_stats())
+
+@app.route('/admin/startup_stats')
+@login_required
+def startup_stats():
+    return jsonify(lazy_models.metrics)
 
 @app.route('/clear_search')
 def clear_search():
-    session.pop('search_results', None)
+    search_results.delete(session.pop('search_id', None))
     flash('Cleared search results.', 'success')
     return redirect(url_for('gallery'))
 
@@ -132,6 +206,11 @@ def admin():
             config['title'] = title
             config['photo_dir'] = photo_dir
             save_config(config)
+            if serve_master['pid'] is not None:
+                # The master re-reads the file, moves its watcher and forks workers that have it
+                os.kill(serve_master['pid'], signal.SIGHUP)
+            else:
+                start_photo_watcher()
             flash("Configuration updated.", "success")
             return redirect(url_for('admin'))
     return render_template_string(ADMIN_HTML, config=config, error=error)
@@ -226,15 +305,212 @@ def admin():
 #         precompute_progress['message'] = 'Precomputation completed.'
 # # 
 
+# precompute into the binary encoding store, only encoding new or changed photos.
+# Results are flushed to the store in checkpoints, every checkpoint_every photos or
+# checkpoint_seconds, so an interrupted run resumes from its last checkpoint.
+# changed lists the photos a watcher saw change: only those are planned, and the
+# store's shards are not verified again, so a few new photos cost a few encodes.
+def precompute_encodings_with_progress(changed=None):
+    global precompute_progress
+    with precompute_lock:
+        if precompute_progress['running']:
+            return False
+        precompute_progress['running'] = True
+        precompute_progress['total'] = 0
+        precompute_progress['current'] = 0
+        precompute_progress['resumed'] = 0
+        precompute_progress['message'] = 'Starting precomputation...'
+    # Whatever happens below, the run ends: a failed one must not leave
+    # 'running' set or the store locked, or no precompute could start again
+    message = 'Precomputation failed, see the server log.'
+    writer = None
+    try:
+        photo_dir = config.get('photo_dir', 'photos')
+        prefix = encodings_store_prefix()
+        # Server processes started by serve.py share the store; one of them writes at a time
+        writer = encoding_store.lock_writer(prefix)
+        if writer is None:
+            message = 'Precomputation is running in another server process.'
+            return False
+        manifest_path = prefix + '.manifest.json'
+        checkpoint_path = prefix + '.checkpoint.json'
+        shard_size = config.get('shard_size', encoding_store.SHARD_SIZE)
+        # An interrupted run's unfinished photos are in no watcher's list; plan them all
+        if changed is not None and not os.path.exists(checkpoint_path):
+            stale = []
+            have_store = encoding_store.read_manifest(prefix) is not None
+        else:
+            changed = None
+            # Photos in damaged shards, or stored with their first face only, are encoded again
+            stale = encoding_store.stale_photos(prefix)
+            have_store = stale is not None and encoding_store.read_manifest(prefix) is not None
+        # What the store holds so far; grows with every checkpoint
+        done = photo_manifest.load_manifest(manifest_path, photo_dir) if have_store else {}
+        manifest, files, dropped, full = photo_manifest.plan(photo_dir, manifest_path, have_store, changed=changed)
+        if have_store and stale:
+            files += [f for f in set(stale) - set(files) if f in manifest]
+            dropped += stale
+        for fname in dropped:
+            done.pop(fname, None)
+
+        # A checkpoint file left behind means the previous run was interrupted; it
+        # records how many photos that run set out to encode
+        total = len(files)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                total = max(total, json.load(f).get('total', 0))
+        resumed = total - len(files)
+        tmp_path = checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'total': total, 'started': time.time()}, f)
+        os.replace(tmp_path, checkpoint_path)
+        with precompute_lock:
+            precompute_progress['total'] = total
+            precompute_progress['current'] = resumed
+            precompute_progress['resumed'] = resumed
+            precompute_progress['images_per_sec'] = 0.0
+            if resumed:
+                precompute_progress['message'] = f'Resuming at {resumed}/{total} images...'
+            else:
+                precompute_progress['message'] = f'Processing {len(files)} new or changed images...'
+            save_progress()
+        progress_saved = {'at': time.time()}
+
+        pending = {'entries': [], 'names': [], 'drop': list(dropped), 'fresh': full, 'at': time.time()}
+
+        def checkpoint():
+            if pending['fresh']:
+                encoding_store.write_store(prefix, pending['entries'], shard_size)
+                pending['fresh'] = False
+            else:
+                # Flushed photos are dropped too, so replaying a checkpoint whose
+                # manifest write was lost cannot store them twice
+                encoding_store.append_store(prefix, pending['drop'] + pending['names'], pending['entries'], shard_size)
+            for fname in pending['names']:
+                done[fname] = manifest[fname]
+            photo_manifest.save_manifest(manifest_path, photo_dir, done)
+            pending.update({'entries': [], 'names': [], 'drop': [], 'at': time.time()})
+            # Searches pick up the photos of every checkpoint
+            refresh_index()
+
+        # Writer stage: runs on a single thread, in completion order
+        def store_result(fname, boxes, file_encodings):
+            pending['names'].append(fname)
+            if boxes:
+                # Every face of the photo, so people in group shots are found too
+                pending['entries'].append((fname, file_encodings, boxes))
+            else:
+                print(f"No face found in {fname}, skipping")
+            if (len(pending['names']) >= config.get('checkpoint_every', 500)
+                    or time.time() - pending['at'] >= config.get('checkpoint_seconds', 60)):
+                checkpoint()
+
+        def forget_failed(fname, error):
+            manifest.pop(fname, None)  # retry on the next run
+
+        def report(stats):
+            with precompute_lock:
+                precompute_progress['current'] = resumed + stats.processed
+                precompute_progress['images_per_sec'] = round(stats.images_per_sec(), 2)
+                precompute_progress['message'] = (f'Processed {resumed + stats.processed}/{total} images'
+                                                  + (f' (resumed at {resumed})' if resumed else ''))
+                if time.time() - progress_saved['at'] >= 1.0:
+                    save_progress()
+                    progress_saved['at'] = time.time()
+
+        # Face crops of removed or changed photos go; the workers write the new ones
+        crop_dir = face_crop_dir()
+        for fname in dropped:
+            face_crops.remove_face_crops(crop_dir, fname)
+
+        stats = precompute_pipeline.run_pipeline(
+            photo_dir, files, store_result, on_progress=report, on_error=forget_failed,
+            workers=config.get('precompute_workers'), model='cnn',
+            batch_size=config.get('detect_batch_size', 8),
+            detect_max_side=config.get('detect_max_side', 1024),
+            encode_max_side=config.get('encode_max_side', 2048),
+            crop_dir=crop_dir, crop_side=config.get('face_crop_side', face_crops.DEFAULT_SIDE))
+
+        if pending['names'] or pending['drop'] or pending['fresh']:
+            checkpoint()
+        # The scan also refreshes the mtimes of unchanged photos
+        photo_manifest.save_manifest(manifest_path, photo_dir, manifest)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        message = 'Precomputation completed.' + (f' {stats.failed} images failed and are retried on the next run.'
+                                                  if stats.failed else '')
+        return True
+    finally:
+        with precompute_lock:
+            precompute_progress['running'] = False
+            precompute_progress['message'] = message
+            if writer is not None:
+                save_progress()
+        if writer is not None:
+            writer.close()
+
+# Under serve.py a worker is replaced whenever the index changes, which would cut a
+# precompute short, so the master runs it (master_task) and the workers read its
+# progress from a file next to the store
+serve_master = {'pid': None}
+
+def worker_started():
+    """serve.py hook: remember the master, which runs precompute for this worker"""
+    serve_master['pid'] = os.getppid()
+
+def master_task():
+    """serve.py hook: run on SIGUSR1 in the master"""
+    precompute_encodings_with_progress()
+
+def master_reload():
+    """serve.py hook: run on SIGHUP in the master, e.g. after the admin page saved config.json"""
+    config.update(load_config())
+    start_photo_watcher()
+
+def precompute_progress_path():
+    return encodings_store_prefix() + '.progress.json'
+
+def save_progress():
+    # Called with precompute_lock held
+    path = precompute_progress_path()
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(precompute_progress, pid=os.getpid()), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save precompute progress: {e}")
+
+def current_progress():
+    """Progress of this process's precompute, or of the serve.py master's"""
+    if serve_master['pid'] is None:
+        with precompute_lock:
+            return dict(precompute_progress)
+    try:
+        with open(precompute_progress_path()) as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        return dict(precompute_progress)
+    try:
+        os.kill(progress.pop('pid'), 0)
+    except ProcessLookupError:
+        progress['running'] = False  # the process running it died
+    except (KeyError, TypeError, PermissionError):
+        pass
+    return progress
+
 # Endpoint to start precompute asynchronously
 @app.route('/admin/precompute')
 @login_required
 def admin_precompute():
-    if precompute_progress['running']:
+    if current_progress()['running']:
         flash("Precomputation is already running.", "warning")
         return redirect(url_for('admin'))
-    thread = threading.Thread(target=precompute_encodings_with_progress)
-    thread.start()
+    if serve_master['pid'] is not None:
+        os.kill(serve_master['pid'], signal.SIGUSR1)
+    else:
+        thread = threading.Thread(target=precompute_encodings_with_progress)
+        thread.start()
     flash("Started encoding precomputation.", "info")
     return redirect(url_for('admin'))
 
@@ -242,8 +518,7 @@ def admin_precompute():
 @app.route('/admin/precompute_progress')
 @login_required
 def precompute_progress_api():
-    with precompute_lock:
-        return jsonify(precompute_progress)
+    return jsonify(current_progress())
 
 # # Precompute face encodings from images in photo directory
 # def precompute_encodings():
@@ -273,17 +548,152 @@ def precompute_progress_api():
 #         json.dump({'images': images, 'encodings': encodings}, f)
 #     print("Precomputation complete and saved.")
 
-# Load the saved encodings
-def load_encodings():
+def encodings_store_prefix():
+    return config.get('encodings_store', 'encodings')
+
+# Convert a legacy encodings.json or single-file store into the sharded store once
+def migrate_json_encodings():
+    prefix = encodings_store_prefix()
+    if encoding_store.read_manifest(prefix) is not None:
+        return
+    legacy_meta = prefix + '.meta.json'
     encodings_path = config.get('encodings_file','encodings.json')
-    if not os.path.exists(encodings_path):
-        print("Encodings file not found, please run precompute_encodings() first.")
-        return [], []
-    with open(encodings_path) as f:
-        data = json.load(f)
-    images = data.get('images', [])
-    encodings = [np.array(e) for e in data.get('encodings',[])]
-    return images, encodings
+    if os.path.exists(legacy_meta):
+        with open(legacy_meta) as f:
+            meta = json.load(f)
+        matrix = np.load(os.path.join(os.path.dirname(os.path.abspath(legacy_meta)), meta['matrix']))
+        by_image = {}
+        for name, encoding in zip(meta['images'], matrix):
+            by_image.setdefault(name, []).append(encoding)
+        encoding_store.write_store(prefix, list(by_image.items()))
+        print(f"Migrated {len(matrix)} encodings from {legacy_meta}")
+    elif os.path.exists(encodings_path):
+        with open(encodings_path) as f:
+            data = json.load(f)
+        images = data.get('images', [])
+        encoding_store.write_store(prefix, [(name, [e]) for name, e in zip(images, data.get('encodings', []))])
+        print(f"Migrated {len(images)} encodings from {encodings_path}")
+
+# Load the saved encodings (memory-mapped shards, reloaded only when the store changes)
+def load_encodings():
+    store = encoding_store.get_store(encodings_store_prefix())
+    if len(store) == 0:
+        print("Encodings store not found, please run precompute_encodings_with_progress() first.")
+    return store
+
+migrate_json_encodings()
+
+# Under app.run(debug=True) this module also runs in the reloader's parent, which only
+# watches the source files and restarts the serving child; it must not load the models
+# or encode photos (lazy_models.warm_in_background() checks the same)
+def reloader_parent():
+    return __name__ == '__main__' and not os.environ.get('WERKZEUG_RUN_MAIN')
+
+# A checkpoint left by an interrupted precompute (crash, redeploy) is picked up at startup
+if not reloader_parent() and config.get('resume_precompute', True) and os.path.exists(encodings_store_prefix() + '.checkpoint.json'):
+    threading.Thread(target=precompute_encodings_with_progress, daemon=True).start()
+
+# Copy-on-write search state: each generation holds a (store snapshot, index) pair.
+# Replaced generations are closed once the last search using them has finished.
+search_generation = generations.GenerationHolder(on_release=lambda pair: pair[1].close())
+index_build_lock = threading.Lock()
+
+# Writer side: indexes a new store version and publishes it. Runs after every precompute
+# checkpoint, after the photo watcher's ingests and in serve.py's master (warm_up), never
+# in a query. One nearest-neighbour index per shard; only shards new since the last
+# version are indexed.
+def refresh_index():
+    with index_build_lock:
+        store = load_encodings()
+        current = search_generation.current
+        # get_store() hands out the same snapshot until the store changes
+        if current.value is not None and current.value[0] is store:
+            return current
+        params = dict(config.get('index', {'kind': 'brute'}))
+        kind = params.pop('kind', 'brute')
+        previous = current.value[1] if current.value is not None else None
+        search_generation.publish((store, face_index.ShardedIndex(store.shards, kind, previous=previous, **params)))
+        return search_generation.current
+
+# Read side: the generation queries search; callers keep it while they use its store and
+# index. Queries never wait for a build, they get what the writer side published last.
+def get_index():
+    return search_generation.current
+
+# The first index is built in the background, so the server starts at once
+if not reloader_parent():
+    threading.Thread(target=refresh_index, name='index-build', daemon=True).start()
+
+# Hooks for serve.py: the index is loaded once in the master process and shared by the workers it forks
+def warm_up():
+    """Load the current index; returns its store version"""
+    return refresh_index().value[0].version
+
+def index_ready():
+    return search_generation.current.value is not None
+
+# New photos are encoded in the background and published to the live index
+# filenames is None when the watcher lost events and the whole directory is rescanned
+def ingest_changed_photos(filenames):
+    changes = "unknown changes" if filenames is None else f"{len(filenames)} changed photos"
+    print(f"Photo watcher: {changes}")
+    # Changes a busy store kept an earlier call from ingesting are picked up with these
+    with photo_watcher_lock:
+        missed, photo_watcher_state['missed'] = photo_watcher_state['missed'], set()
+    names = None if filenames is None or missed is None else sorted(missed | set(filenames))
+    # An admin-started run, or one in another server process, may be busy: wait for it
+    # with growing pauses
+    delay = 1.0
+    for attempt in range(config.get('ingest_retries', 8)):
+        if precompute_encodings_with_progress(changed=names):
+            refresh_index()
+            return
+        time.sleep(delay)
+        delay = min(delay * 2, 60.0)
+    with photo_watcher_lock:
+        missed = photo_watcher_state['missed']
+        photo_watcher_state['missed'] = None if names is None or missed is None else missed | set(names)
+    print(f"Photo watcher: precompute still busy, leaving {changes} to the next run")
+
+photo_watcher_lock = threading.Lock()
+photo_watcher_state = {'watcher': None, 'missed': set()}  # missed None: rescan everything
+
+def start_photo_watcher():
+    if not config.get('watch_photos', True):
+        return
+    photo_dir = config.get('photo_dir', 'photos')
+    with photo_watcher_lock:
+        watcher = photo_watcher_state['watcher']
+        if watcher is not None and watcher.directory == photo_dir:
+            return
+        if watcher is not None:
+            # It may be busy ingesting; it exits once that is done
+            watcher.stop(wait=False)
+            photo_watcher_state['watcher'] = None
+            photo_watcher_state['missed'] = set()
+        if not os.path.isdir(photo_dir):
+            print(f"Photo directory {photo_dir} not found, not watching it")
+            return
+        photo_watcher_state['watcher'] = photo_watcher.DirectoryWatcher(
+            photo_dir, ingest_changed_photos,
+            debounce=config.get('watch_debounce', 2.0),
+            poll_interval=config.get('watch_poll_interval', 5.0)).start()
+
+if not reloader_parent():
+    start_photo_watcher()
+
+# A forked server worker has none of the master's threads: whatever they held or
+# were running is not held or running there
+def _reset_after_fork():
+    global precompute_lock, index_build_lock, photo_watcher_lock
+    precompute_lock = threading.Lock()
+    index_build_lock = threading.Lock()
+    photo_watcher_lock = threading.Lock()
+    precompute_progress['running'] = False
+    photo_watcher_state['watcher'] = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
 
 # API endpoint for face search
 @app.route('/api/search_face', methods=['POST'])
@@ -295,37 +705,63 @@ def search_face():
     if file.filename == '':
         return jsonify({'error': 'Empty filename'}), 400
 
+    started = time.perf_counter()
     img_data = file.read()
     npimg = np.frombuffer(img_data, np.uint8)
     # Decode image + convert to RGB (face_recognition expects RGB)
-    import cv2
     img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
+    if img is None:
+        return jsonify({'error': 'Could not decode image'}), 400
     rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    timings = {'decode_ms': round((time.perf_counter() - started) * 1000, 1)}
 
-    # Detect face locations using CNN
-    boxes = face_recognition.face_locations(rgb_img, model="cnn")
+    # HOG on a downscaled frame first, CNN only if HOG finds nothing
+    boxes, detector, detect_timings = query_detect.detect_query_faces(
+        rgb_img,
+        hog_max_side=config.get('query_hog_max_side', 480),
+        cnn_max_side=config.get('query_cnn_max_side', 800))
+    timings.update(detect_timings)
     if not boxes:
-        return jsonify({'results': [], 'message': 'No faces found'}), 200
+        timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return jsonify({'results': [], 'message': 'No faces found', 'detector': detector, 'timings': timings}), 200
 
+    # Every face in the frame is searched, in one batched query
+    step = time.perf_counter()
     query_encodings = face_recognition.face_encodings(rgb_img, boxes)
-    query_encoding = query_encodings[0]  # Take first face only
+    timings['encode_ms'] = round((time.perf_counter() - step) * 1000, 1)
 
-    stored_images, stored_encodings = load_encodings()
-    if not stored_encodings:
+    generation = get_index()
+    if generation.value is None:
+        return jsonify({'results': [], 'message': 'The search index is loading, try again shortly.'}), 503, {'Retry-After': '2'}
+    store, index = generation.value
+    if len(store) == 0:
         return jsonify({'results': [], 'message': 'No stored encodings found. Run precompute.'}), 500
 
-    # Compute distances and pick best matches
-    distances = face_recognition.face_distance(stored_encodings, query_encoding)
-    # Sort by ascending distance (lower means closer)
-    sorted_idx = np.argsort(distances)
-    top_matches = []
-    for idx in sorted_idx[:10]:
-        top_matches.append({'filename': stored_images[idx], 'distance': float(distances[idx])})
+    # Top K photos per query face by their closest stored face, within tolerance.
+    # Candidates are over-fetched since several faces of one photo may rank together.
+    step = time.perf_counter()
+    k = config.get('search_top_k', 10)
+    tolerance = config.get('search_tolerance', 0.6)
+    faces = []
+    for box, (ids, distances) in zip(boxes, index.search_batch(query_encodings, k * config.get('search_overfetch', 4))):
+        photos, best, rows = search_engine.top_k_photos(distances, store.photos(ids), k, tolerance)
+        top_matches = []
+        for photo, distance, row in zip(photos, best, rows):
+            top_matches.append({'filename': store.photo_name(photo), 'distance': float(distance),
+                                'face': store.face(ids[row]), 'box': store.box(ids[row])})
+        # Keep the results server-side, the cookie only carries the search ID
+        faces.append({'box': list(box), 'results': top_matches, 'search_id': search_results.put(top_matches)})
 
-    # Save matched filenames in session for gallery display
-    session['search_results'] = [m['filename'] for m in top_matches]
+    # Faces left to right, so "person 1" is the leftmost in the frame
+    faces.sort(key=lambda face: face['box'][3])
+    session['search_id'] = faces[0]['search_id']
+    timings['search_ms'] = round((time.perf_counter() - step) * 1000, 1)
+    timings['total_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    lazy_models.record_first_query(time.perf_counter() - started)
 
-    return jsonify(results=top_matches)
+    message = '' if any(face['results'] for face in faces) else 'No matching photos within tolerance'
+    return jsonify(results=faces[0]['results'], search_id=faces[0]['search_id'], faces=faces,
+                   detector=detector, timings=timings, message=message)
 
 # # Route to run precompute (protected behind admin)
 # @app.route('/admin/precompute')
@@ -400,7 +836,7 @@ ADMIN_HTML = """
             percent = Math.round((data.current / data.total) * 100);
           }
           progressBar.value = percent;
-          progressMsg.textContent = data.message + ` (${percent}%)`;
+          progressMsg.textContent = data.message + ` (${percent}%, ${data.images_per_sec} images/sec)`;
           timer = setTimeout(pollProgress, 1000);
         } else {
           progressBar.value = 100;
@@ -434,6 +870,7 @@ body {display:flex;flex-direction:column;align-items:center;justify-content:cent
 button {margin-top:15px;padding:10px 20px;background:#007bff;color:#fff;border:none;border-radius:5px;font-size:16px;cursor:pointer;}
 button:disabled {background:#aaa;cursor:not-allowed;}
 #loading {margin-top:10px;color:#555;display:none;}
+#faces a {display:inline-block;margin:10px 8px 0;color:#007bff;font-weight:bold;text-decoration:none;}
 
 nav {margin-top:30px;}
 nav a {margin:0 15px;text-decoration:none;color:#007bff;font-weight:bold;}
@@ -444,6 +881,7 @@ nav a {margin:0 15px;text-decoration:none;color:#007bff;font-weight:bold;}
 <video id="video" autoplay playsinline width="320" height="240"></video>
 <button id="captureBtn">Capture & Search Face</button>
 <div id="loading">Processing, please wait...</div>
+<div id="faces"></div>
 <nav>
   <a href="{{ url_for('gallery') }}">Gallery</a>
   {% if session.logged_in %}
@@ -458,6 +896,18 @@ const video = document.getElementById('video');
 const captureBtn = document.getElementById('captureBtn');
 const loading = document.getElementById('loading');
 
+// Several people in the frame: one gallery link per face, left to right
+function showFaces(faces){
+  const list = document.getElementById('faces');
+  list.innerHTML = '';
+  faces.forEach((face, i) => {
+    const link = document.createElement('a');
+    link.href = '/gallery?search=' + encodeURIComponent(face.search_id);
+    link.textContent = `Person ${i + 1} (${face.results.length} photos)`;
+    list.appendChild(link);
+  });
+}
+
 navigator.mediaDevices.getUserMedia({ video:true }).then(stream => {
   video.srcObject = stream;
 }).catch(() => alert("Cannot access camera."));
@@ -466,31 +916,38 @@ captureBtn.onclick = () => {
   loading.style.display = '';
   captureBtn.disabled = true;
 
+  // Send a resized JPEG, the server never needs more than this for a query
+  const maxSide = 640;
+  const width = video.videoWidth || 320;
+  const height = video.videoHeight || 240;
+  const ratio = Math.min(1, maxSide / Math.max(width, height));
   const canvas = document.createElement('canvas');
-  canvas.width = video.videoWidth || 320;
-  canvas.height = video.videoHeight || 240;
+  canvas.width = Math.round(width * ratio);
+  canvas.height = Math.round(height * ratio);
   canvas.getContext('2d').drawImage(video,0,0,canvas.width,canvas.height);
 
   canvas.toBlob(blob => {
     const formData = new FormData();
-    formData.append('image', blob, 'capture.png');
+    formData.append('image', blob, 'capture.jpg');
 
     fetch('/api/search_face', {method:'POST', body: formData})
     .then(res => res.json())
     .then(data => {
       loading.style.display = 'none';
       captureBtn.disabled = false;
-      if(data.results.length === 0){
+      if(!data.faces || data.faces.every(face => face.results.length === 0)){
         alert(data.message || "No faces recognized.");
+      } else if(data.faces.length > 1){
+        showFaces(data.faces);
       } else {
-        window.location.href = '/gallery';
+        window.location.href = '/gallery?search=' + encodeURIComponent(data.search_id);
       }
     }).catch(() => {
       loading.style.display = 'none';
       captureBtn.disabled = false;
       alert('Error during face search.');
     });
-  }, 'image/png');
+  }, 'image/jpeg', 0.9);
 };
 </script>
 </body>
@@ -509,6 +966,7 @@ body {font-family:sans-serif; margin:2rem auto; max-width:900px; text-align:cent
 #modal .close {color:#fff; font-size:2rem; position:absolute; top:20px; right:40px; cursor:pointer; user-select:none;}
 nav {margin-bottom:20px;}
 nav a {margin:0 10px; color:#007bff; text-decoration:none; font-weight:bold;}
+.pager a {margin:0 10px; color:#007bff; text-decoration:none;}
 </style>
 </head>
 <body>
@@ -524,13 +982,29 @@ nav a {margin:0 10px; color:#007bff; text-decoration:none; font-weight:bold;}
 <h1>Search Results Gallery</h1>
 {% if images %}
 <div class="gallery">
-  {% for img in images %}
+  {% for match in images %}
+  {% set img = match.filename %}
+  {% set v = photo_version(img) %}
+  {% if match.box %}
+  <img 
+    src="{{ url_for('photos_face', filename=img, face=match.face, v=v) }}" 
+    onerror="this.onerror=null;this.src='{{ url_for('photos_thumbnail', filename=img, v=v) }}';" 
+    class="thumb" onclick="openModal('{{ url_for('photos_thumbnail', filename=img, size='preview', v=v) }}')" alt="{{ img }}">
+  {% else %}
   <img 
-    src="{{ url_for('photos_thumbnail', filename=img) }}" 
-    onerror="this.onerror=null;this.src='{{ url_for('photos', filename=img) }}';" 
-    class="thumb" onclick="openModal(this.src)" alt="{{ img }}">
+    src="{{ url_for('photos_thumbnail', filename=img, v=v) }}" 
+    onerror="this.onerror=null;this.src='{{ url_for('photos', filename=img, v=v) }}';" 
+    class="thumb" onclick="openModal('{{ url_for('photos_thumbnail', filename=img, size='preview', v=v) }}')" alt="{{ img }}">
+  {% endif %}
   {% endfor %}
 </div>
+{% if pages > 1 %}
+<p class="pager">
+  {% if page > 1 %}<a href="{{ url_for('gallery', search=search_id, page=page-1) }}">&laquo; Prev</a>{% endif %}
+  Page {{ page }} of {{ pages }}
+  {% if page < pages %}<a href="{{ url_for('gallery', search=search_id, page=page+1) }}">Next &raquo;</a>{% endif %}
+</p>
+{% endif %}
 {% else %}
 <p>No face matches found. <a href="{{ url_for('index') }}">Try again</a>.</p>
 {% endif %}
@@ -555,5 +1029,8 @@ function closeModal(){
 </html>
 """
 
+lazy_models.mark_app_imported()
+
 if __name__ == '__main__':
+    lazy_models.warm_in_background(reloader=True)
     app.run(debug=True)
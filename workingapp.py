@@ -1,12 +1,15 @@
 import os
 import json
 import numpy as np
-import face_recognition
 from flask import Flask, render_template_string, request, redirect, url_for, session, flash, jsonify, send_from_directory
 from flask import session
 from functools import wraps
 from werkzeug.utils import secure_filename
 
+import lazy_models
+
+face_recognition = lazy_models.lazy_module('face_recognition')
+
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey'  # Change this in production
@@ -476,4 +479,5 @@ GALLERY_HTML = """
 """
 
 if __name__ == '__main__':
+    lazy_models.warm_in_background(reloader=True)
     app.run(host="0.0.0.0", port=int("5000"), debug=True)